@@ -0,0 +1,342 @@
+import asyncio
+
+from databases import Database
+from sqlalchemy import select, func
+from starlette.applications import Starlette
+from starlette.exceptions import HTTPException
+from starlette.responses import JSONResponse
+from starlette.routing import Route
+
+from models import Question, Category, format_question_row
+from helpers import encode_cursor, decode_cursor, paginate_ids
+from config import get_config
+from selection import QuestionPool, ALL, requested_difficulty
+from search import InvertedIndex
+from flaskr import QUESTIONS_PER_PAGE, MAX_QUESTIONS_PER_PAGE, MAX_QUIZ_BATCH
+
+'''
+Async serving mode
+    The read routes of the trivia API (categories, questions, search and
+    quizzes) on an ASGI server, with an async database driver and connection
+    pool. Questions are still created and deleted through the flaskr app.
+
+    uvicorn asgi:app --workers 4
+'''
+
+questions_table = Question.__table__
+categories_table = Category.__table__
+question_columns = [questions_table.c.id, questions_table.c.question,
+                    questions_table.c.answer, questions_table.c.category,
+                    questions_table.c.difficulty]
+
+ERROR_MESSAGES = {
+    400: 'Bad request',
+    404: 'Not found.',
+    405: 'Method not allowed',
+    422: 'Unprocessable',
+    500: 'Internal server error.',
+    503: 'Service unavailable'
+}
+
+
+def async_database_url(uri):
+    # databases uses asyncpg for postgresql:// urls
+    if uri.startswith('postgres://'):
+        return 'postgresql://' + uri[len('postgres://'):]
+    return uri
+
+
+def create_asgi_app(test_config=None):
+    config_class = get_config()
+    config = {key: getattr(config_class, key)
+              for key in dir(config_class) if key.isupper()}
+    if test_config is not None:
+        config.update(test_config)
+
+    url = async_database_url(config['SQLALCHEMY_DATABASE_URI'])
+    options = {}
+    if url.startswith('postgresql'):
+        options = {'min_size': 1,
+                   'max_size': config['DB_POOL_SIZE'] +
+                   config['DB_MAX_OVERFLOW']}
+    database = Database(url, **options)
+
+    # Own pool and index: the ones of flaskr are filled with its session.
+    # Both are reloaded every ASYNC_RELOAD_INTERVAL seconds to see the
+    # changes made by the flaskr app.
+    pool = QuestionPool()
+    index = InvertedIndex()
+    search_in_memory = config.get('SEARCH_BACKEND', 'memory') == 'memory'
+    reload_interval = config['ASYNC_RELOAD_INTERVAL']
+
+    async def load():
+        rows = await database.fetch_all(select(question_columns))
+        pool.load([(row['id'], row['category'], row['difficulty'])
+                   for row in rows])
+        if search_in_memory:
+            index.load([(row['id'], row['question'], row['answer'],
+                         row['category']) for row in rows])
+
+    async def reload_forever():
+        while True:
+            await asyncio.sleep(reload_interval)
+            await load()
+
+    reloader = []
+
+    async def startup():
+        await database.connect()
+        await load()
+        if reload_interval:
+            reloader.append(asyncio.ensure_future(reload_forever()))
+
+    async def shutdown():
+        for task in reloader:
+            task.cancel()
+        await database.disconnect()
+
+    def questions_per_page(request):
+        try:
+            per_page = int(request.query_params.get(
+                'per_page', QUESTIONS_PER_PAGE))
+        except ValueError:
+            raise HTTPException(400)
+        return max(1, min(per_page, MAX_QUESTIONS_PER_PAGE))
+
+    def page_number(request):
+        try:
+            return max(int(request.query_params.get('page', 1)), 1)
+        except ValueError:
+            raise HTTPException(400)
+
+    async def page_of_questions(request, query):
+        # Same pagination as helpers.paginate: ?cursor= keyset or ?page=
+        quantity = questions_per_page(request)
+        query = query.order_by(questions_table.c.id)
+        cursor = request.query_params.get('cursor', None)
+        try:
+            if cursor:
+                query = query.where(
+                    questions_table.c.id > decode_cursor(cursor))
+            else:
+                query = query.offset((page_number(request) - 1) * quantity)
+        except ValueError:
+            raise HTTPException(400)
+
+        rows = await database.fetch_all(query.limit(quantity + 1))
+        next_cursor = None
+        if len(rows) > quantity:
+            rows = rows[:quantity]
+            next_cursor = encode_cursor(rows[-1]['id'])
+        return [_format(row) for row in rows], next_cursor
+
+    async def fetch_questions(ids):
+        rows = await database.fetch_all(select(question_columns).where(
+            questions_table.c.id.in_(ids)))
+        by_id = {row['id']: _format(row) for row in rows}
+        return [by_id[id] for id in ids if id in by_id]
+
+    async def fetch_categories():
+        rows = await database.fetch_all(select(
+            [categories_table.c.id, categories_table.c.type]).order_by(
+            categories_table.c.id))
+        return [{'id': row['id'], 'type': row['type']} for row in rows]
+
+    async def count_questions(category=None):
+        query = select([func.count(questions_table.c.id)])
+        if category is not None:
+            query = query.where(questions_table.c.category == category)
+        return await database.fetch_val(query)
+
+    async def index_route(request):
+        total_categories = await database.fetch_val(
+            select([func.count(categories_table.c.id)]))
+        return JSONResponse({
+            'questions': str(request.base_url) + 'questions',
+            'categories': str(request.base_url) + 'categories',
+            'total_questions': await count_questions(),
+            'total_categories': total_categories
+        })
+
+    async def categories(request):
+        return JSONResponse({
+            'categories': await fetch_categories(),
+            'success': True
+        })
+
+    async def questions(request):
+        current_questions, next_cursor = await page_of_questions(
+            request, select(question_columns))
+        if len(current_questions) == 0:
+            raise HTTPException(404)
+
+        return JSONResponse({
+            'success': True,
+            'list_of_questions': current_questions,
+            'total_questions': await count_questions(),
+            'categories': await fetch_categories(),
+            'items_per_page': questions_per_page(request),
+            'next_cursor': next_cursor
+        })
+
+    async def search_questions(request):
+        search = request.query_params.get('search', None)
+        if search is None:
+            # Questions are created with the flaskr app
+            raise HTTPException(405)
+
+        category = request.query_params.get('category', None)
+        answers = request.query_params.get('answers', '') == 'true'
+        try:
+            category = int(category) if category is not None else None
+            if search_in_memory:
+                found_ids = index.search(search, category, answers)
+            else:
+                found_ids = await postgres_search(search, category, answers)
+            page_ids, next_cursor = paginate_ids(
+                _ArgsAdapter(request), found_ids,
+                questions_per_page(request))
+        except ValueError:
+            raise HTTPException(400)
+
+        return JSONResponse({
+            'success': True,
+            'questions': await fetch_questions(page_ids),
+            'total_questions': len(found_ids),
+            'search': search or None,
+            'next_cursor': next_cursor
+        })
+
+    async def postgres_search(term, category, answers):
+        # Same query as search.PostgresSearch
+        document = func.coalesce(questions_table.c.question, '')
+        if answers:
+            document = document + ' ' + \
+                func.coalesce(questions_table.c.answer, '')
+        vector = func.to_tsvector('english', document)
+        query = func.plainto_tsquery('english', term)
+        matches = select([questions_table.c.id]).where(
+            vector.op('@@')(query))
+        if category is not None:
+            matches = matches.where(questions_table.c.category == category)
+        matches = matches.order_by(func.ts_rank(vector, query).desc(),
+                                   questions_table.c.id)
+        return [row['id'] for row in await database.fetch_all(matches)]
+
+    async def questions_by_category(request):
+        category_id = request.path_params['category_id']
+        category = await database.fetch_one(select(
+            [categories_table.c.id]).where(
+            categories_table.c.id == category_id))
+        if category is None:
+            raise HTTPException(404)
+
+        current_questions, next_cursor = await page_of_questions(
+            request, select(question_columns).where(
+                questions_table.c.category == category_id))
+        return JSONResponse({
+            'success': True,
+            'questions': current_questions,
+            'total_questions': await count_questions(category_id),
+            'current_category': category_id,
+            'next_cursor': next_cursor
+        })
+
+    async def quizzes(request):
+        try:
+            body = await request.json()
+            prev_questions = set(
+                int(id) for id in body.get('previous_questions'))
+            quiz_category = int(body.get('quiz_category')['id'])
+            band, level = requested_difficulty(body)
+        except Exception:
+            raise HTTPException(400)
+
+        if quiz_category != ALL:
+            category = await database.fetch_one(select(
+                [categories_table.c.id]).where(
+                categories_table.c.id == quiz_category))
+            if category is None:
+                raise HTTPException(404)
+
+        try:
+            count = body.get('count', None)
+            if count is not None and not 1 <= int(count) <= MAX_QUIZ_BATCH:
+                raise ValueError('Invalid count')
+        except (TypeError, ValueError):
+            raise HTTPException(400)
+
+        # Same as draw_questions() of flaskr
+        while True:
+            ids, remaining, drawn_level = pool.draw_many(
+                quiz_category, prev_questions, int(count or 1), band=band,
+                level=level)
+            questions = await fetch_questions(ids)
+            if len(questions) == len(ids):
+                break
+            found = set(question['id'] for question in questions)
+            for id in ids:
+                if id not in found:
+                    pool.remove(id)
+
+        response = {
+            'success': True,
+            'question': questions[0] if questions else None,
+            'total_questions': remaining
+        }
+        if count is not None:
+            response['questions'] = questions
+        if level is not None:
+            response['difficulty'] = drawn_level
+        return JSONResponse(response)
+
+    async def http_error(request, error):
+        return JSONResponse({
+            'success': False,
+            'error': error.status_code,
+            'message': ERROR_MESSAGES.get(error.status_code, error.detail)
+        }, status_code=error.status_code)
+
+    routes = [
+        Route('/', index_route),
+        Route('/categories', categories, methods=['GET']),
+        Route('/questions', questions, methods=['GET']),
+        Route('/questions', search_questions, methods=['POST']),
+        Route('/categories/{category_id:int}/questions',
+              questions_by_category, methods=['GET']),
+        Route('/quizzes', quizzes, methods=['POST']),
+    ]
+    return Starlette(routes=routes,
+                     exception_handlers={HTTPException: http_error},
+                     on_startup=[startup], on_shutdown=[shutdown])
+
+
+class _ArgsAdapter:
+    # helpers.paginate_ids reads request.args like in Flask
+    def __init__(self, request):
+        self.args = _Args(request.query_params)
+
+
+class _Args:
+
+    def __init__(self, params):
+        self._params = params
+
+    def get(self, key, default=None, type=None):
+        value = self._params.get(key, None)
+        if value is None:
+            return default
+        if type is not None:
+            try:
+                return type(value)
+            except ValueError:
+                return default
+        return value
+
+
+def _format(row):
+    return format_question_row([row[column.name]
+                                for column in question_columns])
+
+
+app = create_asgi_app()
@@ -0,0 +1,311 @@
+import argparse
+import json
+import random
+import subprocess
+import sys
+import threading
+import time
+import urllib.error
+import urllib.request
+from concurrent.futures import ThreadPoolExecutor
+
+from sqlalchemy import event
+
+from flaskr import create_app
+from models import db, Question, QuestionHash, Category
+from bulk import import_questions
+import migrations
+
+'''
+Benchmarks
+    Seeds a synthetic question bank into a local database, drives every read
+    route with concurrent clients and writes the latency percentiles,
+    throughput and SQL queries per request of each one as JSON, to compare
+    two commits:
+
+    python benchmark.py --database-url postgres://.../trivia_bench \
+        --questions 100000 --seed --output before.json
+    python benchmark.py --database-url ... --baseline before.json
+
+    Without --url the requests go through the flask test client, in
+    process, which is the only way the queries can be counted. With --url
+    they are sent to a running server (flask or asgi.py).
+'''
+
+CATEGORIES = ('Science', 'Art', 'Geography', 'History', 'Entertainment',
+              'Sports')
+WORDS = ('which', 'country', 'river', 'painter', 'element', 'world', 'cup',
+         'first', 'largest', 'planet', 'movie', 'actor', 'king', 'queen',
+         'war', 'century', 'ocean', 'mountain', 'team', 'player', 'book',
+         'author', 'song', 'band', 'animal', 'city', 'island', 'empire',
+         'invented', 'discovered', 'famous', 'ancient', 'modern', 'blood',
+         'star', 'gold', 'soccer', 'title', 'capital', 'language')
+SEARCH_TERMS = ('world', 'river cup', 'famous painter', 'anc', 'title',
+                'nothing matches this')
+ROUTES = ('index', 'categories', 'questions', 'search', 'category_questions',
+          'quizzes')
+# A route is a regression when its p95 grows more than this
+REGRESSION_THRESHOLD = 0.2
+
+
+def synthetic_questions(count, categories, random):
+    # Same shape as the rows read by bulk.import_questions
+    for number in range(count):
+        words = random.sample(WORDS, random.randint(4, 9))
+        yield {
+            'question': ' '.join(words).capitalize() + ' #{}?'.format(number),
+            'answer': random.choice(WORDS).capitalize(),
+            'category': random.choice(categories),
+            'difficulty': random.randint(1, 5)
+        }
+
+
+def seed_database(count, random):
+    # Replaces the questions with count synthetic ones
+    migrations.upgrade(db.engine)
+    if Category.query.count() == 0:
+        for type in CATEGORIES:
+            db.session.add(Category(type=type))
+        db.session.commit()
+    categories = [category.id for category in Category.query.all()]
+
+    # The fingerprints first: SQLite ignores their ON DELETE CASCADE, and
+    # the ids of the questions are reused
+    QuestionHash.query.delete()
+    Question.query.delete()
+    db.session.commit()
+    return import_questions(synthetic_questions(count, categories, random))
+
+
+class QueryCounter:
+    # Counts the statements run by each thread on the engine
+
+    def __init__(self, engine):
+        self._local = threading.local()
+        event.listen(engine, 'before_cursor_execute', self._count)
+
+    def _count(self, *args):
+        self._local.count = getattr(self._local, 'count', 0) + 1
+
+    def reset(self):
+        self._local.count = 0
+
+    @property
+    def count(self):
+        return getattr(self._local, 'count', 0)
+
+
+class TestClientDriver:
+    # Sends the requests to the app in process
+
+    def __init__(self, app):
+        self.app = app
+        self.queries = QueryCounter(db.engine)
+
+    def request(self, method, path, body=None):
+        self.queries.reset()
+        res = self.app.test_client().open(path, method=method, json=body)
+        res.get_data()
+        return res.status_code, self.queries.count
+
+
+class HTTPDriver:
+    # Sends the requests to a running server, queries can't be counted
+
+    def __init__(self, url):
+        self.url = url.rstrip('/')
+
+    def request(self, method, path, body=None):
+        data = None if body is None else json.dumps(body).encode('utf-8')
+        req = urllib.request.Request(
+            self.url + path, data=data, method=method,
+            headers={'Content-Type': 'application/json'})
+        try:
+            with urllib.request.urlopen(req) as res:
+                res.read()
+                return res.status, None
+        except urllib.error.HTTPError as error:
+            return error.code, None
+
+
+def make_request(route, total_questions, categories, random):
+    # (method, path, body) of a request to route
+    if route == 'index':
+        return 'GET', '/', None
+    if route == 'categories':
+        return 'GET', '/categories', None
+    if route == 'questions':
+        pages = max(1, (total_questions + 9) // 10)
+        return 'GET', '/questions?page={}'.format(
+            random.randint(1, pages)), None
+    if route == 'search':
+        return 'POST', '/questions?search={}'.format(
+            random.choice(SEARCH_TERMS).replace(' ', '+')), None
+    if route == 'category_questions':
+        return 'GET', '/categories/{}/questions'.format(
+            random.choice(categories)), None
+    if route == 'quizzes':
+        previous = random.sample(range(1, total_questions + 1),
+                                 min(total_questions, 20))
+        return 'POST', '/quizzes', {
+            'previous_questions': previous,
+            'quiz_category': {'id': random.choice((0,) + categories)}}
+    raise ValueError('Unknown route: {}'.format(route))
+
+
+def is_error(status):
+    # Anything but a success or a 304: the 404 and 409 of an empty or broken
+    # bank are fast, they must not make a baseline
+    return not (200 <= status < 300 or status == 304)
+
+
+def percentile(values, rank):
+    # Nearest rank on sorted values
+    if not values:
+        return None
+    index = max(0, int(round(rank / 100.0 * len(values))) - 1)
+    return values[min(index, len(values) - 1)]
+
+
+def run_route(driver, route, count, clients, total_questions, categories,
+              seed):
+    def client(number):
+        generator = random.Random('{}-{}-{}'.format(seed, route, number))
+        results = []
+        for _ in range(count // clients + (number < count % clients)):
+            method, path, body = make_request(
+                route, total_questions, categories, generator)
+            start = time.perf_counter()
+            status, queries = driver.request(method, path, body)
+            results.append((time.perf_counter() - start, status, queries))
+        return results
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=clients) as executor:
+        results = [result for results in executor.map(client, range(clients))
+                   for result in results]
+    elapsed = time.perf_counter() - start
+
+    latencies = sorted(latency * 1000 for latency, _, _ in results)
+    queries = [queries for _, _, queries in results if queries is not None]
+    return {
+        'requests': len(results),
+        'errors': sum(1 for _, status, _ in results if is_error(status)),
+        'throughput': round(len(results) / elapsed, 1) if elapsed else None,
+        'p50_ms': round(percentile(latencies, 50), 3),
+        'p95_ms': round(percentile(latencies, 95), 3),
+        'p99_ms': round(percentile(latencies, 99), 3),
+        'queries_per_request': (round(sum(queries) / len(queries), 2)
+                                if queries else None)
+    }
+
+
+def compare(result, baseline, threshold=REGRESSION_THRESHOLD):
+    # Routes whose p95 got worse than the baseline by more than threshold,
+    # the routes with errors in the baseline are not compared
+    regressions = []
+    for route, stats in result['routes'].items():
+        before = baseline.get('routes', {}).get(route)
+        if not before or not before['p95_ms'] or before.get('errors'):
+            continue
+        change = stats['p95_ms'] / before['p95_ms'] - 1
+        if change > threshold:
+            regressions.append({'route': route,
+                                'before_p95_ms': before['p95_ms'],
+                                'p95_ms': stats['p95_ms'],
+                                'change': round(change, 3)})
+    return regressions
+
+
+def git_commit():
+    try:
+        return subprocess.check_output(
+            ['git', 'rev-parse', '--short', 'HEAD'],
+            stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Benchmark the trivia API')
+    parser.add_argument('--database-url', default=None,
+                        help='database to seed and query (default: config)')
+    parser.add_argument('--questions', type=int, default=1000,
+                        help='size of the synthetic bank')
+    parser.add_argument('--seed', action='store_true',
+                        help='replace the questions with a synthetic bank')
+    parser.add_argument('--url', default=None,
+                        help='benchmark a running server instead')
+    parser.add_argument('--routes', default=','.join(ROUTES))
+    parser.add_argument('--requests', type=int, default=500,
+                        help='requests per route')
+    parser.add_argument('--clients', type=int, default=8,
+                        help='concurrent clients')
+    parser.add_argument('--warmup', type=int, default=20,
+                        help='requests per route before measuring')
+    parser.add_argument('--random-seed', type=int, default=1)
+    parser.add_argument('--output', default=None,
+                        help='file for the JSON results (default: stdout)')
+    parser.add_argument('--baseline', default=None,
+                        help='results of a previous run to compare with')
+    args = parser.parse_args(argv)
+
+    # The clients would be rate limited like a single one otherwise
+    config = {'RATE_LIMIT_ENABLED': False}
+    if args.database_url:
+        config['SQLALCHEMY_DATABASE_URI'] = args.database_url
+    app = create_app(config)
+    with app.app_context():
+        if args.seed:
+            seeded = seed_database(args.questions, random.Random(
+                args.random_seed))
+            print('Seeded {} questions'.format(seeded['imported']),
+                  file=sys.stderr)
+        total_questions = Question.query.count()
+        if (args.seed and not seeded['imported']) or not total_questions:
+            print('No questions to benchmark', file=sys.stderr)
+            return 1
+        categories = tuple(category.id for category in Category.query.all())
+
+        if args.url:
+            driver = HTTPDriver(args.url)
+        else:
+            driver = TestClientDriver(app)
+
+        routes = {}
+        for route in args.routes.split(','):
+            if route not in ROUTES:
+                parser.error('unknown route {}'.format(route))
+            if args.warmup:
+                run_route(driver, route, args.warmup, 1, total_questions,
+                          categories, 'warmup')
+            routes[route] = run_route(
+                driver, route, args.requests, args.clients, total_questions,
+                categories, args.random_seed)
+            print('{}: {}'.format(route, routes[route]), file=sys.stderr)
+        database = db.engine.dialect.name
+
+    result = {
+        'commit': git_commit(),
+        'database': database,
+        'target': args.url or 'test_client',
+        'questions': total_questions,
+        'clients': args.clients,
+        'routes': routes
+    }
+    if args.baseline:
+        with open(args.baseline) as baseline:
+            result['regressions'] = compare(result, json.load(baseline))
+
+    output = json.dumps(result, indent=2)
+    if args.output:
+        with open(args.output, 'w') as file:
+            file.write(output + '\n')
+    else:
+        print(output)
+    errors = any(stats['errors'] for stats in routes.values())
+    return 1 if errors or result.get('regressions') else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,178 @@
+import csv
+import io
+import json
+
+from sqlalchemy import func
+
+from models import db, Question, notify_change
+from cache import cached_categories
+from dedupe import ImportFilter, index_missing
+
+'''
+Bulk import/export of question banks
+    Rows are read and written one at a time, so files of any size are
+    handled in constant memory. Imports are written in batches, with COPY on
+    PostgreSQL and a single executemany INSERT per batch otherwise. Rows
+    whose question is already in the table, or earlier in the file, are
+    skipped (see dedupe.py).
+'''
+
+IMPORT_BATCH_SIZE = 5000
+EXPORT_BATCH_SIZE = 1000
+# Only the first errors are kept in the import result
+MAX_REPORTED_ERRORS = 100
+
+FIELDS = ('question', 'answer', 'category', 'difficulty')
+FORMATS = ('csv', 'jsonl')
+
+
+def guess_format(name, default='jsonl'):
+    # format from a file name or a content type
+    name = (name or '').lower()
+    if name.endswith('.csv') or 'csv' in name:
+        return 'csv'
+    if name.endswith('.jsonl') or 'ndjson' in name or 'jsonl' in name:
+        return 'jsonl'
+    return default
+
+
+def read_rows(lines, format):
+    # lines is any iterable of text lines (a file, a decoded request stream)
+    if format == 'csv':
+        return csv.DictReader(lines)
+    if format == 'jsonl':
+        return (_parse_json_line(line) for line in lines if line.strip())
+    raise ValueError('Unknown format: {}'.format(format))
+
+
+def _parse_json_line(line):
+    # An invalid line is passed on as its error, so it is reported as a
+    # rejected row instead of stopping the import
+    try:
+        return json.loads(line)
+    except ValueError as error:
+        return error
+
+
+def validate_row(row, categories):
+    # Returns the row as a dict ready to insert, raises ValueError otherwise
+    if isinstance(row, ValueError):
+        raise ValueError('Invalid JSON: {}'.format(row))
+    if not isinstance(row, dict):
+        raise ValueError('Row is not an object')
+    missing = [field for field in FIELDS if row.get(field) in (None, '')]
+    if missing:
+        raise ValueError('Missing ' + ', '.join(missing))
+    try:
+        category = int(row['category'])
+        difficulty = int(row['difficulty'])
+    except (TypeError, ValueError):
+        raise ValueError('category and difficulty must be integers')
+    if category not in categories:
+        raise ValueError('Unknown category {}'.format(category))
+    return {
+        'question': str(row['question']),
+        'answer': str(row['answer']),
+        'category': category,
+        'difficulty': difficulty
+    }
+
+
+def import_questions(rows, batch_size=IMPORT_BATCH_SIZE, progress=None,
+                     skip_duplicates=True):
+    # Validates and inserts the rows, every batch is committed on its own.
+    # progress(imported, rejected) is called after each batch.
+    categories = set(category['id'] for category in cached_categories())
+    result = {'imported': 0, 'rejected': 0, 'duplicates': 0, 'errors': []}
+    batch = []
+    duplicates = ImportFilter() if skip_duplicates else None
+    last_id = db.session.query(func.max(Question.id)).scalar()
+
+    def flush():
+        nonlocal last_id
+        kept = duplicates.filter(batch) if duplicates is not None else batch
+        if kept:
+            _insert_batch(kept)
+            # COPY gives no ids, the new rows are fingerprinted afterwards,
+            # before the next batch looks for its duplicates
+            index_missing(after_id=last_id)
+            last_id = db.session.query(func.max(Question.id)).scalar()
+        result['imported'] += len(kept)
+        result['duplicates'] += len(batch) - len(kept)
+        del batch[:]
+        if progress is not None:
+            progress(result['imported'], result['rejected'])
+
+    try:
+        for line, row in enumerate(rows, 1):
+            try:
+                batch.append(validate_row(row, categories))
+            except ValueError as error:
+                result['rejected'] += 1
+                if len(result['errors']) < MAX_REPORTED_ERRORS:
+                    result['errors'].append({'row': line,
+                                             'message': str(error)})
+                continue
+            if len(batch) >= batch_size:
+                flush()
+        if batch:
+            flush()
+    finally:
+        if result['imported']:
+            # The rows of a batch that failed to be fingerprinted
+            index_missing(after_id=last_id)
+            # Caches can't be updated row by row here, they are reloaded
+            notify_change('questions', 'reload')
+    return result
+
+
+def _insert_batch(batch):
+    if db.engine.dialect.name == 'postgresql':
+        _copy_batch(batch)
+    else:
+        db.session.execute(Question.__table__.insert(), batch)
+        db.session.commit()
+
+
+def _copy_batch(batch):
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    for row in batch:
+        writer.writerow([row[field] for field in FIELDS])
+    buffer.seek(0)
+
+    connection = db.engine.raw_connection()
+    try:
+        cursor = connection.cursor()
+        cursor.copy_expert(
+            'COPY questions ({}) FROM STDIN WITH (FORMAT csv)'.format(
+                ', '.join(FIELDS)), buffer)
+        connection.commit()
+    finally:
+        connection.close()
+
+
+def export_questions(format):
+    # Yields the questions table as lines of text, rows are fetched from a
+    # server-side cursor EXPORT_BATCH_SIZE at a time
+    columns = ('id',) + FIELDS
+    rows = db.session.query(
+        Question.id, Question.question, Question.answer, Question.category,
+        Question.difficulty).order_by(Question.id).execution_options(
+        stream_results=True).yield_per(EXPORT_BATCH_SIZE)
+
+    if format == 'jsonl':
+        for row in rows:
+            yield json.dumps(dict(zip(columns, row))) + '\n'
+    elif format == 'csv':
+        buffer = io.StringIO()
+        writer = csv.writer(buffer)
+        writer.writerow(columns)
+        for row in rows:
+            writer.writerow(row)
+            yield buffer.getvalue()
+            buffer.seek(0)
+            buffer.truncate()
+        yield buffer.getvalue()
+    else:
+        raise ValueError('Unknown format: {}'.format(format))
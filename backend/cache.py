@@ -0,0 +1,209 @@
+import threading
+import time
+from collections import OrderedDict
+
+from models import Question, Category, on_change
+from replicas import reading_from_replica
+
+'''
+LRUCache
+    Size bounded cache with a time to live per entry. Every cache is
+    registered in `caches` so its hit/miss counters can be observed.
+
+    invalidate() and clear() bump the generation of the cache. A value is
+    set() with the generation read before it was loaded, and dropped if it
+    changed in the meantime: the value may have been read before the change
+    that invalidated it.
+
+    A read replica may not have a change yet, so nothing read from one is
+    cached during the replica_delay seconds after a change (the largest of
+    DB_STICKY_SECONDS and DB_REPLICA_MAX_LAG).
+'''
+
+caches = OrderedDict()
+
+# Time of the last change seen by invalidate()
+last_change = 0.0
+replica_delay = 0
+
+_MISSING = object()
+
+
+class LRUCache:
+
+    def __init__(self, name, maxsize=1024, ttl=300):
+        self.name = name
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self.generation = 0
+        self._lock = threading.Lock()
+        # key -> (expires, value), least recently used first
+        self._entries = OrderedDict()
+        caches[name] = self
+
+    def get(self, key, default=None):
+        with self._lock:
+            entry = self._entries.get(key, _MISSING)
+            if entry is not _MISSING and entry[0] > time.time():
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return entry[1]
+            if entry is not _MISSING:
+                del self._entries[key]
+            self.misses += 1
+            return default
+
+    def set(self, key, value, generation=None):
+        # Returns False when value was loaded before an invalidation, or
+        # from a replica right after a change
+        if reading_from_replica() and \
+                time.time() - last_change < replica_delay:
+            return False
+        with self._lock:
+            if generation is not None and generation != self.generation:
+                return False
+            self._entries[key] = (time.time() + self.ttl, value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+            return True
+
+    def get_or_load(self, key, loader):
+        value = self.get(key, _MISSING)
+        if value is _MISSING:
+            generation = self.generation
+            value = loader()
+            self.set(key, value, generation)
+        return value
+
+    def invalidate(self, key):
+        with self._lock:
+            self.generation += 1
+            self._entries.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self.generation += 1
+            self._entries.clear()
+
+    def stats(self):
+        requests = self.hits + self.misses
+        return {
+            'name': self.name,
+            'size': len(self._entries),
+            'maxsize': self.maxsize,
+            'ttl': self.ttl,
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_rate': self.hits / requests if requests else None
+        }
+
+
+category_list = LRUCache('categories', maxsize=1)
+category_question_ids = LRUCache('category_question_ids', maxsize=256)
+question_payloads = LRUCache('question_payloads', maxsize=10000)
+# Questions already encoded as JSON, spliced into the listing responses
+question_json = LRUCache('question_json', maxsize=10000)
+# Compressed bodies of the responses with an ETag, by (url, ETag,
+# encoding): a change gives new ETags, so they are never invalidated
+compressed_bodies = LRUCache('compressed_bodies', maxsize=1024)
+
+
+def configure_caches(app):
+    # CACHE_TTL and CACHE_MAXSIZE ({cache name: maxsize}) are optional
+    global replica_delay
+    replica_delay = max(app.config.get('DB_STICKY_SECONDS', 5),
+                        app.config.get('DB_REPLICA_MAX_LAG', 0))
+    for cache in caches.values():
+        cache.ttl = app.config.get('CACHE_TTL', cache.ttl)
+        cache.maxsize = app.config.get('CACHE_MAXSIZE', {}).get(
+            cache.name, cache.maxsize)
+
+
+'''
+Read-through helpers
+'''
+
+
+def cached_categories():
+    return category_list.get_or_load('all', lambda: [
+        category.format()
+        for category in Category.query.order_by(Category.id).all()])
+
+
+def cached_category(category_id):
+    for category in cached_categories():
+        if category['id'] == category_id:
+            return category
+    return None
+
+
+def cached_category_ids(category_id):
+    # Sorted ids of the questions of a category
+    return category_question_ids.get_or_load(category_id, lambda: [
+        id for id, in Question.query.with_entities(Question.id).filter(
+            Question.category == category_id).order_by(Question.id).all()])
+
+
+def cached_questions(ids):
+    # Formatted questions of the given ids, in the same order. The ones that
+    # are not cached are loaded with a single query.
+    payloads = {}
+    missing = []
+    generation = question_payloads.generation
+    for id in ids:
+        payload = question_payloads.get(id)
+        if payload is None:
+            missing.append(id)
+        else:
+            payloads[id] = payload
+    if missing:
+        for payload in Question.format_many(missing):
+            question_payloads.set(payload['id'], payload, generation)
+            payloads[payload['id']] = payload
+    return [payloads[id] for id in ids if id in payloads]
+
+
+def cached_question_json(ids, load, dumps):
+    # Encoded questions of the given ids, in the same order. load(ids) gives
+    # the formatted questions that are not cached, dumps encodes them.
+    encoded = {}
+    missing = []
+    generation = question_json.generation
+    for id in ids:
+        data = question_json.get(id)
+        if data is None:
+            missing.append(id)
+        else:
+            encoded[id] = data
+    if missing:
+        for payload in load(missing):
+            data = dumps(payload)
+            question_json.set(payload['id'], data, generation)
+            encoded[payload['id']] = data
+    return [encoded[id] for id in ids if id in encoded]
+
+
+@on_change
+def invalidate(change):
+    global last_change
+    last_change = time.time()
+    if change.table == 'categories':
+        category_list.clear()
+    elif change.table == 'questions':
+        if change.action in ('insert', 'delete') and \
+                change.category is not None:
+            question_payloads.invalidate(change.id)
+            question_json.invalidate(change.id)
+            category_question_ids.invalidate(int(change.category))
+        elif change.action == 'update':
+            # The question may have moved to another category
+            question_payloads.invalidate(change.id)
+            question_json.invalidate(change.id)
+            category_question_ids.clear()
+        else:
+            question_payloads.clear()
+            question_json.clear()
+            category_question_ids.clear()
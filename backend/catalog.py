@@ -0,0 +1,369 @@
+import sys
+import threading
+import time
+from array import array
+from bisect import bisect_left
+
+from models import db, Question, Category, on_changes
+from selection import pool
+from search import search_index
+
+'''
+Catalog
+    Every question held in memory, column by column: arrays of ids,
+    categories and difficulties and lists of the question and answer strings
+    (answers are interned, many questions share them). With
+    QUESTION_CATALOG=true the listings, searches and quizzes are served from
+    it without any query.
+
+    Readers take the current Snapshot, which is never changed: each batch
+    of changes builds a new one in a single pass (the columns are append
+    only, so they are shared), with one query for the changed questions.
+    The changes of the other processes arrive in batches through the change
+    bus (see change_bus.py); CATALOG_RELOAD_INTERVAL adds a full reload from
+    the database every so many seconds, for CHANGE_BUS=off. The changes made
+    while a reload runs are applied again to the reloaded snapshot, which
+    may have been read before them.
+'''
+
+# Stored for a NULL category or difficulty
+NO_VALUE = -1
+# Changed ids per IN (...) clause
+CHUNK_SIZE = 500
+
+
+class Snapshot:
+    __slots__ = ('ids', 'rows', 'by_category', 'question', 'answer',
+                 'category', 'difficulty', 'categories')
+
+    def __init__(self, ids, rows, by_category, columns, categories):
+        # ids: sorted question ids, rows: the position of each one in the
+        # columns, by_category: category -> sorted ids
+        self.ids = ids
+        self.rows = rows
+        self.by_category = by_category
+        self.question, self.answer, self.category, self.difficulty = columns
+        self.categories = categories
+
+    def row(self, id):
+        index = bisect_left(self.ids, id)
+        if index < len(self.ids) and self.ids[index] == id:
+            return self.rows[index]
+        return None
+
+    def format(self, id, row):
+        return {
+            'id': id,
+            'question': self.question[row],
+            'answer': self.answer[row],
+            'category': _value(self.category[row]),
+            'difficulty': _value(self.difficulty[row])
+        }
+
+    def columns(self):
+        return self.question, self.answer, self.category, self.difficulty
+
+    def with_changes(self, rows, removed=()):
+        # New snapshot with the (id, question, answer, category, difficulty)
+        # rows added or replaced and the removed ids dropped. The ids and
+        # the categories they leave or join are copied once.
+        columns = self.columns()
+        # id -> its new row, None when removed
+        changes = dict.fromkeys(removed)
+        for row in rows:
+            changes[row[0]] = len(self.question)
+            _append(columns, row)
+        if not changes:
+            return self
+
+        # category -> {id: True when added, None when removed}
+        by_category = dict(self.by_category)
+        category_changes = {}
+        for id, position in changes.items():
+            row = self.row(id)
+            if row is not None:
+                category_changes.setdefault(
+                    _value(self.category[row]), {})[id] = None
+        for id, position in changes.items():
+            if position is not None:
+                category_changes.setdefault(
+                    _value(self.category[position]), {})[id] = True
+        for category, category_ids in category_changes.items():
+            by_category[category] = _splice(
+                by_category.get(category, array('l')), None,
+                sorted(category_ids.items()))[0]
+        ids, positions = _splice(self.ids, self.rows, sorted(changes.items()))
+        return Snapshot(ids, positions, by_category, columns,
+                        self.categories)
+
+    def with_categories(self, categories):
+        return Snapshot(self.ids, self.rows, self.by_category,
+                        self.columns(), categories)
+
+
+class Catalog:
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._reload_lock = threading.Lock()
+        self._snapshot = None
+        # Changes (snapshot -> snapshot) made while a reload runs, None
+        # when none runs
+        self._pending = None
+        self.loaded_at = None
+        # Also load the in-memory search index (SEARCH_BACKEND=memory)
+        self.load_search_index = True
+
+    @property
+    def loaded(self):
+        return self._snapshot is not None
+
+    def snapshot(self):
+        snapshot = self._snapshot
+        if snapshot is None:
+            # The first readers wait for a single load
+            with self._reload_lock:
+                snapshot = self._snapshot
+                if snapshot is None:
+                    snapshot = self._reload()
+        return snapshot
+
+    def ids(self, category=None):
+        # Sorted ids of every question or of a category
+        snapshot = self.snapshot()
+        if category is None:
+            return snapshot.ids
+        return snapshot.by_category.get(category, array('l'))
+
+    def count(self, category=None):
+        return len(self.ids(category))
+
+    def questions(self, ids):
+        # Formatted questions of the given ids that exist, in the same order
+        return list(self.iter_questions(ids))
+
+    def iter_questions(self, ids):
+        snapshot = self.snapshot()
+        for id in ids:
+            row = snapshot.row(id)
+            if row is not None:
+                yield snapshot.format(id, row)
+
+    def categories(self):
+        return self.snapshot().categories
+
+    def category(self, category_id):
+        for category in self.categories():
+            if category['id'] == category_id:
+                return category
+        return None
+
+    def load(self, rows, categories):
+        # Replaces the catalog with the (id, question, answer, category,
+        # difficulty) rows, in id order, and the formatted categories
+        ids = array('l')
+        by_category = {}
+        columns = ([], [], array('l'), array('i'))
+        for row in rows:
+            ids.append(row[0])
+            _append(columns, row)
+            by_category.setdefault(row[3], array('l')).append(row[0])
+        snapshot = Snapshot(ids, array('l', range(len(ids))), by_category,
+                            columns, categories)
+        with self._lock:
+            for change in self._pending or ():
+                snapshot = change(snapshot)
+            self._pending = None
+            self._snapshot = snapshot
+            self.loaded_at = time.time()
+        return snapshot
+
+    def reload(self):
+        # Loads the catalog from the database, then the quiz pool and the
+        # search index from the catalog. The changes made from the start are
+        # applied again to each of them.
+        with self._reload_lock:
+            return self._reload()
+
+    def _reload(self):
+        with self._lock:
+            self._pending = []
+        pool.begin_load()
+        if self.load_search_index:
+            search_index.begin_load()
+        try:
+            rows = db.session.query(
+                Question.id, Question.question, Question.answer,
+                Question.category, Question.difficulty).order_by(
+                Question.id).execution_options(
+                stream_results=True).yield_per(10000)
+            categories = [category.format() for category in
+                          Category.query.order_by(Category.id).all()]
+            snapshot = self.load(rows, categories)
+        except Exception:
+            with self._lock:
+                self._pending = None
+            raise
+
+        self._load_pool(snapshot)
+        if self.load_search_index:
+            search_index.load(
+                (id, snapshot.question[row], snapshot.answer[row],
+                 _value(snapshot.category[row]))
+                for id, row in zip(snapshot.ids, snapshot.rows))
+        return snapshot
+
+    def _load_pool(self, snapshot):
+        pool.load((id, _value(snapshot.category[row]),
+                   _value(snapshot.difficulty[row]))
+                  for id, row in zip(snapshot.ids, snapshot.rows))
+
+    def apply(self, rows, removed=()):
+        # Adds or replaces the (id, question, answer, category, difficulty)
+        # rows and removes the ids of removed
+        self._change(lambda snapshot: snapshot.with_changes(rows, removed))
+
+    def _change(self, change):
+        # change: snapshot -> new snapshot
+        with self._lock:
+            if self._pending is not None:
+                self._pending.append(change)
+            if self._snapshot is not None:
+                self._snapshot = change(self._snapshot)
+
+    def invalidate(self, changes):
+        # on_changes listener: the changed questions are read again with one
+        # query per CHUNK_SIZE ids and applied together
+        if self._snapshot is None and self._pending is None:
+            return
+        # id -> True when inserted or updated, False when deleted
+        questions = {}
+        categories = updated = False
+        for change in changes:
+            if change.table == 'categories':
+                categories = True
+            elif change.action in ('insert', 'update'):
+                questions[change.id] = True
+                updated = updated or change.action == 'update'
+            elif change.action == 'delete':
+                questions[change.id] = False
+            else:
+                self.reload()
+                return
+
+        if categories:
+            formatted = [category.format() for category in
+                         Category.query.order_by(Category.id).all()]
+            self._change(
+                lambda snapshot: snapshot.with_categories(formatted))
+        if not questions:
+            return
+        ids = [id for id, present in questions.items() if present]
+        rows = []
+        for start in range(0, len(ids), CHUNK_SIZE):
+            rows.extend(tuple(row) for row in db.session.query(
+                Question.id, Question.question, Question.answer,
+                Question.category, Question.difficulty).filter(
+                Question.id.in_(ids[start:start + CHUNK_SIZE])))
+        found = set(row[0] for row in rows)
+        self.apply(rows, [id for id in questions if id not in found])
+        if updated and self._snapshot is not None:
+            # The pool drops itself on updates, it would be reloaded from
+            # the database otherwise
+            self._load_pool(self._snapshot)
+
+    def start_reloading(self, app, interval):
+        # Reloads the catalog every interval seconds in a daemon thread
+        def reload_forever():
+            while True:
+                time.sleep(interval)
+                with app.app_context():
+                    try:
+                        self.reload()
+                    except Exception:
+                        app.logger.exception('Catalog reload failed')
+                    finally:
+                        db.session.remove()
+
+        thread = threading.Thread(target=reload_forever,
+                                  name='catalog-reload', daemon=True)
+        thread.start()
+        return thread
+
+    def stats(self):
+        snapshot = self._snapshot
+        if snapshot is None:
+            return {'loaded': False}
+        # Interned answers are counted once
+        strings = {id(text): text for text in
+                   snapshot.question + snapshot.answer if text is not None}
+        columns = (snapshot.ids, snapshot.rows, snapshot.question,
+                   snapshot.answer, snapshot.category, snapshot.difficulty) + \
+            tuple(snapshot.by_category.values())
+        size = sum(map(sys.getsizeof, columns)) + \
+            sum(map(sys.getsizeof, strings.values()))
+        return {
+            'loaded': True,
+            'loaded_at': self.loaded_at,
+            'questions': len(snapshot.ids),
+            'rows': len(snapshot.question),
+            'strings': len(strings),
+            'bytes': size,
+            'bytes_per_question': (size // len(snapshot.ids)
+                                   if snapshot.ids else None)
+        }
+
+
+def _append(columns, row):
+    question, answer, category, difficulty = columns
+    question.append(row[1])
+    answer.append(sys.intern(row[2]) if row[2] is not None else None)
+    category.append(NO_VALUE if row[3] is None else row[3])
+    difficulty.append(NO_VALUE if row[4] is None else row[4])
+
+
+def _splice(ids, values, changes):
+    # Copies of the sorted ids, and of the values in the same order (None
+    # for none), with the sorted (id, value) changes applied: a None value
+    # removes the id, any other adds or replaces it. The runs of ids
+    # between two changes are copied as slices.
+    new_ids = array('l')
+    new_values = array('l') if values is not None else None
+    start = 0
+    for id, value in changes:
+        index = bisect_left(ids, id, start)
+        new_ids.extend(ids[start:index])
+        if values is not None:
+            new_values.extend(values[start:index])
+        start = index + 1 if index < len(ids) and ids[index] == id else index
+        if value is not None:
+            new_ids.append(id)
+            if values is not None:
+                new_values.append(value)
+    new_ids.extend(ids[start:])
+    if values is not None:
+        new_values.extend(values[start:])
+    return new_ids, new_values
+
+
+def _value(stored):
+    return None if stored == NO_VALUE else stored
+
+
+catalog = Catalog()
+on_changes(catalog.invalidate)
+
+
+def create_catalog(app):
+    # The catalog when QUESTION_CATALOG is set, None otherwise
+    if not app.config.get('QUESTION_CATALOG', False):
+        return None
+    catalog.load_search_index = \
+        app.config.get('SEARCH_BACKEND', 'memory') == 'memory'
+    # Loaded before the first request, so the quiz pool and search index
+    # are filled from it instead of the database
+    app.before_first_request(catalog.snapshot)
+    interval = app.config.get('CATALOG_RELOAD_INTERVAL', 0)
+    if interval:
+        catalog.start_reloading(app, interval)
+    return catalog
@@ -0,0 +1,318 @@
+import json
+import select
+import threading
+import time
+import uuid
+
+from sqlalchemy import func, or_, text
+
+from models import db, ChangeLog, Change, notify_changes, on_changes
+
+'''
+Change bus
+    Sends the changes of the models (see on_change in models.py) to the
+    other worker processes and nodes, which apply them to their caches,
+    quiz pool, search index, catalog and ETag versions as if they had made
+    them.
+
+    On PostgreSQL a change is sent with NOTIFY on the trivia_changes channel
+    and every worker LISTENs on a connection of its own. On other databases
+    the changes are added to the change_log table, which every worker polls
+    each CHANGE_POLL_INTERVAL seconds. A worker that may have missed changes
+    (its connection was lost, or the rows were pruned) reloads everything.
+    The changes of a batch (insert_many, delete_many) are sent in one
+    transaction, and the changes received together are applied as one batch
+    (see on_changes).
+
+    The ids of the change_log are not committed in order: an id skipped by
+    a poll is looked for again during LATE_COMMIT_WINDOW seconds, then it
+    is taken as rolled back.
+'''
+
+CHANNEL = 'trivia_changes'
+# Seconds before a lost LISTEN connection is opened again
+RECONNECT_DELAY = 5
+# The polling bus prunes the change_log every PRUNE_EVERY polls
+PRUNE_EVERY = 60
+LATE_COMMIT_WINDOW = 30
+# Most skipped ids looked for again
+MAX_MISSING = 10000
+
+# Set while a change of another process is applied, so that no bus of this
+# process sends it again
+_applying = threading.local()
+
+
+def encode(origin, change):
+    return json.dumps([origin] + list(change), separators=(',', ':'))
+
+
+def decode(payload):
+    values = json.loads(payload)
+    return values[0], Change(*values[1:])
+
+
+class ChangeBus:
+
+    name = None
+
+    def __init__(self, app=None):
+        self.app = app
+        self.origin = uuid.uuid4().hex
+        self.published = 0
+        self.received = 0
+        self.reloads = 0
+        self.errors = 0
+        self._thread = None
+
+    def publish(self, changes):
+        # on_changes listener: sends the changes made by this process, a
+        # failure is logged, the changes themselves are already committed
+        if self.app is None or not changes or \
+                getattr(_applying, 'active', False):
+            return
+        try:
+            self._publish(changes)
+            self.published += len(changes)
+        except Exception:
+            self.errors += 1
+            self.app.logger.exception('Changes not published: %s', changes)
+
+    def receive(self, origin, change):
+        # Applies a change of another process, returns True if it was one
+        return self.receive_many([(origin, change)]) == 1
+
+    def receive_many(self, changes):
+        # Applies the changes of other processes among the (origin, change)
+        # pairs together, so the listeners of on_changes get them in one
+        # batch. Returns how many.
+        changes = [change for origin, change in changes
+                   if origin != self.origin]
+        if not changes:
+            return 0
+        _applying.active = True
+        try:
+            notify_changes(changes)
+        finally:
+            _applying.active = False
+        self.received += len(changes)
+        return len(changes)
+
+    def reload_all(self):
+        # Some changes may have been missed
+        self.reloads += 1
+        self.receive(None, Change('categories', 'reload', None, None, None))
+        self.receive(None, Change('questions', 'reload', None, None, None))
+
+    def start(self):
+        if self._thread is not None:
+            return self._thread
+        self._thread = threading.Thread(
+            target=self._run, name='change-bus', daemon=True)
+        self._thread.start()
+        return self._thread
+
+    def stats(self):
+        return {
+            'kind': self.name,
+            'published': self.published,
+            'received': self.received,
+            'reloads': self.reloads,
+            'errors': self.errors
+        }
+
+
+class NotifyBus(ChangeBus):
+    # PostgreSQL LISTEN/NOTIFY
+
+    name = 'notify'
+
+    def __init__(self, app=None, timeout=5):
+        ChangeBus.__init__(self, app)
+        self.timeout = timeout
+
+    def _publish(self, changes):
+        # Sent when the transaction commits
+        with db.engine.begin() as connection:
+            connection.execute(text('SELECT pg_notify(:channel, :payload)'), [
+                {'channel': CHANNEL, 'payload': encode(self.origin, change)}
+                for change in changes])
+
+    def _listen(self):
+        # A connection out of the pool, kept open by the listening thread
+        connection = db.engine.raw_connection()
+        connection.detach()
+        connection = connection.connection
+        connection.autocommit = True
+        connection.cursor().execute('LISTEN {}'.format(CHANNEL))
+        return connection
+
+    def _run(self):
+        listened = False
+        while True:
+            try:
+                with self.app.app_context():
+                    connection = self._listen()
+                    if listened:
+                        self.reload_all()
+                    listened = True
+                    try:
+                        self._receive_forever(connection)
+                    finally:
+                        connection.close()
+            except Exception:
+                self.errors += 1
+                self.app.logger.exception('Change bus connection lost')
+                time.sleep(RECONNECT_DELAY)
+
+    def _receive_forever(self, connection):
+        while True:
+            if select.select([connection], [], [], self.timeout) == \
+                    ([], [], []):
+                continue
+            connection.poll()
+            payloads = [notification.payload
+                        for notification in connection.notifies]
+            del connection.notifies[:]
+            try:
+                self.receive_many(decode(payload) for payload in payloads)
+            except Exception:
+                self.errors += 1
+                self.app.logger.exception('Changes not applied: %s',
+                                          payloads)
+            finally:
+                db.session.remove()
+
+
+class PollingBus(ChangeBus):
+    # change_log table, for SQLite and local runs
+
+    name = 'polling'
+
+    def __init__(self, app=None, interval=1.0, retention=3600):
+        ChangeBus.__init__(self, app)
+        self.interval = interval
+        self.retention = retention
+        # Last change_log id seen, None until the first poll
+        self.last_id = None
+        # Skipped ids below last_id -> when they were first skipped
+        self.missing = {}
+        self._polls = 0
+
+    def _publish(self, changes):
+        created_at = time.time()
+        with db.engine.begin() as connection:
+            connection.execute(ChangeLog.__table__.insert(), [{
+                'origin': self.origin, 'table_name': change.table,
+                'action': change.action, 'row_id': change.id,
+                'category': change.category,
+                'difficulty': change.difficulty, 'created_at': created_at
+            } for change in changes])
+
+    def poll(self):
+        # Applies the changes of the other processes logged since the last
+        # poll, and the ones skipped before that were committed since,
+        # returns how many. The first poll only takes the last id.
+        table = ChangeLog.__table__
+        with db.engine.connect() as connection:
+            if self.last_id is None:
+                self.last_id = connection.execute(
+                    func.max(table.c.id).select()).scalar() or 0
+                return 0
+            condition = table.c.id > self.last_id
+            if self.missing:
+                condition = or_(condition,
+                                table.c.id.in_(sorted(self.missing)))
+            rows = connection.execute(
+                table.select().where(condition).order_by(
+                    table.c.id)).fetchall()
+            first_id = None
+            new = [row.id for row in rows if row.id > self.last_id]
+            if new and new[0] > self.last_id + 1 and self.last_id:
+                first_id = connection.execute(
+                    func.min(table.c.id).select()).scalar()
+            self._polls += 1
+            if self._polls % PRUNE_EVERY == 0:
+                self.prune(connection)
+
+        now = time.time()
+        # The skipped ids are looked for until then
+        skipped = first_id is None or first_id <= self.last_id + 1
+        if not skipped:
+            # Pruned before this worker saw them
+            self.reload_all()
+        changes = []
+        for row in rows:
+            if row.id > self.last_id:
+                if skipped:
+                    for id in range(max(self.last_id + 1,
+                                        row.id - MAX_MISSING), row.id):
+                        self.missing[id] = now
+                skipped = True
+                self.last_id = row.id
+            else:
+                # Committed after a higher id
+                self.missing.pop(row.id, None)
+            changes.append((row.origin, Change(
+                row.table_name, row.action, row.row_id, row.category,
+                row.difficulty)))
+        self.missing = {id: skipped_at
+                        for id, skipped_at in self.missing.items()
+                        if now - skipped_at < LATE_COMMIT_WINDOW}
+        return self.receive_many(changes)
+
+    def prune(self, connection):
+        # The last row is kept so its id is never used again
+        table = ChangeLog.__table__
+        last = connection.execute(func.max(table.c.id).select()).scalar()
+        connection.execute(table.delete().where(
+            (table.c.created_at < time.time() - self.retention) &
+            (table.c.id < last)))
+
+    def _run(self):
+        while True:
+            with self.app.app_context():
+                try:
+                    self.poll()
+                except Exception:
+                    self.errors += 1
+                    self.app.logger.exception('Change bus poll failed')
+                finally:
+                    db.session.remove()
+            time.sleep(self.interval)
+
+
+bus = None
+
+
+def create_change_bus(app):
+    # CHANGE_BUS: 'auto' (default: notify on PostgreSQL, polling on other
+    # databases, off for an in-memory SQLite database), 'notify',
+    # 'polling' or 'off'. One bus runs per process. It publishes as soon as
+    # it is created, and starts receiving with the first request: the CLI
+    # commands (db-upgrade, dedupe-scan, benchmark.py --seed...) run before
+    # the tables exist or exit without serving, they don't start it.
+    global bus
+    kind = app.config.get('CHANGE_BUS', 'auto')
+    if kind == 'auto':
+        uri = app.config['SQLALCHEMY_DATABASE_URI']
+        if uri.startswith('postgres'):
+            kind = 'notify'
+        elif uri in ('sqlite://', 'sqlite:///:memory:'):
+            kind = 'off'
+        else:
+            kind = 'polling'
+    if kind == 'off':
+        return None
+    if bus is None:
+        if kind == 'notify':
+            bus = NotifyBus(app)
+        elif kind == 'polling':
+            bus = PollingBus(
+                app, interval=app.config.get('CHANGE_POLL_INTERVAL', 1.0),
+                retention=app.config.get('CHANGE_LOG_RETENTION', 3600))
+        else:
+            raise ValueError('Unknown CHANGE_BUS: {}'.format(kind))
+        on_changes(bus.publish)
+    app.before_first_request(bus.start)
+    return bus
@@ -0,0 +1,107 @@
+import zlib
+
+from flask import request, Response
+
+from cache import compressed_bodies
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+'''
+Response compression
+    JSON and text responses of at least COMPRESS_MIN_SIZE bytes are sent
+    with the Content-Encoding the client prefers in its Accept-Encoding: br
+    (when the brotli package is installed) or gzip.
+
+    A response with an ETag (the listings, see http_cache.py) has the same
+    body until its data changes, so its compressed bytes are kept in the
+    compressed_bodies cache keyed by the url, the ETag and the encoding:
+    each version of a page is compressed once per worker, and later requests
+    for it are answered from the cache without running the view.
+'''
+
+COMPRESSIBLE = ('application/json', 'text/plain', 'text/csv',
+                'application/x-ndjson')
+
+
+def gzip_compress(data, level):
+    # gzip format with no timestamp, the same bytes every time
+    compressor = zlib.compressobj(level, zlib.DEFLATED, 31)
+    return compressor.compress(data) + compressor.flush()
+
+
+def brotli_compress(data, quality):
+    return brotli.compress(data, quality=quality)
+
+
+class Compressor:
+
+    def __init__(self, min_size=500, level=6, brotli_quality=4):
+        self.min_size = min_size
+        self.encoders = {'gzip': lambda data: gzip_compress(data, level)}
+        if brotli is not None:
+            self.encoders['br'] = \
+                lambda data: brotli_compress(data, brotli_quality)
+
+    def encoding(self, response):
+        # The encoding to send response with, None to send it as it is
+        if response.direct_passthrough or response.is_streamed or \
+                response.status_code != 200 or \
+                'Content-Encoding' in response.headers or \
+                response.mimetype not in COMPRESSIBLE:
+            return None
+        if response.content_length is not None and \
+                response.content_length < self.min_size:
+            return None
+        return self.accepted()
+
+    def accepted(self):
+        # Prefer brotli when the client accepts both equally
+        return request.accept_encodings.best_match(
+            [name for name in ('br', 'gzip') if name in self.encoders])
+
+    def cached_response(self, etag):
+        # The compressed response of the url at etag, None when it is not
+        # cached
+        encoding = self.accepted()
+        if encoding is None:
+            return None
+        entry = compressed_bodies.get((request.full_path, etag, encoding))
+        if entry is None:
+            return None
+        mimetype, data = entry
+        response = Response(data, mimetype=mimetype)
+        response.headers['Content-Encoding'] = encoding
+        return response
+
+    def compress(self, response):
+        response.vary.add('Accept-Encoding')
+        encoding = self.encoding(response)
+        if encoding is None:
+            return response
+
+        etag, weak = response.get_etag()
+        key = (request.full_path, etag, encoding)
+        data = self.encoders[encoding](response.get_data())
+        if etag and request.method == 'GET':
+            compressed_bodies.set(key, (response.mimetype, data))
+
+        response.set_data(data)
+        response.headers['Content-Encoding'] = encoding
+        return response
+
+
+def init_compression(app):
+    # COMPRESS_ENABLED (off behind a proxy that compresses),
+    # COMPRESS_MIN_SIZE in bytes, COMPRESS_LEVEL (gzip, 1-9) and
+    # COMPRESS_BROTLI_QUALITY (0-11)
+    if not app.config.get('COMPRESS_ENABLED', True):
+        return None
+    compressor = Compressor(
+        min_size=app.config.get('COMPRESS_MIN_SIZE', 500),
+        level=app.config.get('COMPRESS_LEVEL', 6),
+        brotli_quality=app.config.get('COMPRESS_BROTLI_QUALITY', 4))
+    app.after_request(compressor.compress)
+    return compressor
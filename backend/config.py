@@ -0,0 +1,175 @@
+from sqlalchemy.pool import StaticPool
+# environment variables using python-decouple (.env) file :
+from decouple import config as env, Csv
+
+'''
+Configurations
+    create_app() loads the one named by TRIVIA_CONFIG ('development' by
+    default), then the test_config it was given. Every setting can be
+    overridden from the environment or the .env file.
+'''
+
+
+def postgres_path(name):
+    return 'postgres://{}:{}@{}:{}/{}'.format(
+        env('USERDB', default='postgres'),
+        env('USERDBPASSWORD', default='postgres'),
+        env('DB_HOST', default='localhost'),
+        env('DB_PORT', default='5433'),
+        name)
+
+
+class Config:
+    SQLALCHEMY_DATABASE_URI = env('DATABASE_URL',
+                                  default=postgres_path('trivia'))
+    SQLALCHEMY_TRACK_MODIFICATIONS = False
+
+    # Connection pool of each worker process: a deployment opens up to
+    # workers * (DB_POOL_SIZE + DB_MAX_OVERFLOW) connections
+    DB_POOL_SIZE = env('DB_POOL_SIZE', default=5, cast=int)
+    DB_MAX_OVERFLOW = env('DB_MAX_OVERFLOW', default=10, cast=int)
+    DB_POOL_TIMEOUT = env('DB_POOL_TIMEOUT', default=30, cast=int)
+    DB_POOL_RECYCLE = env('DB_POOL_RECYCLE', default=1800, cast=int)
+    DB_POOL_PRE_PING = env('DB_POOL_PRE_PING', default=True, cast=bool)
+    # In milliseconds, 0 means no timeout (PostgreSQL only)
+    DB_STATEMENT_TIMEOUT = env('DB_STATEMENT_TIMEOUT', default=0, cast=int)
+    # Read replicas (comma separated urls) of the read-only routes, see
+    # replicas.py. A failing replica is left out for DB_REPLICA_RETRY
+    # seconds, DB_REPLICA_MAX_LAG (PostgreSQL, 0: not checked) is checked
+    # every DB_REPLICA_CHECK_INTERVAL seconds and a client that wrote reads
+    # from the primary for DB_STICKY_SECONDS
+    DB_REPLICA_URLS = env('DB_REPLICA_URLS', default='', cast=Csv())
+    DB_REPLICA_RETRY = env('DB_REPLICA_RETRY', default=30, cast=int)
+    DB_REPLICA_CHECK_INTERVAL = env('DB_REPLICA_CHECK_INTERVAL', default=10,
+                                    cast=int)
+    DB_REPLICA_MAX_LAG = env('DB_REPLICA_MAX_LAG', default=0, cast=float)
+    DB_STICKY_SECONDS = env('DB_STICKY_SECONDS', default=5, cast=int)
+    # Apply the pending migrations when the app is created
+    DB_AUTO_MIGRATE = env('DB_AUTO_MIGRATE', default=False, cast=bool)
+
+    QUIZ_SESSION_STORE = env('QUIZ_SESSION_STORE', default='memory')
+    REDIS_URL = env('REDIS_URL', default='redis://localhost:6379/0')
+    SEARCH_BACKEND = env('SEARCH_BACKEND', default='memory')
+    CACHE_TTL = env('CACHE_TTL', default=300, cast=int)
+    # Serve the reads from an in-memory copy of the questions (catalog.py),
+    # kept up to date by the change bus and also reloaded every
+    # CATALOG_RELOAD_INTERVAL seconds (0: never, for CHANGE_BUS=off)
+    QUESTION_CATALOG = env('QUESTION_CATALOG', default=False, cast=bool)
+    CATALOG_RELOAD_INTERVAL = env('CATALOG_RELOAD_INTERVAL', default=0,
+                                  cast=int)
+    # Token buckets of each client (X-API-Key or IP) on the expensive
+    # routes, {rule: (requests per second, burst)}. RATE_LIMIT_BACKEND:
+    # 'memory' (per worker) or 'redis' (REDIS_URL, shared by the workers).
+    # Only the keys of API_KEYS (comma separated) identify a client, the
+    # others are ignored.
+    API_KEYS = env('API_KEYS', default='', cast=Csv())
+    # Proxies (nginx, the CDN) in front of the app: the IP address of a
+    # client is taken from the X-Forwarded-For they add, which is ignored
+    # with 0, as anyone can send it
+    TRUSTED_PROXIES = env('TRUSTED_PROXIES', default=0, cast=int)
+    RATE_LIMIT_ENABLED = env('RATE_LIMIT_ENABLED', default=True, cast=bool)
+    RATE_LIMIT_BACKEND = env('RATE_LIMIT_BACKEND', default='memory')
+    RATE_LIMITS = {
+        'search': (env('RATE_LIMIT_SEARCH', default=5.0, cast=float),
+                   env('RATE_LIMIT_SEARCH_BURST', default=20, cast=int)),
+        'quizzes': (env('RATE_LIMIT_QUIZZES', default=10.0, cast=float),
+                    env('RATE_LIMIT_QUIZZES_BURST', default=30, cast=int)),
+        'answers': (env('RATE_LIMIT_ANSWERS', default=20.0, cast=float),
+                    env('RATE_LIMIT_ANSWERS_BURST', default=60, cast=int))
+    }
+    # Searches, quizzes and answers running at once in a worker (0: the
+    # size of the connection pool), the ones waiting more than
+    # ADMISSION_TIMEOUT milliseconds for a slot get a 503
+    ADMISSION_LIMIT = env('ADMISSION_LIMIT', default=0, cast=int)
+    ADMISSION_TIMEOUT = env('ADMISSION_TIMEOUT', default=100, cast=int)
+    # POST /questions refuses the questions already in the table (same text
+    # once normalized) and imports skip them, questions with a similarity of
+    # DEDUPE_THRESHOLD or more are reported as near duplicates
+    DEDUPE_ENABLED = env('DEDUPE_ENABLED', default=True, cast=bool)
+    DEDUPE_THRESHOLD = env('DEDUPE_THRESHOLD', default=0.7, cast=float)
+    # Sends the changes to the other workers so they drop their cached
+    # copies: 'auto' (NOTIFY on PostgreSQL, the change_log table polled
+    # every CHANGE_POLL_INTERVAL seconds otherwise), 'notify', 'polling' or
+    # 'off'. The change_log keeps CHANGE_LOG_RETENTION seconds of changes.
+    CHANGE_BUS = env('CHANGE_BUS', default='auto')
+    CHANGE_POLL_INTERVAL = env('CHANGE_POLL_INTERVAL', default=1.0,
+                               cast=float)
+    CHANGE_LOG_RETENTION = env('CHANGE_LOG_RETENTION', default=3600,
+                               cast=int)
+    # Answers buffered in memory are written every LEADERBOARD_FLUSH_INTERVAL
+    # seconds, or once LEADERBOARD_FLUSH_SIZE answers are waiting, and the
+    # leaderboard is reloaded every LEADERBOARD_RELOAD_INTERVAL seconds with
+    # the scores of the other workers (0: never)
+    LEADERBOARD_FLUSH_INTERVAL = env('LEADERBOARD_FLUSH_INTERVAL', default=2,
+                                     cast=float)
+    LEADERBOARD_FLUSH_SIZE = env('LEADERBOARD_FLUSH_SIZE', default=5000,
+                                 cast=int)
+    LEADERBOARD_RELOAD_INTERVAL = env('LEADERBOARD_RELOAD_INTERVAL',
+                                      default=30, cast=int)
+    # Cache-Control max-age of the listings in seconds, with 0 clients and
+    # CDNs revalidate them with their ETag every time
+    CATEGORIES_MAX_AGE = env('CATEGORIES_MAX_AGE', default=300, cast=int)
+    QUESTIONS_MAX_AGE = env('QUESTIONS_MAX_AGE', default=0, cast=int)
+    # gzip (or brotli, when installed) responses of at least
+    # COMPRESS_MIN_SIZE bytes, turn it off behind a proxy that compresses
+    COMPRESS_ENABLED = env('COMPRESS_ENABLED', default=True, cast=bool)
+    COMPRESS_MIN_SIZE = env('COMPRESS_MIN_SIZE', default=500, cast=int)
+    COMPRESS_LEVEL = env('COMPRESS_LEVEL', default=6, cast=int)
+    COMPRESS_BROTLI_QUALITY = env('COMPRESS_BROTLI_QUALITY', default=4,
+                                  cast=int)
+    # Encoder of the question listings: 'auto' (orjson when installed),
+    # 'orjson' or 'json'
+    JSON_SERIALIZER = env('JSON_SERIALIZER', default='auto')
+    # Send the db/json/total timings of each request in Server-Timing
+    SERVER_TIMING = env('SERVER_TIMING', default=True, cast=bool)
+    # Seconds between reloads of the quiz pool and search index of the
+    # ASGI app (asgi.py), 0 to load them only at startup
+    ASYNC_RELOAD_INTERVAL = env('ASYNC_RELOAD_INTERVAL', default=60, cast=int)
+
+
+class TestingConfig(Config):
+    TESTING = True
+    SQLALCHEMY_DATABASE_URI = env('TEST_DATABASE_URL',
+                                  default=postgres_path('trivia_test'))
+
+
+class SQLiteConfig(Config):
+    # In-memory database for local runs, the schema is created at startup
+    SQLALCHEMY_DATABASE_URI = 'sqlite://'
+    DB_AUTO_MIGRATE = True
+
+
+configs = {
+    'development': Config,
+    'testing': TestingConfig,
+    'sqlite': SQLiteConfig
+}
+
+
+def get_config(name=None):
+    return configs[name or env('TRIVIA_CONFIG', default='development')]
+
+
+def engine_options(config):
+    # SQLALCHEMY_ENGINE_OPTIONS from the DB_* settings
+    uri = config['SQLALCHEMY_DATABASE_URI']
+    if uri.startswith('sqlite'):
+        if uri in ('sqlite://', 'sqlite:///:memory:'):
+            # A single connection shared by every thread, otherwise each
+            # connection would see its own empty database
+            return {'poolclass': StaticPool,
+                    'connect_args': {'check_same_thread': False}}
+        return {'connect_args': {'check_same_thread': False}}
+
+    options = {
+        'pool_size': config.get('DB_POOL_SIZE', 5),
+        'max_overflow': config.get('DB_MAX_OVERFLOW', 10),
+        'pool_timeout': config.get('DB_POOL_TIMEOUT', 30),
+        'pool_recycle': config.get('DB_POOL_RECYCLE', 1800),
+        'pool_pre_ping': config.get('DB_POOL_PRE_PING', True)
+    }
+    timeout = config.get('DB_STATEMENT_TIMEOUT', 0)
+    if timeout and uri.startswith('postgres'):
+        options['connect_args'] = {
+            'options': '-c statement_timeout={}'.format(timeout)}
+    return options
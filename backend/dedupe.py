@@ -0,0 +1,169 @@
+from collections import Counter
+from itertools import groupby
+
+from sqlalchemy import and_, exists, func
+
+from models import db, Question, QuestionHash
+from fingerprints import (EXACT, fingerprints, exact_hash, normalize_text,
+                          similarity)
+
+'''
+Duplicate questions
+    The fingerprints of every question are kept in the question_hashes
+    table (written with the question, see QuestionHash), so the questions
+    similar to a new one are found with an indexed lookup of its
+    fingerprints, then only those candidates are compared with it.
+
+    POST /questions refuses the exact duplicates (same text once
+    normalized), imports skip them, and `flask dedupe-scan` lists the exact
+    and near duplicates already in the table.
+'''
+
+# Jaccard similarity of the shingles above which questions are near
+# duplicates
+DEFAULT_THRESHOLD = 0.7
+# Most near duplicate candidates (sharing a band other than the exact one)
+# compared with a question, the exact duplicates are always compared
+MAX_CANDIDATES = 200
+# Buckets with more questions are skipped by the scan (very short or
+# boilerplate texts), their pairs would be quadratic
+MAX_BUCKET = 100
+INDEX_BATCH_SIZE = 1000
+# Ids per IN (...) clause
+CHUNK_SIZE = 500
+
+
+def find_duplicates(text, threshold=DEFAULT_THRESHOLD):
+    # Questions with the same normalized text or a similarity of at least
+    # threshold, most similar first: [{id, question, similarity, exact}]
+    prints = fingerprints(text)
+    exact_ids = set(id for id, in db.session.query(
+        QuestionHash.question_id).filter(
+        QuestionHash.band == EXACT, QuestionHash.hash == prints[0][1]))
+    # The questions sharing the most bands first
+    bands = set(prints[1:])
+    shared = Counter()
+    if bands:
+        shared.update(id for id, band, hash in db.session.query(
+            QuestionHash.question_id, QuestionHash.band,
+            QuestionHash.hash).filter(
+            QuestionHash.hash.in_([hash for band, hash in bands])).limit(
+            MAX_CANDIDATES * len(bands))
+            if (band, hash) in bands and id not in exact_ids)
+    candidates = sorted(exact_ids) + [
+        id for id, count in shared.most_common(MAX_CANDIDATES)]
+    if not candidates:
+        return []
+
+    normalized = normalize_text(text)
+    duplicates = []
+    for start in range(0, len(candidates), CHUNK_SIZE):
+        for id, question in db.session.query(
+                Question.id, Question.question).filter(
+                Question.id.in_(candidates[start:start + CHUNK_SIZE])):
+            other = normalize_text(question)
+            exact = other == normalized
+            score = 1.0 if exact else similarity(normalized, other)
+            if exact or score >= threshold:
+                duplicates.append({'id': id, 'question': question,
+                                   'similarity': round(score, 3),
+                                   'exact': exact})
+    duplicates.sort(key=lambda duplicate: (-duplicate['similarity'],
+                                           duplicate['id']))
+    return duplicates
+
+
+class ImportFilter:
+    # Drops the rows of an import batch whose question is already in the
+    # table, or earlier in the batch (same normalized text). The earlier
+    # batches are in the table: they are fingerprinted once inserted (see
+    # bulk.py), so only the hashes of one batch are held in memory.
+
+    def __init__(self):
+        self.skipped = 0
+
+    def filter(self, batch):
+        hashes = [exact_hash(row['question']) for row in batch]
+        seen = set()
+        unique = sorted(set(hashes))
+        for start in range(0, len(unique), CHUNK_SIZE):
+            seen.update(hash for hash, in db.session.query(
+                QuestionHash.hash).filter(
+                QuestionHash.band == EXACT,
+                QuestionHash.hash.in_(unique[start:start + CHUNK_SIZE])))
+        kept = []
+        for row, hash in zip(batch, hashes):
+            if hash in seen:
+                self.skipped += 1
+                continue
+            seen.add(hash)
+            kept.append(row)
+        return kept
+
+
+def index_missing(after_id=None, batch_size=INDEX_BATCH_SIZE):
+    # Adds the fingerprints of the questions that have none (the ones
+    # written by an import, or before the index existed). Returns how many.
+    indexed = exists().where(and_(QuestionHash.question_id == Question.id,
+                                  QuestionHash.band == EXACT))
+    last_id = after_id or 0
+    count = 0
+    while True:
+        batch = db.session.query(Question.id, Question.question).filter(
+            Question.id > last_id, ~indexed).order_by(Question.id).limit(
+            batch_size).all()
+        if not batch:
+            return count
+        db.session.execute(QuestionHash.__table__.insert(), [
+            row for id, text in batch for row in QuestionHash.rows(id, text)])
+        db.session.commit()
+        count += len(batch)
+        last_id = batch[-1][0]
+
+
+def rebuild_index(batch_size=INDEX_BATCH_SIZE):
+    # Computes the fingerprints of every question again
+    QuestionHash.query.delete(synchronize_session=False)
+    db.session.commit()
+    return index_missing(batch_size=batch_size)
+
+
+def scan(threshold=DEFAULT_THRESHOLD):
+    # Yields (id, duplicate id, similarity, exact) for the pairs of
+    # questions that share a fingerprint and are duplicates, the duplicate
+    # id is the newest one of the pair
+    shared = db.session.query(QuestionHash.band, QuestionHash.hash).group_by(
+        QuestionHash.band, QuestionHash.hash).having(
+        func.count() > 1).subquery()
+    rows = db.session.query(
+        QuestionHash.band, QuestionHash.hash,
+        QuestionHash.question_id).join(shared, and_(
+            QuestionHash.band == shared.c.band,
+            QuestionHash.hash == shared.c.hash)).order_by(
+        QuestionHash.band, QuestionHash.hash, QuestionHash.question_id).all()
+
+    pairs = set()
+    for (band, _), bucket in groupby(rows, key=lambda row: (row[0], row[1])):
+        ids = [row[2] for row in bucket]
+        if band == EXACT:
+            # Each copy is paired with the oldest one only
+            pairs.update((ids[0], id) for id in ids[1:])
+        elif len(ids) <= MAX_BUCKET:
+            pairs.update((first, second) for index, first in enumerate(ids)
+                         for second in ids[index + 1:])
+
+    texts = {}
+    ids = sorted(set(id for pair in pairs for id in pair))
+    for start in range(0, len(ids), CHUNK_SIZE):
+        texts.update((id, normalize_text(question))
+                     for id, question in db.session.query(
+                         Question.id, Question.question).filter(
+                         Question.id.in_(ids[start:start + CHUNK_SIZE])))
+
+    for first, second in sorted(pairs):
+        if first not in texts or second not in texts:
+            continue
+        exact = texts[first] == texts[second]
+        score = 1.0 if exact else similarity(texts[first], texts[second])
+        if exact or score >= threshold:
+            yield first, second, score, exact
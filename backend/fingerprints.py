@@ -0,0 +1,81 @@
+import hashlib
+import random
+import struct
+import unicodedata
+
+'''
+Question fingerprints
+    Hashes of the normalized text of a question for the duplicate index
+    (dedupe.py): band 0 holds the hash of the whole text, bands 1 to
+    NUM_BANDS the locality sensitive hashes of its MinHash signature. Two
+    texts share the band 0 hash when they are the same once normalized, and
+    at least one other band with a probability that grows quickly with the
+    Jaccard similarity of their character shingles:
+    1 - (1 - J ** BAND_ROWS) ** NUM_BANDS, 0.99 at J = 0.7, 0.12 at J = 0.3.
+'''
+
+EXACT = 0
+NUM_BANDS = 16
+BAND_ROWS = 4
+SHINGLE_SIZE = 4
+
+_PRIME = (1 << 61) - 1
+# The same permutations in every process, the hashes are stored
+_random = random.Random(20201)
+PERMUTATIONS = [(_random.randrange(1, _PRIME), _random.randrange(_PRIME))
+                for _ in range(NUM_BANDS * BAND_ROWS)]
+_BAND_FORMAT = '!B{}Q'.format(BAND_ROWS)
+
+
+def normalize_text(text):
+    # Case, accents, punctuation and spacing are ignored
+    text = unicodedata.normalize('NFKD', text or '')
+    text = ''.join(char if char.isalnum() else ' '
+                   for char in text.casefold()
+                   if not unicodedata.combining(char))
+    return ' '.join(text.split())
+
+
+def shingles(normalized):
+    # The SHINGLE_SIZE characters long substrings of a normalized text
+    if len(normalized) <= SHINGLE_SIZE:
+        return {normalized}
+    return {normalized[index:index + SHINGLE_SIZE]
+            for index in range(len(normalized) - SHINGLE_SIZE + 1)}
+
+
+def similarity(first, second):
+    # Jaccard similarity of the shingles of two normalized texts
+    first, second = shingles(first), shingles(second)
+    return len(first & second) / len(first | second)
+
+
+def _digest(data, signed=True):
+    return int.from_bytes(hashlib.blake2b(data, digest_size=8).digest(),
+                          'big', signed=signed)
+
+
+def minhash(normalized):
+    hashes = [_digest(shingle.encode('utf-8'), signed=False) % _PRIME
+              for shingle in shingles(normalized)]
+    return [min((a * value + b) % _PRIME for value in hashes)
+            for a, b in PERMUTATIONS]
+
+
+def exact_hash(text):
+    # The band 0 hash, without the MinHash signature
+    return _digest(normalize_text(text).encode('utf-8'))
+
+
+def fingerprints(text):
+    # [(band, hash)] of a question text, hashes are signed 64 bits integers
+    normalized = normalize_text(text)
+    result = [(EXACT, _digest(normalized.encode('utf-8')))]
+    if not normalized:
+        return result
+    signature = minhash(normalized)
+    for band in range(NUM_BANDS):
+        rows = signature[band * BAND_ROWS:(band + 1) * BAND_ROWS]
+        result.append((band + 1, _digest(struct.pack(_BAND_FORMAT, band,
+                                                      *rows))))
+    return result
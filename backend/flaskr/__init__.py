@@ -1,24 +1,266 @@
 import os
-from flask import Flask, request, abort, jsonify
+import codecs
+from functools import wraps
+import click
+from flask import (Flask, request, abort, jsonify, Response,
+                   stream_with_context, make_response, g)
 from flask_sqlalchemy import SQLAlchemy
 from flask_cors import CORS
-import random
-
-from models import setup_db, Question, Category
-from helpers import paginate, hasNextPage
+from werkzeug.middleware.proxy_fix import ProxyFix
+from sqlalchemy.exc import DBAPIError
+
+from models import setup_db, db, Question
+from helpers import paginate, paginate_ids, hasNextPage
+from totals import totals
+from selection import pool, requested_difficulty
+from sessions import QuizSession, create_store
+from search import create_search
+from bulk import (FORMATS, IMPORT_BATCH_SIZE, guess_format, read_rows,
+                  import_questions, export_questions)
+from cache import (caches, configure_caches, cached_categories,
+                   cached_category, cached_category_ids, cached_questions,
+                   cached_question_json)
+from streaming import StreamedQuestions, json_stream_response
+from metrics import metrics, init_metrics, CONTENT_TYPE as METRICS_CONTENT_TYPE
+from http_cache import versions, is_not_modified, cache_headers
+from catalog import create_catalog
+from ratelimit import create_limiter, create_gate, client_key
+from serializer import create_serializer, encode_listing
+from replicas import create_replicas, reading_from_replica, on_primary
+from compression import init_compression
+from change_bus import create_change_bus
+from dedupe import find_duplicates, index_missing, rebuild_index, scan
+from leaderboard import (create_leaderboard, is_correct, question_points,
+                         MAX_PLAYER_LENGTH)
+import migrations
+from config import get_config
 
 QUESTIONS_PER_PAGE = 10
+# Biggest ?per_page= allowed, unless the response is streamed (?stream=true)
+MAX_QUESTIONS_PER_PAGE = 100
+# Most questions a single POST /quizzes can draw with "count"
+MAX_QUIZ_BATCH = 50
+# Most players GET /leaderboard returns
+MAX_LEADERBOARD = 100
 
 
 def create_app(test_config=None):
     # create and configure the app
+    # test_config can be a dict of settings or a config class
     app = Flask(__name__)
+    app.config.from_object(get_config())
+    if isinstance(test_config, dict):
+        app.config.from_mapping(test_config)
+    elif test_config is not None:
+        app.config.from_object(test_config)
+    proxies = app.config.get('TRUSTED_PROXIES', 0)
+    if proxies:
+        # The address and scheme of the client, as sent by the proxies
+        app.wsgi_app = ProxyFix(app.wsgi_app, x_for=proxies,
+                                x_proto=proxies)
     setup_db(app)
+    if app.config.get('DB_AUTO_MIGRATE'):
+        migrations.upgrade(db.engine)
 
     '''
   @DONETODO: Set up CORS. Allow '*' for origins. Delete the sample route after completing the TODOs
   '''
     CORS(app, resources={r"/*": {"origins": "*"}})
+    init_metrics(app)
+
+    quiz_sessions = create_store(app)
+    question_search = create_search(app)
+    configure_caches(app)
+    catalog = create_catalog(app)
+    limiter = create_limiter(app)
+    admission = create_gate(app)
+    serializer = create_serializer(app)
+    dedupe = app.config.get('DEDUPE_ENABLED', True)
+    replicas = create_replicas(app)
+    compressor = init_compression(app)
+    leaderboard = create_leaderboard(app)
+    change_bus = create_change_bus(app)
+
+    # Reads go to the in-memory catalog with QUESTION_CATALOG, to the caches
+    # (and the database behind them) otherwise:
+    def load_questions(ids):
+        if catalog is not None:
+            return catalog.questions(ids)
+        return cached_questions(ids)
+
+    def all_categories():
+        if catalog is not None:
+            return catalog.categories()
+        return cached_categories()
+
+    def find_category(category_id):
+        if catalog is not None:
+            return catalog.category(category_id)
+        return cached_category(category_id)
+
+    def category_question_ids(category_id):
+        if catalog is not None:
+            return catalog.ids(category_id)
+        return cached_category_ids(category_id)
+
+    def count_questions(category=None):
+        if catalog is not None:
+            return catalog.count(category)
+        return totals.questions(category)
+
+    def questions_per_page():
+        per_page = request.args.get('per_page', QUESTIONS_PER_PAGE, type=int)
+        return max(1, min(per_page, MAX_QUESTIONS_PER_PAGE))
+
+    def page_of_question_ids(query=Question.query):
+        # Only the ids are paginated in SQL, the payloads come from the
+        # cache when possible
+        if catalog is not None:
+            return paginate_ids(
+                request, catalog.ids(), questions_per_page(), keyset=True)
+        rows, next_cursor = paginate(
+            request, query.with_entities(Question.id), Question.id,
+            questions_per_page())
+        return [row.id for row in rows], next_cursor
+
+    def page_of_questions(query=Question.query):
+        # Page of formatted questions
+        page_ids, next_cursor = page_of_question_ids(query)
+        return load_questions(page_ids), next_cursor
+
+    def encoded_questions(ids):
+        # JSON of the questions of ids, each one is encoded once and cached
+        return cached_question_json(ids, load_questions, serializer.dumps)
+
+    def listing_response(body, key, items):
+        # body with the encoded questions (items) as a list under key,
+        # instead of jsonify()
+        return Response(encode_listing(serializer, body, key, items),
+                        mimetype='application/json')
+
+    def stream_questions(query, key, envelope, category=None):
+        # ?stream=true: the questions are encoded while they are read from
+        # the database (or the catalog), without ?per_page= every question
+        # is sent
+        per_page = request.args.get('per_page', None, type=int)
+        if per_page is not None:
+            per_page = max(1, per_page)
+        envelope['items_per_page'] = per_page
+        if catalog is not None:
+            ids = catalog.ids(category)
+            try:
+                page_ids, next_cursor = paginate_ids(
+                    request, ids, per_page or max(len(ids), 1), keyset=True)
+            except ValueError:
+                abort(400)
+            return json_stream_response(
+                envelope, key, catalog.iter_questions(page_ids),
+                lambda: {'next_cursor': next_cursor})
+
+        try:
+            streamed = StreamedQuestions(request, query, per_page)
+        except ValueError:
+            abort(400)
+        return json_stream_response(
+            envelope, key, streamed,
+            lambda: {'next_cursor': streamed.next_cursor})
+
+    def conditional(etag, max_age_setting):
+        # Sends the ETag returned by etag(**view_args) with Cache-Control,
+        # and answers a matching If-None-Match with 304, or a page compressed
+        # before, without calling the view
+        def decorator(view):
+            @wraps(view)
+            def conditional_view(**kwargs):
+                tag = etag(**kwargs)
+                max_age = app.config.get(max_age_setting, 0)
+                if is_not_modified(request, tag):
+                    return cache_headers(Response(status=304), tag, max_age)
+                if compressor is not None:
+                    # Compressed when this version was last sent
+                    compressed = compressor.cached_response(tag)
+                    if compressed is not None:
+                        return cache_headers(compressed, tag, max_age)
+                return cache_headers(make_response(view(**kwargs)), tag,
+                                     max_age)
+            return conditional_view
+        return decorator
+
+    def protected(rule, when=None):
+        # Rate limit of the rule for the client (see client_key), then a
+        # slot of the admission gate for the expensive routes. when(), if
+        # given, tells if the request is one of them.
+        def decorator(view):
+            @wraps(view)
+            def protected_view(**kwargs):
+                if when is not None and not when():
+                    return view(**kwargs)
+                if limiter is not None:
+                    decision = limiter.check(rule, client_key())
+                    g.rate_limit = decision
+                    if decision is not None and not decision.allowed:
+                        abort(429)
+                if not admission.acquire():
+                    g.overloaded = True
+                    abort(503)
+                try:
+                    return view(**kwargs)
+                finally:
+                    admission.release()
+            return protected_view
+        return decorator
+
+    def read_only(when=None):
+        # The queries of the view may run on a read replica, unless its
+        # client has just written. A view whose replica fails is run again
+        # on the primary. when(), if given, tells if the request only reads.
+        def decorator(view):
+            @wraps(view)
+            def read_only_view(**kwargs):
+                if replicas is None or (when is not None and not when()) or \
+                        replicas.is_sticky():
+                    return view(**kwargs)
+                g.db_replicas = replicas
+                try:
+                    return view(**kwargs)
+                except DBAPIError:
+                    if not g.pop('db_replica_failed', False):
+                        raise
+                    db.session.rollback()
+                    g.db_replicas = None
+                    return view(**kwargs)
+            return read_only_view
+        return decorator
+
+    def mutation_response(body):
+        # Mutations only return the affected entity, unless the client asks
+        # for the current page too with ?return=page
+        body['total_questions'] = count_questions()
+        if request.args.get('return', None) == 'page':
+            body['questions'], body['next_cursor'] = page_of_questions()
+        return jsonify(body)
+
+    def draw_questions(category, previous, count=1, seen=None, band=None,
+                       level=None):
+        # Random quiz questions from the in-memory pool (see
+        # QuestionPool.draw_many), only the chosen ones are loaded with a
+        # single query (or taken from the cache). Returns the questions, the
+        # number of eligible ones and the level.
+        while True:
+            ids, remaining, level_drawn = pool.draw_many(
+                category, previous, count, seen, band, level)
+            questions = load_questions(ids)
+            if len(questions) < len(ids) and reading_from_replica():
+                # Maybe added since the replica was updated
+                with on_primary():
+                    questions = load_questions(ids)
+            if len(questions) == len(ids):
+                return questions, remaining, level_drawn
+            # Deleted since the pool was loaded:
+            found = set(question['id'] for question in questions)
+            for id in ids:
+                if id not in found:
+                    pool.remove(id)
 
     '''
   @DONETODO: Use the after_request decorator to set Access-Control-Allow
@@ -34,23 +276,52 @@ def create_app(test_config=None):
         response.headers.add('Access-Control-Allow-Credentials', 'true')
         return response
 
+    # Rate limit headers of the protected routes:
+    @app.after_request
+    def rate_limit_headers(response):
+        decision = g.get('rate_limit', None)
+        if decision is not None:
+            response.headers['X-RateLimit-Limit'] = str(decision.limit)
+            response.headers['X-RateLimit-Remaining'] = \
+                str(decision.remaining)
+            if not decision.allowed:
+                response.headers['Retry-After'] = str(decision.retry_after)
+        if g.get('overloaded', False):
+            response.headers['Retry-After'] = '1'
+        return response
+
     ''' 
 Index route
 @DOCUMENTED!
     '''
     # Added the / index endpoint for the api:
     @app.route("/")
+    @read_only()
     def index():
-        questions = Question.query.all()
-        categories = Category.query.all()
-
         return jsonify({
             'questions': request.url_root + 'questions',
             'categories': request.url_root + 'categories',
-            'total_questions': len(questions),
-            'total_categories': len(categories)
+            'total_questions': count_questions(),
+            'total_categories': len(all_categories())
+        })
+
+    # Hit/miss rates of the in-process caches:
+    @app.route("/cache", methods=['GET'])
+    def cache_stats():
+        return jsonify({
+            'success': True,
+            'caches': [cache.stats() for cache in caches.values()],
+            'catalog': catalog.stats() if catalog is not None else None,
+            'replicas': replicas.stats() if replicas is not None else None,
+            'change_bus': (change_bus.stats() if change_bus is not None
+                           else None)
         })
 
+    # Per endpoint request metrics, Prometheus text format:
+    @app.route("/metrics", methods=['GET'])
+    def metrics_endpoint():
+        return Response(metrics.render(), mimetype=METRICS_CONTENT_TYPE)
+
     '''
   @DONETODO:
   Create an endpoint to handle GET requests
@@ -58,13 +329,13 @@ Index route
   @DOCUMENTED!
   '''
     @app.route("/categories", methods=['GET'])
+    @conditional(lambda: versions.etag('categories'), 'CATEGORIES_MAX_AGE')
+    @read_only()
     def categories():
 
         try:
-            categories = Category.query.all()
-
             return jsonify({
-                'categories': [c.format() for c in categories],
+                'categories': all_categories(),
                 'success': True
             })
         except:
@@ -84,26 +355,39 @@ Index route
   @DOCUMENTED!
   '''
     @app.route("/questions", methods=['GET'])
+    @conditional(lambda: versions.etag('categories', 'questions'),
+                 'QUESTIONS_MAX_AGE')
+    @read_only()
     def questions():
-        all_questions = Question.query.order_by(Question.id).all()
-        current_questions = paginate(
-            request, all_questions, QUESTIONS_PER_PAGE)
-
-        categories = Category.query.order_by(Category.id).all()
+        if request.args.get('stream', '') == 'true':
+            return stream_questions(Question.query, 'list_of_questions', {
+                'success': True,
+                'total_questions': count_questions(),
+                'categories': all_categories()
+            })
 
-        restant_pages = len(all_questions) % QUESTIONS_PER_PAGE
+        try:
+            page_ids, next_cursor = page_of_question_ids()
+        except ValueError:
+            abort(400)
 
+        current_questions = encoded_questions(page_ids)
         if len(current_questions) == 0:
             abort(404)
 
-        return jsonify({
+        total_questions = count_questions()
+        per_page = questions_per_page()
+
+        restant_pages = total_questions % per_page
+
+        return listing_response({
             'success': True,
-            'list_of_questions': current_questions,
-            'total_questions': len(all_questions),
-            'categories': [category.format() for category in categories],
-            'items_per_page': QUESTIONS_PER_PAGE,
-            'next_page': hasNextPage(len(current_questions), request, restant_pages)
-        })
+            'total_questions': total_questions,
+            'categories': all_categories(),
+            'items_per_page': per_page,
+            'next_page': hasNextPage(len(current_questions), request, restant_pages),
+            'next_cursor': next_cursor
+        }, 'list_of_questions', current_questions)
 
     '''
   @DONETODO:
@@ -119,16 +403,169 @@ Index route
         if question is None:
             abort(404)
 
+        deleted_question = question.format()
         question.delete()
-        new_list_questions = Question.query.order_by(Question.id).all()
-        # print(new_list_questions)
 
-        return jsonify({
+        return mutation_response({
             'success': True,
             'question_deleted': id,
-            'questions': [question.format() for question in new_list_questions]
+            'question': deleted_question
         })
 
+    # Batch delete, body: {"ids": [1, 2, 3]}
+    @app.route("/questions/batch", methods=['DELETE'])
+    def delete_questions():
+        body = request.get_json()
+        try:
+            ids = [int(id) for id in body['ids']]
+        except:
+            abort(400)
+
+        deleted = Question.delete_many(ids)
+        if len(deleted) == 0:
+            abort(404)
+
+        return mutation_response({
+            'success': True,
+            'questions_deleted': deleted,
+            'not_found': sorted(set(ids) - set(deleted))
+        })
+
+    # Batch insert, body: {"questions": [{"question": ..., "answer": ...,
+    # "category": ..., "difficulty": ...}, ...]}
+    @app.route("/questions/batch", methods=['POST'])
+    def add_questions():
+        body = request.get_json()
+        try:
+            new_questions = [
+                Question(
+                    question=data_new_question['question'],
+                    answer=data_new_question['answer'],
+                    category=data_new_question['category'],
+                    difficulty=data_new_question['difficulty']
+                )
+                for data_new_question in body['questions']]
+        except:
+            abort(422)
+
+        if len(new_questions) == 0:
+            abort(400)
+
+        return mutation_response({
+            'success': True,
+            'questions_created': Question.insert_many(new_questions)
+        })
+
+    '''
+Bulk import/export of question banks, as CSV or JSON Lines
+(question, answer, category, difficulty).
+@DOCUMENTED!
+    '''
+    @app.route("/questions/import", methods=['POST'])
+    def import_questions_endpoint():
+        format = request.args.get(
+            'format', guess_format(request.content_type))
+        if format not in FORMATS:
+            abort(400)
+
+        lines = codecs.iterdecode(request.stream, 'utf-8')
+        try:
+            result = import_questions(read_rows(lines, format),
+                                      skip_duplicates=dedupe)
+        except:
+            abort(422)
+
+        result['success'] = True
+        result['total_questions'] = count_questions()
+        return jsonify(result)
+
+    @app.route("/questions/export", methods=['GET'])
+    @read_only()
+    def export_questions_endpoint():
+        format = request.args.get('format', 'jsonl')
+        if format not in FORMATS:
+            abort(400)
+
+        mimetype = 'text/csv' if format == 'csv' else 'application/x-ndjson'
+        return Response(stream_with_context(export_questions(format)),
+                        mimetype=mimetype)
+
+    @app.cli.command('db-upgrade')
+    @click.option('--target', type=int, default=None,
+                  help='Stop at this version.')
+    def db_upgrade_command(target):
+        """Applies the pending schema migrations."""
+        applied = migrations.upgrade(db.engine, target)
+        for number, description, _ in migrations.MIGRATIONS:
+            if number in applied:
+                click.echo('{}: {}'.format(number, description))
+        click.echo('Schema at version {}'.format(
+            db_version()))
+
+    @app.cli.command('db-version')
+    def db_version_command():
+        """Shows the version of the schema."""
+        click.echo(db_version())
+
+    def db_version():
+        with db.engine.connect() as connection:
+            return migrations.current_version(connection)
+
+    @app.cli.command('import-questions')
+    @click.argument('file', type=click.File('r', encoding='utf-8'))
+    @click.option('--format', type=click.Choice(FORMATS), default=None,
+                  help='Guessed from the file name when not given.')
+    @click.option('--batch-size', default=IMPORT_BATCH_SIZE)
+    def import_questions_command(file, format, batch_size):
+        """Imports questions from a CSV or JSON Lines FILE (- for stdin)."""
+        def progress(imported, rejected):
+            click.echo('{} imported, {} rejected'.format(imported, rejected))
+
+        result = import_questions(
+            read_rows(file, format or guess_format(file.name)),
+            batch_size, progress, skip_duplicates=dedupe)
+        for error in result['errors']:
+            click.echo('row {}: {}'.format(error['row'], error['message']),
+                       err=True)
+        click.echo('Done: {} imported, {} rejected, {} duplicates'.format(
+            result['imported'], result['rejected'], result['duplicates']))
+
+    @app.cli.command('dedupe-scan')
+    @click.option('--threshold', type=float, default=None,
+                  help='Similarity of the near duplicates (DEDUPE_THRESHOLD).')
+    @click.option('--rebuild', is_flag=True,
+                  help='Compute the fingerprints of every question again.')
+    @click.option('--delete', is_flag=True,
+                  help='Delete the exact duplicates, the oldest is kept.')
+    def dedupe_scan_command(threshold, rebuild, delete):
+        """Indexes the questions and lists the duplicate pairs."""
+        indexed = rebuild_index() if rebuild else index_missing()
+        click.echo('{} questions indexed'.format(indexed))
+        if threshold is None:
+            threshold = app.config.get('DEDUPE_THRESHOLD', 0.7)
+
+        exact, near = [], 0
+        for id, duplicate_id, score, is_exact in scan(threshold):
+            click.echo('{}\t{}\t{:.3f}\t{}'.format(
+                id, duplicate_id, score, 'exact' if is_exact else 'near'))
+            if is_exact:
+                exact.append(duplicate_id)
+            else:
+                near += 1
+        click.echo('{} exact and {} near duplicates'.format(len(exact), near))
+        if delete and exact:
+            deleted = Question.delete_many(sorted(set(exact)))
+            click.echo('{} questions deleted'.format(len(deleted)))
+
+    @app.cli.command('export-questions')
+    @click.argument('file', type=click.File('w', encoding='utf-8'))
+    @click.option('--format', type=click.Choice(FORMATS), default=None,
+                  help='Guessed from the file name when not given.')
+    def export_questions_command(file, format):
+        """Exports all the questions to a CSV or JSON Lines FILE."""
+        for line in export_questions(format or guess_format(file.name)):
+            file.write(line)
+
     '''
   @DONETODO:
   Create an endpoint to POST a new question,
@@ -151,6 +588,8 @@ Index route
   '''
 
     @app.route("/questions", methods=['POST'])
+    @protected('search', when=lambda: 'search' in request.args)
+    @read_only(when=lambda: 'search' in request.args)
     def add_question():
         data_new_question = request.get_json()
         search = request.args.get('search', None)
@@ -169,51 +608,65 @@ Index route
                     category=data_new_question['category'],
                     difficulty=data_new_question['difficulty']
                 )
-                new_question.insert()
+                # Exact duplicates are refused unless ?force=true, the near
+                # ones are created and listed in similar_questions. Two
+                # requests with the same text at the same time can both
+                # pass the check: nothing in the schema forbids duplicates,
+                # since ?force=true creates them on purpose. `flask
+                # dedupe-scan` finds the ones that got in.
+                similar = []
+                if dedupe and request.args.get('force', '') != 'true':
+                    similar = find_duplicates(
+                        new_question.question,
+                        app.config.get('DEDUPE_THRESHOLD', 0.7))
+                    exact = [duplicate['id'] for duplicate in similar
+                             if duplicate['exact']]
+                    if exact:
+                        return jsonify({
+                            'success': False,
+                            'error': 409,
+                            'message': 'Duplicate question',
+                            'duplicates': exact
+                        }), 409
 
-                questions = Question.query.order_by(Question.id).all()
-                current_questions = paginate(
-                    request, questions, QUESTIONS_PER_PAGE)
+                new_question.insert()
 
                 # print(new_question.format())
                 # print(new_question.id)
                 # new_question.insert()
-                return jsonify({
+                return mutation_response({
                     'success': True,
                     'question_created': new_question.id,
-                    'questions': current_questions,
-                    'total_questions': len(questions),
+                    'question': new_question.format(),
+                    'similar_questions': [duplicate['id']
+                                          for duplicate in similar],
                     'search': search
                 })
 
             else:
-                print("SEARCHED WORD" + search)
-                print(len(search))
                 if (len(search) == 0 or search == "" or search is None):
-                    print("hast aqui")
-                    questions = Question.query.order_by(Question.id).all()
-                    current_questions = paginate(
-                        request, questions, QUESTIONS_PER_PAGE)
-                    return jsonify({
+                    page_ids, next_cursor = page_of_question_ids()
+                    return listing_response({
                         'success': True,
-                        'questions': current_questions,
-                        'total_questions': len(questions),
-                        'search': None
-                    })
+                        'total_questions': count_questions(),
+                        'search': None,
+                        'next_cursor': next_cursor
+                    }, 'questions', encoded_questions(page_ids))
                 else:
-                    questions = Question.query.order_by(Question.id).all()
-                    # Search values:
-                    questions_filtered = Question.query.order_by(Question.id).filter(
-                        Question.question.ilike('%{}%'.format(search))).all()
-                    current_questions = paginate(
-                        request, questions_filtered, QUESTIONS_PER_PAGE)
-
-                    return jsonify({
+                    # Search values (?category= and ?answers=true are
+                    # optional):
+                    found_ids = question_search.search(
+                        search,
+                        category=request.args.get('category', None, type=int),
+                        answers=request.args.get('answers', '') == 'true')
+                    page_ids, next_cursor = paginate_ids(
+                        request, found_ids, questions_per_page())
+                    return listing_response({
                         'success': True,
-                        'questions': current_questions,
-                        'total_questions': len(questions),
-                        'search': search
-                    })
+                        'total_questions': len(found_ids),
+                        'search': search,
+                        'next_cursor': next_cursor
+                    }, 'questions', encoded_questions(page_ids))
         except:
             abort(422)
 
@@ -227,22 +680,35 @@ Index route
   @DOCUMENTED!
   '''
     @app.route("/categories/<int:category_id>/questions", methods=['GET'])
+    @conditional(versions.category_etag, 'QUESTIONS_MAX_AGE')
+    @read_only()
     def questions_by_category(category_id):
-        category = Category.query.get(category_id)
-        if category is None:
+        if find_category(category_id) is None:
             abort(404)
-        questions_filtered = Question.query.order_by(
-            Question.id).filter(Question.category == category_id).all()
 
-        paginated_filtered_questions = paginate(
-            request, questions_filtered, QUESTIONS_PER_PAGE)
+        if request.args.get('stream', '') == 'true':
+            return stream_questions(
+                Question.query.filter(Question.category == category_id),
+                'questions', {
+                    'success': True,
+                    'total_questions': count_questions(category_id),
+                    'current_category': category_id
+                }, category_id)
+
+        category_ids = category_question_ids(category_id)
 
-        return jsonify({
+        try:
+            page_ids, next_cursor = paginate_ids(
+                request, category_ids, questions_per_page(), keyset=True)
+        except ValueError:
+            abort(400)
+
+        return listing_response({
             'success': True,
-            'questions': paginated_filtered_questions,
-            'total_questions': len(questions_filtered),
-            'current_category': category_id
-        })
+            'total_questions': len(category_ids),
+            'current_category': category_id,
+            'next_cursor': next_cursor
+        }, 'questions', encoded_questions(page_ids))
 
     '''
   @DONETODO: 
@@ -258,6 +724,8 @@ Index route
   '''
 
     @app.route("/quizzes", methods=['POST'])
+    @protected('quizzes')
+    @read_only()
     def get_quizzes():
         body = request.get_json()
         try:
@@ -268,29 +736,173 @@ Index route
             if (prev_questions is None):
                 abort(400)
 
-            questions = []
-            if quiz_category == 0:
-                questions = Question.query.filter(
-                    Question.id.notin_(prev_questions)).all()
-            else:
-                category = Category.query.get(quiz_category)
+            if quiz_category != 0:
+                category = find_category(int(quiz_category))
                 if category is None:
                     abort(404)
-                questions = Question.query.filter(Question.id.notin_(
-                    prev_questions), Question.category == quiz_category).all()
-            current_question = None
-            if (len(questions) > 0):
-                index = random.randrange(0, len(questions))
-                current_question = questions[index].format()
-            return jsonify({
+
+            prev_questions = set(int(id) for id in prev_questions)
+            band, level = requested_difficulty(body)
+            count = body.get('count', None)
+            if count is not None and not 1 <= int(count) <= MAX_QUIZ_BATCH:
+                abort(400)
+            questions, remaining, level = draw_questions(
+                quiz_category, prev_questions, int(count or 1), band=band,
+                level=level)
+            response = {
                 'success': True,
-                'question': current_question,
-                'total_questions': len(questions)
-            })
+                'question': questions[0] if questions else None,
+                'total_questions': remaining
+            }
+            if count is not None:
+                response['questions'] = questions
+            if level is not None:
+                response['difficulty'] = level
+            return jsonify(response)
 
         except:
             abort(400)
 
+    '''
+Answers: checked on the server and added to the score of the player, see
+leaderboard.py.
+@DOCUMENTED!
+    '''
+    @app.route("/quizzes/answers", methods=['POST'])
+    @protected('answers')
+    @read_only()
+    def answer_question():
+        body = request.get_json()
+        try:
+            player = str(body['player']).strip()
+            question_id = int(body['question_id'])
+            answer = body['answer']
+            session_id = body.get('session_id')
+        except (TypeError, KeyError, ValueError, AttributeError):
+            abort(400)
+        if not player or len(player) > MAX_PLAYER_LENGTH or answer is None:
+            abort(400)
+
+        session = None
+        if session_id is not None:
+            session = quiz_sessions.get(str(session_id))
+            if session is None:
+                abort(404)
+        questions = load_questions([question_id])
+        if not questions:
+            abort(404)
+        question = questions[0]
+        correct = is_correct(answer, question['answer'])
+        points, score, rank = leaderboard.record(
+            player, question_id, correct, question_points(question))
+
+        response = {
+            'success': True,
+            'question_id': question_id,
+            'correct': correct,
+            'answer': question['answer'],
+            'points': points,
+            'player': player,
+            'score': score,
+            'rank': rank
+        }
+        if session is not None:
+            # The level of an adaptive session follows the answers checked
+            # here, never a result sent by the client
+            if session.answer(question_id, correct):
+                quiz_sessions.save(session)
+            response['difficulty'] = session.level
+        return jsonify(response)
+
+    @app.route("/leaderboard", methods=['GET'])
+    @read_only()
+    def get_leaderboard():
+        limit = request.args.get('limit', 10, type=int)
+        limit = max(1, min(limit, MAX_LEADERBOARD))
+        return jsonify({
+            'success': True,
+            'leaderboard': leaderboard.top(limit),
+            'total_players': len(leaderboard)
+        })
+
+    @app.route("/leaderboard/<player>", methods=['GET'])
+    @read_only()
+    def get_player_score(player):
+        entry = leaderboard.player(player)
+        if entry is None:
+            abort(404)
+        entry['success'] = True
+        return jsonify(entry)
+
+    '''
+Quiz sessions: the played questions are kept on the server, each round only
+sends the session id.
+@DOCUMENTED!
+    '''
+    @app.route("/quizzes/sessions", methods=['POST'])
+    @read_only()
+    def start_quiz_session():
+        body = request.get_json()
+        try:
+            quiz_category = int(body.get('quiz_category')['id'])
+            band, level = requested_difficulty(body, adaptive=True)
+        except:
+            abort(400)
+
+        if quiz_category != 0 and find_category(quiz_category) is None:
+            abort(404)
+
+        session = QuizSession(quiz_category, band=band, level=level)
+        quiz_sessions.save(session)
+        _, remaining = pool.draw(quiz_category, seen=0)
+
+        return jsonify({
+            'success': True,
+            'session_id': session.id,
+            'quiz_category': quiz_category,
+            'total_questions': remaining,
+            'difficulty': level
+        })
+
+    @app.route("/quizzes/sessions/<session_id>/next", methods=['POST'])
+    @read_only()
+    def next_quiz_question(session_id):
+        session = quiz_sessions.get(session_id)
+        if session is None:
+            abort(404)
+
+        questions, remaining, level = draw_questions(
+            session.category, session, seen=len(session), band=session.band,
+            level=session.level)
+        current_question = questions[0] if questions else None
+        if current_question is not None:
+            session.add(current_question['id'])
+            if session.level is not None:
+                session.asked = current_question['id']
+        quiz_sessions.save(session)
+
+        return jsonify({
+            'success': True,
+            'session_id': session.id,
+            'question': current_question,
+            'total_questions': remaining,
+            'difficulty': level
+        })
+
+    @app.route("/quizzes/sessions/<session_id>", methods=['DELETE'])
+    def finish_quiz_session(session_id):
+        session = quiz_sessions.get(session_id)
+        if session is None:
+            abort(404)
+        quiz_sessions.delete(session_id)
+
+        return jsonify({
+            'success': True,
+            'session_id': session.id,
+            'quiz_category': session.category,
+            'total_played': len(session)
+        })
+
     '''
   @DONETODO: 
   Create error handlers for all expected errors 
@@ -330,6 +942,14 @@ Index route
             'message': 'Bad request'
         }), 400
 
+    @app.errorhandler(429)
+    def too_many_requests(error):
+        return jsonify({
+            'success': False,
+            'error': 429,
+            'message': 'Too many requests'
+        }), 429
+
     @app.errorhandler(500)
     def internal_error(error):
         return jsonify({
@@ -1,14 +1,65 @@
+import base64
+import binascii
+from bisect import bisect_right
+
+
+# Cursor helpers: the cursor is an opaque token for the client, internally it
+# is just the last id that was sent, base64 encoded.
+def encode_cursor(last_id):
+    return base64.urlsafe_b64encode(str(last_id).encode()).decode()
+
+
+def decode_cursor(cursor):
+    # Raises ValueError if the cursor was not produced by encode_cursor
+    try:
+        return int(base64.urlsafe_b64decode(cursor.encode()).decode())
+    except (binascii.Error, UnicodeError):
+        raise ValueError('Invalid cursor')
+
+
 #  Paginate function:
-def paginate(request, selection, quantity):
-    # Here, the pagination is done by getting the ?page=2 (value), 1 is set as default, and expects an integer :)
-    page = request.args.get('page', 1, type=int)
-    start = (page - 1) * quantity
-    end = start + quantity
+def paginate(request, query, key, quantity):
+    # The pagination is pushed down into SQL. With a ?cursor= value we do a
+    # keyset query (WHERE key > cursor LIMIT n), otherwise we fall back to the
+    # ?page=2 (value) with LIMIT/OFFSET, 1 is set as default.
+    # Returns the rows of the page and the cursor of the next page (None
+    # when there are no more rows).
+    query = query.order_by(key)
+    cursor = request.args.get('cursor', None)
+    if cursor:
+        query = query.filter(key > decode_cursor(cursor))
+    else:
+        page = request.args.get('page', 1, type=int)
+        query = query.offset(max(page - 1, 0) * quantity)
+
+    # One extra row tells us if there is a next page without counting:
+    rows = query.limit(quantity + 1).all()
+    next_cursor = None
+    if len(rows) > quantity:
+        rows = rows[:quantity]
+        next_cursor = encode_cursor(getattr(rows[-1], key.key))
+
+    return rows, next_cursor
 
-    items = [item.format() for item in selection]
-    current_items = items[start:end]
 
-    return current_items
+def paginate_ids(request, ids, quantity, keyset=False):
+    # Same as paginate() for a list of ids that is already in order. For a
+    # sorted list (keyset=True) the cursor is the last id sent like in
+    # paginate(), otherwise (like ranked search results) it is the offset.
+    cursor = request.args.get('cursor', None)
+    if cursor and keyset:
+        start = bisect_right(ids, decode_cursor(cursor))
+    elif cursor:
+        start = decode_cursor(cursor)
+    else:
+        start = max(request.args.get('page', 1, type=int) - 1, 0) * quantity
+    end = start + quantity
+
+    page_ids = ids[start:end]
+    next_cursor = None
+    if end < len(ids):
+        next_cursor = encode_cursor(page_ids[-1] if keyset else end)
+    return page_ids, next_cursor
 
 
 def hasNextPage(page, request, restant_pages):
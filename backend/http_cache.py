@@ -0,0 +1,73 @@
+import threading
+import uuid
+
+from models import on_change
+
+'''
+HTTP caching
+    The read endpoints send a weak ETag built from change counters that are
+    bumped by the model change listeners, so a request with a matching
+    If-None-Match is answered with 304 before any query runs.
+
+    The counters live in each worker process: the ETags start with a token
+    of the process, so one worker never validates the ETag of another.
+'''
+
+
+class Versions:
+
+    def __init__(self):
+        self.token = uuid.uuid4().hex[:8]
+        self._lock = threading.Lock()
+        # 'categories', 'questions', 'questions_moved' and
+        # ('questions', category id) -> number of changes seen
+        self._counters = {}
+
+    def get(self, key):
+        return self._counters.get(key, 0)
+
+    def bump(self, *keys):
+        with self._lock:
+            for key in keys:
+                self._counters[key] = self._counters.get(key, 0) + 1
+
+    def etag(self, *keys):
+        return '{}-{}'.format(self.token, '.'.join(
+            str(self.get(key)) for key in keys))
+
+    def category_etag(self, category_id):
+        # Changes to other categories don't change the listing of this one,
+        # 'questions_moved' covers the changes whose category is not known
+        return self.etag('categories', 'questions_moved',
+                         ('questions', category_id))
+
+    def invalidate(self, change):
+        if change.table != 'questions':
+            self.bump(change.table)
+        elif change.action in ('insert', 'delete') and \
+                change.category is not None:
+            self.bump('questions', ('questions', int(change.category)))
+        else:
+            # Updates may move a question to another category, reloads
+            # change any of them
+            self.bump('questions', 'questions_moved')
+
+
+versions = Versions()
+on_change(versions.invalidate)
+
+
+def is_not_modified(request, etag):
+    return request.if_none_match.contains_weak(etag)
+
+
+def cache_headers(response, etag, max_age=0):
+    # max_age 0: shared caches may store the response but must revalidate
+    # it with the ETag before every use
+    response.set_etag(etag, weak=True)
+    response.cache_control.public = True
+    if max_age:
+        response.cache_control.max_age = max_age
+    else:
+        response.cache_control.no_cache = True
+    return response
@@ -0,0 +1,262 @@
+import atexit
+import threading
+import time
+import unicodedata
+from bisect import bisect_left, insort
+from collections import OrderedDict
+
+from models import db, Score, AnsweredQuestion
+
+'''
+Leaderboard
+    The answers are checked on the server and scored in memory: each player
+    has a [score, answers, correct] total, and the ranking is a list of
+    (-score, player) kept sorted as the scores change, so the top players
+    and the rank of a player are read without any query.
+
+    The answers scored since the last flush are buffered and written in one
+    transaction every LEADERBOARD_FLUSH_INTERVAL seconds (sooner once
+    LEADERBOARD_FLUSH_SIZE answers are waiting), not one commit per answer.
+    Every LEADERBOARD_RELOAD_INTERVAL seconds the totals are reloaded from
+    the table to add the answers scored by the other workers.
+
+    An answer to a question scores once per player. Each worker remembers
+    the last MAX_ANSWERED (player, question id) pairs and answers the
+    repeats it has seen with 0 points, without a query. The flush inserts
+    the buffered pairs into the answered_questions table and only adds the
+    points of the pairs the database did not have yet: an answer already
+    given on another worker, or before a restart, has its points taken back
+    from the totals.
+'''
+
+MAX_ANSWERED = 200000
+MAX_PLAYER_LENGTH = 64
+# Points of a question without difficulty
+DEFAULT_POINTS = 1
+
+ARTICLES = ('a', 'an', 'the')
+
+
+def normalize_answer(text):
+    # Case, accents, punctuation, extra spaces and a leading article don't
+    # matter: "The Beatles!" == "beatles"
+    text = unicodedata.normalize('NFKD', str(text))
+    text = ''.join(char if char.isalnum() else ' '
+                   for char in text.casefold()
+                   if not unicodedata.combining(char))
+    words = text.split()
+    if len(words) > 1 and words[0] in ARTICLES:
+        words = words[1:]
+    return ' '.join(words)
+
+
+def is_correct(answer, expected):
+    if answer is None or expected is None:
+        return False
+    return normalize_answer(answer) == normalize_answer(expected)
+
+
+def question_points(question):
+    return question.get('difficulty') or DEFAULT_POINTS
+
+
+class Leaderboard:
+
+    def __init__(self, app=None, flush_interval=2, flush_size=5000,
+                 reload_interval=30, max_answered=MAX_ANSWERED):
+        self.app = app
+        self.flush_interval = flush_interval
+        self.flush_size = flush_size
+        self.reload_interval = reload_interval
+        self.max_answered = max_answered
+        self.flushes = 0
+        self._lock = threading.Lock()
+        # Taken by flush() and reload() so a reload never misses the points
+        # being written
+        self._flush_lock = threading.Lock()
+        self._wake = threading.Event()
+        self._thread = None
+        self._loaded_at = None
+        # player -> [score, answers, correct]
+        self._players = {}
+        # (-score, player), sorted
+        self._ranking = []
+        # (player, question id, (score, answers, correct)) not written yet
+        self._pending = []
+        # (player, question id) already scored, oldest first
+        self._answered = OrderedDict()
+
+    def record(self, player, question_id, correct, points):
+        # Scores an answer, returns the points won (0 for a question the
+        # player already answered here), the score and the rank of the
+        # player
+        self._ensure_loaded()
+        key = (player, question_id)
+        with self._lock:
+            if key in self._answered:
+                self._answered.move_to_end(key)
+                totals = self._players.get(player, [0, 0, 0])
+                return 0, totals[0], self._rank(totals[0])
+            self._answered[key] = True
+            while len(self._answered) > self.max_answered:
+                self._answered.popitem(last=False)
+
+            won = points if correct else 0
+            delta = (won, 1, 1 if correct else 0)
+            self._add(player, delta)
+            self._pending.append((player, question_id, delta))
+            waiting = len(self._pending)
+            totals = self._players[player]
+            score, rank = totals[0], self._rank(totals[0])
+
+        self._start()
+        if waiting >= self.flush_size:
+            self._wake.set()
+        return won, score, rank
+
+    def top(self, limit=10):
+        # [{rank, player, score, answers, correct}] of the best players
+        self._ensure_loaded()
+        with self._lock:
+            return [self._format(player) for _, player in
+                    self._ranking[:limit]]
+
+    def player(self, player):
+        # The entry of the player, None if they have not answered yet
+        self._ensure_loaded()
+        with self._lock:
+            if player not in self._players:
+                return None
+            return self._format(player)
+
+    def __len__(self):
+        return len(self._players)
+
+    def _format(self, player):
+        score, answers, correct = self._players[player]
+        return {
+            'rank': self._rank(score),
+            'player': player,
+            'score': score,
+            'answers': answers,
+            'correct': correct
+        }
+
+    def _rank(self, score):
+        # 1 + the number of players with a higher score, ties share a rank
+        return bisect_left(self._ranking, (-score,)) + 1
+
+    def _add(self, player, delta, sign=1):
+        # Adds (or takes back) the (score, answers, correct) of an answer to
+        # the totals of the player
+        totals = self._players.get(player)
+        if totals is None:
+            totals = self._players[player] = [0, 0, 0]
+            insort(self._ranking, (0, player))
+        self._move(player, totals[0], totals[0] + sign * delta[0])
+        for index, value in enumerate(delta):
+            totals[index] += sign * value
+
+    def _move(self, player, old, new):
+        if old == new:
+            return
+        index = bisect_left(self._ranking, (-old, player))
+        del self._ranking[index]
+        insort(self._ranking, (-new, player))
+
+    def flush(self):
+        # Writes the buffered answers and adds their points to the scores
+        # table in one transaction, returns the number of players whose
+        # scores changed. The answers are put back in the buffer if it fails.
+        with self._flush_lock:
+            with self._lock:
+                batch, self._pending = self._pending, []
+            if not batch:
+                return 0
+            try:
+                added = AnsweredQuestion.add_many(
+                    (player, question_id) for player, question_id, _ in batch)
+                scored, rejected = {}, []
+                for player, question_id, delta in batch:
+                    if (player, question_id) not in added:
+                        rejected.append((player, delta))
+                        continue
+                    # A pair buffered twice scores once
+                    added.discard((player, question_id))
+                    totals = scored.setdefault(player, [0, 0, 0])
+                    for index, value in enumerate(delta):
+                        totals[index] += value
+                if scored:
+                    Score.add_many(scored)
+                else:
+                    db.session.commit()
+            except Exception:
+                db.session.rollback()
+                with self._lock:
+                    self._pending[:0] = batch
+                raise
+            with self._lock:
+                # Answered on another worker, or before a restart
+                for player, delta in rejected:
+                    self._add(player, delta, sign=-1)
+            self.flushes += 1
+            return len(scored)
+
+    def reload(self):
+        # The totals of the table plus the answers not written yet
+        with self._flush_lock:
+            rows = db.session.query(Score.player, Score.score, Score.answers,
+                                    Score.correct).all()
+            with self._lock:
+                players = {row[0]: list(row[1:]) for row in rows}
+                for player, _, delta in self._pending:
+                    totals = players.setdefault(player, [0, 0, 0])
+                    for index, value in enumerate(delta):
+                        totals[index] += value
+                self._players = players
+                self._ranking = sorted((-totals[0], player)
+                                       for player, totals in players.items())
+                self._loaded_at = time.time()
+
+    def _ensure_loaded(self):
+        if self._loaded_at is None:
+            self.reload()
+
+    def _start(self):
+        # Starts the flushing thread with the first answer
+        if self._thread is not None or self.app is None:
+            return
+        with self._lock:
+            if self._thread is not None:
+                return
+            self._thread = threading.Thread(
+                target=self._flush_forever, name='leaderboard-flush',
+                daemon=True)
+        self._thread.start()
+        atexit.register(self._flush_in_context)
+
+    def _flush_forever(self):
+        while True:
+            self._wake.wait(self.flush_interval)
+            self._wake.clear()
+            self._flush_in_context()
+
+    def _flush_in_context(self):
+        with self.app.app_context():
+            try:
+                self.flush()
+                if self.reload_interval and \
+                        time.time() - self._loaded_at >= self.reload_interval:
+                    self.reload()
+            except Exception:
+                self.app.logger.exception('Leaderboard flush failed')
+            finally:
+                db.session.remove()
+
+
+def create_leaderboard(app):
+    return Leaderboard(
+        app,
+        flush_interval=app.config.get('LEADERBOARD_FLUSH_INTERVAL', 2),
+        flush_size=app.config.get('LEADERBOARD_FLUSH_SIZE', 5000),
+        reload_interval=app.config.get('LEADERBOARD_RELOAD_INTERVAL', 30))
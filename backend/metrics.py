@@ -0,0 +1,240 @@
+import threading
+import time
+from collections import OrderedDict
+
+from flask import g, request, has_request_context
+from flask.json import JSONEncoder
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+from sqlalchemy.orm import Mapper
+
+from cache import caches
+
+'''
+Request metrics
+    Every request records its SQL queries, the time spent in the database,
+    the ORM objects it loaded, the time spent encoding JSON and the size of
+    the response. They are added up per endpoint and exposed in the
+    Prometheus text format by GET /metrics, and the timings of each request
+    are sent in its Server-Timing header.
+'''
+
+# Upper bounds of the request duration histogram, in seconds
+DURATION_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0,
+                    10.0)
+
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+
+class RequestSample:
+    # Counters of the current request, kept in flask.g
+
+    def __init__(self):
+        self.start = time.perf_counter()
+        self.queries = 0
+        self.db_seconds = 0.0
+        self.rows = 0
+        self.json_seconds = 0.0
+
+    def server_timing(self, total):
+        return ('db;dur={:.2f};desc="{} queries", json;dur={:.2f}, '
+                'total;dur={:.2f}').format(
+            self.db_seconds * 1000, self.queries, self.json_seconds * 1000,
+            total * 1000)
+
+
+class EndpointStats:
+
+    def __init__(self):
+        self.requests = {}  # status -> count
+        self.buckets = [0] * len(DURATION_BUCKETS)
+        self.seconds = 0.0
+        self.queries = 0
+        self.db_seconds = 0.0
+        self.rows = 0
+        self.json_seconds = 0.0
+        self.response_bytes = 0
+
+    @property
+    def count(self):
+        return sum(self.requests.values())
+
+
+class Metrics:
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        # (endpoint, method) -> EndpointStats
+        self._endpoints = OrderedDict()
+
+    def observe(self, endpoint, method, status, sample, seconds, size):
+        with self._lock:
+            stats = self._endpoints.get((endpoint, method))
+            if stats is None:
+                stats = self._endpoints[(endpoint, method)] = EndpointStats()
+            stats.requests[status] = stats.requests.get(status, 0) + 1
+            for number, bound in enumerate(DURATION_BUCKETS):
+                if seconds <= bound:
+                    stats.buckets[number] += 1
+            stats.seconds += seconds
+            stats.queries += sample.queries
+            stats.db_seconds += sample.db_seconds
+            stats.rows += sample.rows
+            stats.json_seconds += sample.json_seconds
+            stats.response_bytes += size or 0
+
+    def clear(self):
+        with self._lock:
+            self._endpoints.clear()
+
+    def render(self):
+        # Prometheus text exposition format
+        with self._lock:
+            endpoints = [(key, _copy(stats))
+                         for key, stats in self._endpoints.items()]
+
+        lines = []
+
+        def family(name, type, help, samples):
+            lines.append('# HELP {} {}'.format(name, help))
+            lines.append('# TYPE {} {}'.format(name, type))
+            for suffix, labels, value in samples:
+                lines.append('{}{}{{{}}} {}'.format(
+                    name, suffix, ','.join(
+                        '{}="{}"'.format(key, _escape(label))
+                        for key, label in labels), _number(value)))
+
+        def labels(endpoint, method, *extra):
+            return (('endpoint', endpoint), ('method', method)) + extra
+
+        family('trivia_requests_total', 'counter', 'Requests handled.', [
+            ('', labels(endpoint, method, ('status', status)), count)
+            for (endpoint, method), stats in endpoints
+            for status, count in sorted(stats.requests.items())])
+
+        duration = []
+        for (endpoint, method), stats in endpoints:
+            for bound, count in zip(DURATION_BUCKETS, stats.buckets):
+                duration.append(('_bucket', labels(
+                    endpoint, method, ('le', _number(bound))), count))
+            duration.append(('_bucket', labels(
+                endpoint, method, ('le', '+Inf')), stats.count))
+            duration.append(('_sum', labels(endpoint, method), stats.seconds))
+            duration.append(('_count', labels(endpoint, method),
+                             stats.count))
+        family('trivia_request_duration_seconds', 'histogram',
+               'Time to handle a request, without streamed bodies.',
+               duration)
+
+        for name, attribute, help in (
+                ('trivia_db_queries_total', 'queries', 'SQL statements run.'),
+                ('trivia_db_seconds_total', 'db_seconds',
+                 'Time spent running SQL statements.'),
+                ('trivia_rows_hydrated_total', 'rows',
+                 'ORM objects loaded from query results.'),
+                ('trivia_json_encode_seconds_total', 'json_seconds',
+                 'Time spent encoding JSON responses.'),
+                ('trivia_response_bytes_total', 'response_bytes',
+                 'Size of the response bodies with a known length.')):
+            family(name, 'counter', help, [
+                ('', labels(endpoint, method), getattr(stats, attribute))
+                for (endpoint, method), stats in endpoints])
+
+        cache_stats = [cache.stats() for cache in caches.values()]
+        family('trivia_cache_hits_total', 'counter', 'Cache hits.', [
+            ('', (('cache', stats['name']),), stats['hits'])
+            for stats in cache_stats])
+        family('trivia_cache_misses_total', 'counter', 'Cache misses.', [
+            ('', (('cache', stats['name']),), stats['misses'])
+            for stats in cache_stats])
+        return '\n'.join(lines) + '\n'
+
+
+metrics = Metrics()
+
+
+def current_sample():
+    if has_request_context():
+        return g.get('request_metrics', None)
+    return None
+
+
+class TimedJSONEncoder(JSONEncoder):
+    # Flask's encoder, adds its time to the current request
+
+    def encode(self, o):
+        start = time.perf_counter()
+        try:
+            return super().encode(o)
+        finally:
+            sample = current_sample()
+            if sample is not None:
+                sample.json_seconds += time.perf_counter() - start
+
+
+@event.listens_for(Engine, 'before_cursor_execute')
+def _before_cursor_execute(conn, cursor, statement, parameters, context,
+                           executemany):
+    conn.info.setdefault('query_start', []).append(time.perf_counter())
+
+
+@event.listens_for(Engine, 'after_cursor_execute')
+def _after_cursor_execute(conn, cursor, statement, parameters, context,
+                          executemany):
+    starts = conn.info.get('query_start')
+    if not starts:
+        return
+    start = starts.pop()
+    sample = current_sample()
+    if sample is not None:
+        sample.queries += 1
+        sample.db_seconds += time.perf_counter() - start
+
+
+@event.listens_for(Mapper, 'load')
+def _on_load(target, context):
+    sample = current_sample()
+    if sample is not None:
+        sample.rows += 1
+
+
+def init_metrics(app):
+    # Registers the request hooks, must run before the other after_request
+    # functions are added so it sees the final response
+    app.json_encoder = TimedJSONEncoder
+    server_timing = app.config.get('SERVER_TIMING', True)
+
+    @app.before_request
+    def start_request_metrics():
+        g.request_metrics = RequestSample()
+
+    @app.after_request
+    def record_request_metrics(response):
+        sample = g.pop('request_metrics', None)
+        if sample is None:
+            return response
+        seconds = time.perf_counter() - sample.start
+        endpoint = request.url_rule.rule if request.url_rule else 'unmatched'
+        metrics.observe(endpoint, request.method, response.status_code,
+                        sample, seconds, response.content_length)
+        if server_timing:
+            response.headers['Server-Timing'] = sample.server_timing(seconds)
+        return response
+
+
+def _copy(stats):
+    copy = EndpointStats()
+    copy.__dict__.update(stats.__dict__)
+    copy.requests = dict(stats.requests)
+    copy.buckets = list(stats.buckets)
+    return copy
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"')
+
+
+def _number(value):
+    if isinstance(value, float):
+        return repr(round(value, 6))
+    return str(value)
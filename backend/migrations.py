@@ -0,0 +1,195 @@
+import datetime
+
+from sqlalchemy import (MetaData, Table, Column, Integer, SmallInteger,
+                        BigInteger, String, DateTime, Float, ForeignKey,
+                        Index, and_, inspect, select, text)
+
+from fingerprints import EXACT, fingerprints
+
+'''
+Schema migrations
+    Versioned changes to the database schema, applied in order by upgrade()
+    (`flask db-upgrade`). The applied versions are recorded in the
+    schema_version table, so running it again only applies the new ones.
+'''
+
+MIGRATIONS = []
+
+schema_version = Table(
+    'schema_version', MetaData(),
+    Column('version', Integer, primary_key=True),
+    Column('description', String),
+    Column('applied_at', DateTime))
+
+
+def migration(version, description):
+    def register(upgrade):
+        MIGRATIONS.append((version, description, upgrade))
+        MIGRATIONS.sort(key=lambda migration: migration[0])
+        return upgrade
+    return register
+
+
+def current_version(connection):
+    if not connection.dialect.has_table(connection, 'schema_version'):
+        return 0
+    versions = [row[0] for row in connection.execute(
+        select([schema_version.c.version]))]
+    return max(versions) if versions else 0
+
+
+def upgrade(engine, target=None):
+    # Applies the pending migrations (up to target), each one in its own
+    # transaction. Returns the versions that were applied.
+    with engine.begin() as connection:
+        schema_version.create(connection, checkfirst=True)
+        version = current_version(connection)
+
+    applied = []
+    for number, description, function in MIGRATIONS:
+        if number <= version or (target is not None and number > target):
+            continue
+        with engine.begin() as connection:
+            function(connection)
+            connection.execute(schema_version.insert().values(
+                version=number, description=description,
+                applied_at=datetime.datetime.utcnow()))
+        applied.append(number)
+    return applied
+
+
+@migration(1, 'Create the categories and questions tables')
+def create_tables(connection):
+    # Same schema as trivia.psql, nothing is done on a restored database
+    metadata = MetaData()
+    Table('categories', metadata,
+          Column('id', Integer, primary_key=True),
+          Column('type', String))
+    Table('questions', metadata,
+          Column('id', Integer, primary_key=True),
+          Column('question', String),
+          Column('answer', String),
+          Column('difficulty', Integer),
+          Column('category', Integer, ForeignKey(
+              'categories.id', onupdate='CASCADE', ondelete='SET NULL')))
+    metadata.create_all(connection, checkfirst=True)
+
+
+@migration(2, 'Integer questions.category with a foreign key and indexes')
+def category_foreign_key_and_indexes(connection):
+    if connection.dialect.name == 'postgresql':
+        # Tables created by db.create_all() with the old model had a
+        # varchar category and no foreign key
+        connection.execute(text(
+            'ALTER TABLE questions ALTER COLUMN category TYPE integer '
+            'USING category::integer'))
+        foreign_keys = inspect(connection).get_foreign_keys('questions')
+        if not any(key['referred_table'] == 'categories'
+                   for key in foreign_keys):
+            connection.execute(text(
+                'ALTER TABLE questions ADD CONSTRAINT '
+                'questions_category_fkey FOREIGN KEY (category) '
+                'REFERENCES categories (id) '
+                'ON UPDATE CASCADE ON DELETE SET NULL'))
+    # SQLite can't alter columns or add constraints to an existing table,
+    # its tables come from migration 1 which already has both.
+    connection.execute(text(
+        'CREATE INDEX IF NOT EXISTS ix_questions_category_id '
+        'ON questions (category, id)'))
+    connection.execute(text(
+        'CREATE INDEX IF NOT EXISTS ix_questions_category_difficulty '
+        'ON questions (category, difficulty)'))
+
+
+@migration(3, 'Full text search indexes (PostgreSQL only)')
+def full_text_search_indexes(connection):
+    # Same expressions as search.PostgresSearch, with and without answers
+    if connection.dialect.name != 'postgresql':
+        return
+    connection.execute(text(
+        "CREATE INDEX IF NOT EXISTS ix_questions_search ON questions "
+        "USING gin (to_tsvector('english', coalesce(question, '')))"))
+    connection.execute(text(
+        "CREATE INDEX IF NOT EXISTS ix_questions_search_answers "
+        "ON questions USING gin (to_tsvector('english', "
+        "coalesce(question, '') || ' ' || coalesce(answer, '')))"))
+
+
+@migration(4, 'Create the scores table of the leaderboard')
+def create_scores(connection):
+    metadata = MetaData()
+    Table('scores', metadata,
+          Column('player', String(64), primary_key=True),
+          Column('score', Integer, nullable=False, default=0),
+          Column('answers', Integer, nullable=False, default=0),
+          Column('correct', Integer, nullable=False, default=0))
+    metadata.create_all(connection, checkfirst=True)
+
+
+@migration(5, 'Create the change_log table of the polling change bus')
+def create_change_log(connection):
+    metadata = MetaData()
+    Table('change_log', metadata,
+          Column('id', Integer, primary_key=True),
+          Column('origin', String(32), nullable=False),
+          Column('table_name', String(32), nullable=False),
+          Column('action', String(16), nullable=False),
+          Column('row_id', Integer),
+          Column('category', Integer),
+          Column('difficulty', Integer),
+          Column('created_at', Float, nullable=False))
+    metadata.create_all(connection, checkfirst=True)
+
+
+@migration(6, 'Create the question_hashes table of the duplicate index')
+def create_question_hashes(connection):
+    # Filled for the existing questions by migration 8
+    metadata = MetaData()
+    # Only referenced by the foreign key
+    Table('questions', metadata, Column('id', Integer, primary_key=True))
+    question_hashes = Table(
+        'question_hashes', metadata,
+        Column('question_id', Integer, ForeignKey(
+            'questions.id', ondelete='CASCADE'), primary_key=True),
+        Column('band', SmallInteger, primary_key=True),
+        Column('hash', BigInteger, nullable=False),
+        Index('ix_question_hashes_hash', 'hash'))
+    question_hashes.create(connection, checkfirst=True)
+
+
+@migration(7, 'Create the answered_questions table of the leaderboard')
+def create_answered_questions(connection):
+    metadata = MetaData()
+    Table('answered_questions', metadata,
+          Column('player', String(64), primary_key=True),
+          Column('question_id', Integer, primary_key=True))
+    metadata.create_all(connection, checkfirst=True)
+
+
+@migration(8, 'Fingerprint the questions already in the table')
+def fingerprint_questions(connection, batch_size=1000):
+    # The questions written before migration 6 have no fingerprints, the
+    # duplicate checks would not see them
+    metadata = MetaData()
+    questions = Table('questions', metadata,
+                      Column('id', Integer, primary_key=True),
+                      Column('question', String))
+    question_hashes = Table('question_hashes', metadata,
+                            Column('question_id', Integer, primary_key=True),
+                            Column('band', SmallInteger, primary_key=True),
+                            Column('hash', BigInteger))
+    indexed = select([question_hashes.c.question_id]).where(
+        question_hashes.c.band == EXACT)
+    last_id = 0
+    while True:
+        batch = connection.execute(
+            select([questions.c.id, questions.c.question]).where(and_(
+                questions.c.id > last_id, ~questions.c.id.in_(indexed)))
+            .order_by(questions.c.id).limit(batch_size)).fetchall()
+        if not batch:
+            return
+        connection.execute(question_hashes.insert(), [
+            {'question_id': id, 'band': band, 'hash': hash}
+            for id, question in batch
+            for band, hash in fingerprints(question)])
+        last_id = batch[-1][0]
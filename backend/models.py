@@ -1,31 +1,70 @@
 import os
-from sqlalchemy import Column, String, Integer, create_engine
-from flask_sqlalchemy import SQLAlchemy
+from collections import namedtuple
+from sqlalchemy import Column, String, Integer, SmallInteger, BigInteger, \
+    Float, ForeignKey, Index, create_engine, text
 import json
-# environment variables using python-decouple (.env) file :
-from decouple import config
-USERDB = config('USERDB')
-USERDBPASSWORD = config('USERDBPASSWORD')
+from config import engine_options
+from replicas import RoutingSQLAlchemy
+from fingerprints import fingerprints
 
-database_name = "trivia"
-port_config = "5433"
-database_path = "postgres://{}:{}@{}:{}/{}".format(
-    USERDB, USERDBPASSWORD, 'localhost', port_config, database_name)
-
-db = SQLAlchemy()
+db = RoutingSQLAlchemy()
 
 '''
 setup_db(app)
     binds a flask application and a SQLAlchemy service
+    the database and pool settings come from the app config (see config.py),
+    the engine is only created when the first query needs it
+    the tables are created by the migrations: `flask db-upgrade`
+    the session can send the reads to replicas (see replicas.py)
 '''
 
 
-def setup_db(app, database_path=database_path):
-    app.config["SQLALCHEMY_DATABASE_URI"] = database_path
+def setup_db(app, database_path=None):
+    if database_path is not None:
+        app.config["SQLALCHEMY_DATABASE_URI"] = database_path
     app.config["SQLALCHEMY_TRACK_MODIFICATIONS"] = False
+    if "SQLALCHEMY_ENGINE_OPTIONS" not in app.config:
+        app.config["SQLALCHEMY_ENGINE_OPTIONS"] = engine_options(app.config)
     db.app = app
     db.init_app(app)
-    db.create_all()
+
+
+'''
+Change listeners
+    functions registered with on_change(listener) are called with a Change
+    after every committed insert, update or delete of a model, so in-process
+    caches can invalidate themselves.
+'''
+
+Change = namedtuple('Change', ['table', 'action', 'id', 'category',
+                               'difficulty'])
+
+_change_listeners = []
+_batch_listeners = []
+
+
+def on_change(listener):
+    _change_listeners.append(listener)
+    return listener
+
+
+def on_changes(listener):
+    # listener(changes) gets the changes notified together (insert_many,
+    # delete_many) in one call
+    _batch_listeners.append(listener)
+    return listener
+
+
+def notify_change(table, action, id=None, category=None, difficulty=None):
+    notify_changes([Change(table, action, id, category, difficulty)])
+
+
+def notify_changes(changes):
+    for change in changes:
+        for listener in _change_listeners:
+            listener(change)
+    for listener in _batch_listeners:
+        listener(changes)
 
 
 '''
@@ -36,11 +75,17 @@ Question
 
 class Question(db.Model):
     __tablename__ = 'questions'
+    # Created by migration 2, for the per category listings and quizzes
+    __table_args__ = (
+        Index('ix_questions_category_id', 'category', 'id'),
+        Index('ix_questions_category_difficulty', 'category', 'difficulty'),
+    )
 
     id = Column(Integer, primary_key=True)
     question = Column(String)
     answer = Column(String)
-    category = Column(String)
+    category = Column(Integer, ForeignKey(
+        'categories.id', onupdate='CASCADE', ondelete='SET NULL'))
     difficulty = Column(Integer)
 
     def __init__(self, question, answer, category, difficulty):
@@ -49,16 +94,67 @@ class Question(db.Model):
         self.category = category
         self.difficulty = difficulty
 
+    # The fingerprints of the duplicate index (QuestionHash) are written in
+    # the same transaction as the question
+
     def insert(self):
         db.session.add(self)
+        db.session.flush()
+        QuestionHash.add([self])
         db.session.commit()
+        notify_change('questions', 'insert', self.id, self.category,
+                      self.difficulty)
 
     def update(self):
+        QuestionHash.remove([self.id])
+        QuestionHash.add([self])
         db.session.commit()
+        notify_change('questions', 'update', self.id, self.category,
+                      self.difficulty)
 
     def delete(self):
+        id, category, difficulty = self.id, self.category, self.difficulty
+        QuestionHash.remove([id])
         db.session.delete(self)
         db.session.commit()
+        notify_change('questions', 'delete', id, category, difficulty)
+
+    @classmethod
+    def insert_many(cls, questions):
+        # Inserts all the questions in one transaction
+        db.session.add_all(questions)
+        db.session.flush()
+        QuestionHash.add(questions)
+        inserted = [(question.id, question.category, question.difficulty)
+                    for question in questions]
+        db.session.commit()
+        notify_changes([Change('questions', 'insert', *row)
+                        for row in inserted])
+        return [id for id, category, difficulty in inserted]
+
+    @classmethod
+    def delete_many(cls, ids):
+        # Deletes the questions of the given ids in one transaction, returns
+        # the ids that existed
+        deleted = db.session.query(
+            cls.id, cls.category, cls.difficulty).filter(
+            cls.id.in_(ids)).all()
+        QuestionHash.remove(ids)
+        cls.query.filter(cls.id.in_(ids)).delete(synchronize_session=False)
+        db.session.commit()
+        notify_changes([Change('questions', 'delete', *row)
+                        for row in deleted])
+        return [id for id, category, difficulty in deleted]
+
+    @classmethod
+    def format_many(cls, ids):
+        # Formatted questions of the given ids in one query, in the same
+        # order. Only the columns are read, no Question instance is built.
+        rows = db.session.query(
+            cls.id, cls.question, cls.answer, cls.category,
+            cls.difficulty).filter(cls.id.in_(ids)).all()
+        questions = {row[0]: format_question_row(row) for row in rows}
+        return [questions[id] for id in ids if id in questions]
 
     def format(self):
         return {
@@ -70,6 +166,56 @@ class Question(db.Model):
         }
 
 
+# Same dict as Question.format() from a (id, question, answer, category,
+# difficulty) row, for queries that don't load Question instances
+QUESTION_COLUMNS = ('id', 'question', 'answer', 'category', 'difficulty')
+
+
+def format_question_row(row):
+    return dict(zip(QUESTION_COLUMNS, row))
+
+
+'''
+QuestionHash
+    fingerprints of the text of each question (see fingerprints.py), looked
+    up by hash to find duplicates without comparing every question
+    (dedupe.py)
+'''
+
+
+class QuestionHash(db.Model):
+    __tablename__ = 'question_hashes'
+    # Created by migration 6. The rows of a question are deleted with it
+    # by Question.delete and delete_many: SQLite ignores ON DELETE CASCADE
+    # unless foreign keys are turned on.
+    __table_args__ = (
+        Index('ix_question_hashes_hash', 'hash'),
+    )
+
+    question_id = Column(Integer, ForeignKey(
+        'questions.id', ondelete='CASCADE'), primary_key=True)
+    band = Column(SmallInteger, primary_key=True)
+    hash = Column(BigInteger, nullable=False)
+
+    @classmethod
+    def rows(cls, id, text):
+        return [{'question_id': id, 'band': band, 'hash': hash}
+                for band, hash in fingerprints(text)]
+
+    @classmethod
+    def add(cls, questions):
+        # Adds the fingerprints of the (flushed) questions to the session
+        rows = [row for question in questions
+                for row in cls.rows(question.id, question.question)]
+        if rows:
+            db.session.execute(cls.__table__.insert(), rows)
+
+    @classmethod
+    def remove(cls, ids):
+        cls.query.filter(cls.question_id.in_(ids)).delete(
+            synchronize_session=False)
+
+
 '''
 Category
 
@@ -85,8 +231,125 @@ class Category(db.Model):
     def __init__(self, type):
         self.type = type
 
+    def insert(self):
+        db.session.add(self)
+        db.session.commit()
+        notify_change('categories', 'insert', self.id)
+
+    def update(self):
+        db.session.commit()
+        notify_change('categories', 'update', self.id)
+
+    def delete(self):
+        id = self.id
+        db.session.delete(self)
+        db.session.commit()
+        notify_change('categories', 'delete', id)
+
     def format(self):
         return {
             'id': self.id,
             'type': self.type
         }
+
+
+'''
+Score
+    points, answers and right answers of each player, written by the
+    leaderboard in batches (see leaderboard.py)
+'''
+
+# Adds to the row of the player, or creates it (PostgreSQL 9.5+ and
+# SQLite 3.24+)
+ADD_SCORE = text(
+    'INSERT INTO scores (player, score, answers, correct) '
+    'VALUES (:player, :score, :answers, :correct) '
+    'ON CONFLICT (player) DO UPDATE SET '
+    'score = scores.score + excluded.score, '
+    'answers = scores.answers + excluded.answers, '
+    'correct = scores.correct + excluded.correct')
+
+
+class Score(db.Model):
+    __tablename__ = 'scores'
+
+    player = Column(String(64), primary_key=True)
+    score = Column(Integer, nullable=False, default=0)
+    answers = Column(Integer, nullable=False, default=0)
+    correct = Column(Integer, nullable=False, default=0)
+
+    @classmethod
+    def add_many(cls, totals):
+        # Adds the (score, answers, correct) of each player of totals in one
+        # statement and one transaction
+        db.session.execute(ADD_SCORE, [
+            {'player': player, 'score': score, 'answers': answers,
+             'correct': correct}
+            for player, (score, answers, correct) in totals.items()])
+        db.session.commit()
+
+
+'''
+AnsweredQuestion
+    the questions answered by each player: a question scores once per
+    player, whichever worker gets the answers
+'''
+
+# Answers inserted by one statement (under the 999 variables of SQLite)
+ANSWERED_BATCH_SIZE = 400
+
+
+def add_answered_statement(count):
+    # Nothing is inserted when the player already answered the question,
+    # the pairs that were are returned (PostgreSQL 9.5+ and SQLite 3.35+)
+    values = ', '.join('(:player{0}, :question_id{0})'.format(index)
+                       for index in range(count))
+    return text(
+        'INSERT INTO answered_questions (player, question_id) '
+        'VALUES ' + values + ' ON CONFLICT DO NOTHING '
+        'RETURNING player, question_id')
+
+
+class AnsweredQuestion(db.Model):
+    __tablename__ = 'answered_questions'
+
+    player = Column(String(64), primary_key=True)
+    question_id = Column(Integer, primary_key=True)
+
+    @classmethod
+    def add_many(cls, pairs):
+        # Inserts the (player, question id) pairs, returns the set of those
+        # the players had not answered before. Not committed, the caller
+        # commits with the scores.
+        pairs = list(dict.fromkeys(pairs))
+        added = set()
+        for start in range(0, len(pairs), ANSWERED_BATCH_SIZE):
+            batch = pairs[start:start + ANSWERED_BATCH_SIZE]
+            params = {}
+            for index, (player, question_id) in enumerate(batch):
+                params['player{}'.format(index)] = player
+                params['question_id{}'.format(index)] = question_id
+            result = db.session.execute(
+                add_answered_statement(len(batch)), params)
+            added.update((row[0], row[1]) for row in result)
+        return added
+
+
+'''
+ChangeLog
+    the changes published by the polling change bus (see change_bus.py), the
+    id is the version the other workers have seen
+'''
+
+
+class ChangeLog(db.Model):
+    __tablename__ = 'change_log'
+
+    id = Column(Integer, primary_key=True)
+    origin = Column(String(32), nullable=False)
+    table_name = Column(String(32), nullable=False)
+    action = Column(String(16), nullable=False)
+    row_id = Column(Integer)
+    category = Column(Integer)
+    difficulty = Column(Integer)
+    created_at = Column(Float, nullable=False)
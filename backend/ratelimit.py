@@ -0,0 +1,159 @@
+import math
+import threading
+import time
+from collections import OrderedDict, namedtuple
+
+from flask import current_app, request
+
+'''
+Rate limiting and admission control
+    Each client (its X-API-Key when it is one of API_KEYS, its IP address
+    otherwise) has a token bucket per rule: the bucket holds up to `burst`
+    tokens and refills at `rate` tokens per second, a request takes one and
+    is refused with 429 when it is empty. The buckets are kept in memory,
+    by each worker, or in redis, where they are shared by every worker.
+
+    The AdmissionGate caps the number of expensive requests running at once
+    in a worker: a request waits at most `timeout` seconds for a slot, then
+    it is refused with 503 instead of queueing for a database connection.
+'''
+
+Decision = namedtuple('Decision', ['allowed', 'limit', 'remaining',
+                                   'retry_after'])
+
+# Buckets kept by MemoryBuckets, the least recently used are dropped first
+MAX_CLIENTS = 100000
+
+
+def client_key():
+    # The client of the request. The X-API-Key header is only trusted when
+    # it is one of API_KEYS, any other value would give its sender a new
+    # bucket.
+    key = request.headers.get('X-API-Key')
+    if key and key in current_app.config.get('API_KEYS', ()):
+        return 'key:' + key
+    return request.remote_addr
+
+
+def _refill(tokens, updated, now, rate, burst):
+    return min(burst, tokens + max(0.0, now - updated) * rate)
+
+
+def _decision(allowed, tokens, rate, burst, cost):
+    retry_after = 0 if allowed else math.ceil((cost - tokens) / rate)
+    return Decision(allowed, burst, int(tokens), retry_after)
+
+
+class MemoryBuckets:
+
+    def __init__(self, max_clients=MAX_CLIENTS):
+        self.max_clients = max_clients
+        self._lock = threading.Lock()
+        # key -> (tokens, updated)
+        self._buckets = OrderedDict()
+
+    def take(self, key, rate, burst, cost=1):
+        now = time.time()
+        with self._lock:
+            tokens, updated = self._buckets.get(key, (burst, now))
+            tokens = _refill(tokens, updated, now, rate, burst)
+            allowed = tokens >= cost
+            if allowed:
+                tokens -= cost
+            self._buckets[key] = (tokens, now)
+            self._buckets.move_to_end(key)
+            while len(self._buckets) > self.max_clients:
+                self._buckets.popitem(last=False)
+        return _decision(allowed, tokens, rate, burst, cost)
+
+
+class RedisBuckets:
+    # The bucket is read and updated by a Lua script, atomically for every
+    # worker sharing the redis server
+
+    SCRIPT = '''
+local state = redis.call('HMGET', KEYS[1], 'tokens', 'updated')
+local rate, burst = tonumber(ARGV[1]), tonumber(ARGV[2])
+local now, cost = tonumber(ARGV[3]), tonumber(ARGV[4])
+local tokens = tonumber(state[1]) or burst
+local updated = tonumber(state[2]) or now
+tokens = math.min(burst, tokens + math.max(0, now - updated) * rate)
+local allowed = 0
+if tokens >= cost then
+  tokens = tokens - cost
+  allowed = 1
+end
+redis.call('HMSET', KEYS[1], 'tokens', tostring(tokens), 'updated',
+           tostring(now))
+redis.call('EXPIRE', KEYS[1], math.ceil(burst / rate) + 1)
+return {allowed, tostring(tokens)}
+'''
+
+    def __init__(self, client, prefix='rate-limit:'):
+        self.client = client
+        self.prefix = prefix
+        self._script = client.register_script(self.SCRIPT)
+
+    def take(self, key, rate, burst, cost=1):
+        allowed, tokens = self._script(
+            keys=[self.prefix + key], args=[rate, burst, time.time(), cost])
+        return _decision(bool(allowed), float(tokens), rate, burst, cost)
+
+
+class RateLimiter:
+
+    def __init__(self, buckets, rules):
+        # rules: name -> (rate per second, burst)
+        self.buckets = buckets
+        self.rules = rules
+
+    def check(self, rule, client):
+        # None when the rule has no limit
+        if rule not in self.rules:
+            return None
+        rate, burst = self.rules[rule]
+        return self.buckets.take('{}:{}'.format(rule, client), rate, burst)
+
+
+class AdmissionGate:
+
+    def __init__(self, limit, timeout):
+        self.limit = limit
+        self.timeout = timeout
+        self.rejected = 0
+        self._slots = threading.BoundedSemaphore(limit)
+
+    def acquire(self):
+        # False when no slot was free within the timeout
+        if self._slots.acquire(timeout=self.timeout):
+            return True
+        self.rejected += 1
+        return False
+
+    def release(self):
+        self._slots.release()
+
+
+def create_limiter(app):
+    # None when RATE_LIMIT_ENABLED is off. RATE_LIMIT_BACKEND: 'memory'
+    # (default, per worker) or 'redis' (REDIS_URL, shared)
+    if not app.config.get('RATE_LIMIT_ENABLED', True):
+        return None
+    kind = app.config.get('RATE_LIMIT_BACKEND', 'memory')
+    if kind == 'memory':
+        buckets = MemoryBuckets()
+    elif kind == 'redis':
+        import redis
+        buckets = RedisBuckets(redis.Redis.from_url(app.config['REDIS_URL']))
+    else:
+        raise ValueError('Unknown RATE_LIMIT_BACKEND: {}'.format(kind))
+    return RateLimiter(buckets, app.config.get('RATE_LIMITS', {}))
+
+
+def create_gate(app):
+    # ADMISSION_LIMIT 0 uses the size of the connection pool
+    limit = app.config.get('ADMISSION_LIMIT', 0) or (
+        app.config.get('DB_POOL_SIZE', 5) +
+        app.config.get('DB_MAX_OVERFLOW', 10))
+    return AdmissionGate(limit,
+                         app.config.get('ADMISSION_TIMEOUT', 100) / 1000.0)
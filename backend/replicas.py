@@ -0,0 +1,235 @@
+import itertools
+import threading
+import time
+from collections import OrderedDict
+from contextlib import contextmanager
+
+from flask import g, request, has_request_context
+from flask_sqlalchemy import SQLAlchemy, SignallingSession
+from sqlalchemy import create_engine, event, orm
+from sqlalchemy.exc import DBAPIError
+from sqlalchemy.sql.expression import UpdateBase
+
+from config import engine_options
+from ratelimit import client_key
+
+'''
+Read replicas
+    With DB_REPLICA_URLS the queries of the read-only routes run on a
+    replica, taken in turn among the healthy ones, every other query (the
+    writes included) runs on the primary, SQLALCHEMY_DATABASE_URI.
+
+    A replica is left out for DB_REPLICA_RETRY seconds when a connection to
+    it fails, or when its health check (run every DB_REPLICA_CHECK_INTERVAL
+    seconds) fails or finds it more than DB_REPLICA_MAX_LAG seconds behind.
+    When no replica is healthy the primary serves the reads.
+
+    Replicas lag behind the primary, so once a request has written the rest
+    of it reads from the primary, and so does its client (a cookie, and its
+    API key or IP in this worker, see ratelimit.client_key) for
+    DB_STICKY_SECONDS. For the same reason a question missing from a replica
+    is looked up again on the primary before it is taken as deleted, and
+    the caches are not filled from a replica right after a change (see
+    cache.py).
+'''
+
+STICKY_COOKIE = 'trivia_primary'
+# Clients kept by the in-process stickiness, the oldest are dropped first
+MAX_STICKY_CLIENTS = 100000
+
+# Seconds the PostgreSQL replica is behind, 0 when it has replayed all it
+# received (NULL on a server that is not a replica)
+LAG_QUERY = '''
+SELECT CASE WHEN pg_last_wal_receive_lsn() = pg_last_wal_replay_lsn() THEN 0
+ELSE EXTRACT(EPOCH FROM now() - pg_last_xact_replay_timestamp()) END
+'''
+
+
+class RoutingSession(SignallingSession):
+    # Runs the queries on a replica of the ReplicaSet put in g.db_replicas
+    # by the read-only routes, until the session writes
+
+    def __init__(self, db, **options):
+        self.wrote = False
+        SignallingSession.__init__(self, db, **options)
+
+    def get_bind(self, mapper=None, clause=None):
+        if self._flushing or isinstance(clause, UpdateBase):
+            self.wrote = True
+            if has_request_context():
+                g.db_wrote = True
+        elif not self.wrote and has_request_context():
+            replicas = g.get('db_replicas', None)
+            engine = replicas.engine() if replicas is not None else None
+            if engine is not None:
+                return engine
+        return SignallingSession.get_bind(self, mapper, clause)
+
+
+class RoutingSQLAlchemy(SQLAlchemy):
+
+    def create_session(self, options):
+        return orm.sessionmaker(class_=RoutingSession, db=self, **options)
+
+
+class Replica:
+
+    def __init__(self, url, engine):
+        self.url = url
+        self.engine = engine
+        self.down_until = 0.0
+        self.checked_at = 0.0
+        self.failures = 0
+
+
+class ReplicaSet:
+
+    def __init__(self, engines, retry=30, check_interval=10, max_lag=0,
+                 sticky_seconds=5):
+        # engines: url -> engine
+        self.replicas = [Replica(url, engine)
+                         for url, engine in engines.items()]
+        self.retry = retry
+        self.check_interval = check_interval
+        self.max_lag = max_lag
+        self.sticky_seconds = sticky_seconds
+        self._turn = itertools.count()
+        self._lock = threading.Lock()
+        # client -> time until which it reads from the primary
+        self._sticky = OrderedDict()
+        for replica in self.replicas:
+            event.listen(replica.engine, 'handle_error',
+                         self._error_handler(replica))
+
+    def engine(self):
+        # Engine of the next healthy replica, None when there is none
+        now = time.time()
+        for _ in range(len(self.replicas)):
+            replica = self.replicas[next(self._turn) % len(self.replicas)]
+            if self._healthy(replica, now):
+                return replica.engine
+        return None
+
+    def _healthy(self, replica, now):
+        if replica.down_until > now:
+            return False
+        if now - replica.checked_at < self.check_interval:
+            return True
+        with self._lock:
+            if now - replica.checked_at < self.check_interval:
+                return replica.down_until <= now
+            replica.checked_at = now
+        return self.check(replica)
+
+    def check(self, replica):
+        # Health check: the replica answers, and is not too far behind
+        try:
+            with replica.engine.connect() as connection:
+                lag = 0
+                if self.max_lag and \
+                        replica.engine.dialect.name == 'postgresql':
+                    lag = connection.execute(LAG_QUERY).scalar() or 0
+        except DBAPIError:
+            self.mark_down(replica)
+            return False
+        if lag > self.max_lag:
+            self.mark_down(replica)
+            return False
+        replica.down_until = 0.0
+        return True
+
+    def mark_down(self, replica):
+        replica.failures += 1
+        replica.down_until = time.time() + self.retry
+        replica.checked_at = 0.0
+
+    def _error_handler(self, replica):
+        def handle_error(context):
+            # Connection failures only, a bad query is not the fault of the
+            # replica
+            if context.is_disconnect or context.connection is None:
+                self.mark_down(replica)
+                if has_request_context():
+                    g.db_replica_failed = True
+        return handle_error
+
+    def is_sticky(self):
+        # True when the client of the request wrote a moment ago
+        if request.cookies.get(STICKY_COOKIE):
+            return True
+        client = client_key()
+        with self._lock:
+            until = self._sticky.get(client)
+            if until is not None and until <= time.time():
+                del self._sticky[client]
+                until = None
+        return until is not None
+
+    def stick(self, response):
+        # The client of the request reads from the primary for
+        # sticky_seconds
+        client = client_key()
+        with self._lock:
+            self._sticky[client] = time.time() + self.sticky_seconds
+            self._sticky.move_to_end(client)
+            while len(self._sticky) > MAX_STICKY_CLIENTS:
+                self._sticky.popitem(last=False)
+        response.set_cookie(STICKY_COOKIE, '1', max_age=self.sticky_seconds,
+                            httponly=True)
+
+    def stats(self):
+        now = time.time()
+        return [{
+            'url': repr(replica.engine.url),
+            'healthy': replica.down_until <= now,
+            'failures': replica.failures
+        } for replica in self.replicas]
+
+
+def create_replicas(app):
+    # The ReplicaSet of DB_REPLICA_URLS, None when there are none. Each
+    # replica gets a connection pool with the DB_* settings of the primary.
+    urls = app.config.get('DB_REPLICA_URLS') or []
+    if isinstance(urls, str):
+        urls = [url.strip() for url in urls.split(',') if url.strip()]
+    if not urls:
+        return None
+    engines = OrderedDict()
+    for url in urls:
+        config = dict(app.config, SQLALCHEMY_DATABASE_URI=url)
+        engines[url] = create_engine(url, **engine_options(config))
+    replicas = ReplicaSet(
+        engines,
+        retry=app.config.get('DB_REPLICA_RETRY', 30),
+        check_interval=app.config.get('DB_REPLICA_CHECK_INTERVAL', 10),
+        max_lag=app.config.get('DB_REPLICA_MAX_LAG', 0),
+        sticky_seconds=app.config.get('DB_STICKY_SECONDS', 5))
+
+    @app.after_request
+    def stick_to_primary(response):
+        if g.get('db_wrote', False):
+            replicas.stick(response)
+        return response
+
+    return replicas
+
+
+def reading_from_replica():
+    # True when the queries of the request may run on a replica
+    return has_request_context() and \
+        g.get('db_replicas', None) is not None and \
+        not g.get('db_wrote', False)
+
+
+@contextmanager
+def on_primary():
+    # The queries run in the block go to the primary
+    if not has_request_context():
+        yield
+        return
+    replicas = g.pop('db_replicas', None)
+    try:
+        yield
+    finally:
+        if replicas is not None:
+            g.db_replicas = replicas
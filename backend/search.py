@@ -0,0 +1,262 @@
+import math
+import re
+import threading
+from bisect import bisect_left, insort
+
+from sqlalchemy import func
+
+from models import db, Question, on_changes
+from replicas import on_primary
+
+'''
+Question search
+    search(term, category=None, answers=False) returns the ids of the matching
+    questions, best ranked first. Every word of the term has to be found, the
+    last one can be the beginning of a word so results show up while typing.
+'''
+
+WORD_RE = re.compile(r'\w+')
+
+# A match in the question text weights more than a match in the answer
+QUESTION_WEIGHT = 2.0
+ANSWER_WEIGHT = 1.0
+# Changed ids per IN (...) clause
+CHUNK_SIZE = 500
+
+
+def tokenize(text):
+    return [word.casefold() for word in WORD_RE.findall(text or '')]
+
+
+def _term_frequencies(text):
+    frequencies = {}
+    for word in tokenize(text):
+        frequencies[word] = frequencies.get(word, 0) + 1
+    return frequencies
+
+
+class InvertedIndex:
+    # In-process index, built from the questions table the first time it is
+    # used and then updated with the model change listeners. A load builds
+    # a new index aside and swaps it in, the changes made meanwhile are
+    # applied to it again.
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._load_lock = threading.RLock()
+        self._loaded = False
+        # field -> word -> {question id: term frequency}
+        self._postings = {'question': {}, 'answer': {}}
+        # field -> sorted list of the words, for prefix matches
+        self._words = {'question': [], 'answer': []}
+        # question id -> (category, question words, answer words)
+        self._documents = {}
+        # Changes made since begin_load(): (id, question, answer, category)
+        # added, (id,) removed, None to load again. None when no load runs.
+        self._pending = None
+
+    def search(self, term, category=None, answers=False):
+        words = tokenize(term)
+        if not words:
+            return []
+        if not self._loaded:
+            self._load()
+
+        fields = [('question', QUESTION_WEIGHT)]
+        if answers:
+            fields.append(('answer', ANSWER_WEIGHT))
+
+        total = len(self._documents) or 1
+        scores = None
+        with self._lock:
+            for position, word in enumerate(words):
+                prefix = position == len(words) - 1
+                word_scores = {}
+                for field, weight in fields:
+                    for match in self._matches(field, word, prefix):
+                        postings = self._postings[field][match]
+                        idf = math.log(1 + total / len(postings))
+                        for id, frequency in postings.items():
+                            word_scores[id] = word_scores.get(id, 0) + \
+                                weight * frequency * idf
+                if scores is None:
+                    scores = word_scores
+                else:
+                    scores = {id: score + word_scores[id]
+                              for id, score in scores.items()
+                              if id in word_scores}
+                if not scores:
+                    return []
+
+            if category is not None:
+                category = int(category)
+                scores = {id: score for id, score in scores.items()
+                          if self._documents[id][0] == category}
+
+        return sorted(scores, key=lambda id: (-scores[id], id))
+
+    def add(self, id, question, answer, category):
+        with self._lock:
+            self._add(id, question, answer, category)
+            if self._pending is not None:
+                self._pending.append((id, question, answer, category))
+
+    def remove(self, id):
+        with self._lock:
+            self._remove(id)
+            if self._pending is not None:
+                self._pending.append((id,))
+
+    def _add(self, id, question, answer, category):
+        self._remove(id)
+        question_words = _term_frequencies(question)
+        answer_words = _term_frequencies(answer)
+        for field, frequencies in (('question', question_words),
+                                   ('answer', answer_words)):
+            for word, frequency in frequencies.items():
+                postings = self._postings[field].get(word)
+                if postings is None:
+                    postings = self._postings[field][word] = {}
+                    insort(self._words[field], word)
+                postings[id] = frequency
+        category = int(category) if category is not None else None
+        self._documents[id] = (category, tuple(question_words),
+                               tuple(answer_words))
+
+    def invalidate(self, changes=None):
+        # on_changes listener, without changes the index is loaded again.
+        # The questions inserted or updated by a batch are read with one
+        # query per CHUNK_SIZE ids.
+        if not self._loaded and self._pending is None:
+            return
+        # id -> True when inserted or updated, False when deleted
+        questions = {}
+        for change in changes or ():
+            if change.table != 'questions':
+                continue
+            if change.action == 'reload':
+                changes = None
+                break
+            questions[change.id] = change.action != 'delete'
+        if changes is None:
+            with self._lock:
+                self._loaded = False
+                if self._pending is not None:
+                    self._pending.append(None)
+            return
+
+        for id, present in questions.items():
+            if not present:
+                self.remove(id)
+        ids = [id for id, present in questions.items() if present]
+        for start in range(0, len(ids), CHUNK_SIZE):
+            for row in db.session.query(
+                    Question.id, Question.question, Question.answer,
+                    Question.category).filter(
+                    Question.id.in_(ids[start:start + CHUNK_SIZE])):
+                self.add(*row)
+
+    def _matches(self, field, word, prefix):
+        if not prefix:
+            return [word] if word in self._postings[field] else []
+        words = self._words[field]
+        matches = []
+        index = bisect_left(words, word)
+        while index < len(words) and words[index].startswith(word):
+            matches.append(words[index])
+            index += 1
+        return matches
+
+    def _remove(self, id):
+        document = self._documents.pop(id, None)
+        if document is None:
+            return
+        for field, words in (('question', document[1]),
+                             ('answer', document[2])):
+            for word in words:
+                postings = self._postings[field][word]
+                del postings[id]
+                if not postings:
+                    del self._postings[field][word]
+                    words_list = self._words[field]
+                    del words_list[bisect_left(words_list, word)]
+
+    def begin_load(self):
+        # The changes made from now on are applied again to the index of the
+        # next load(), whose rows may have been read before them
+        with self._lock:
+            if self._pending is None:
+                self._pending = []
+
+    def load(self, rows):
+        # Replaces the index with the (id, question, answer, category) rows,
+        # searches use the current index until the new one is built
+        with self._load_lock:
+            self.begin_load()
+            index = InvertedIndex()
+            try:
+                for row in rows:
+                    index.add(*row)
+            except Exception:
+                with self._lock:
+                    self._pending = None
+                raise
+            with self._lock:
+                loaded = True
+                for change in self._pending:
+                    if change is None:
+                        loaded = False
+                    elif len(change) == 1:
+                        index._remove(*change)
+                    else:
+                        index._add(*change)
+                self._pending = None
+                self._postings = index._postings
+                self._words = index._words
+                self._documents = index._documents
+                self._loaded = loaded
+
+    def _load(self):
+        with self._load_lock:
+            if self._loaded:
+                return
+            self.begin_load()
+            # From the primary, like QuestionPool._load
+            with on_primary():
+                rows = db.session.query(Question.id, Question.question,
+                                        Question.answer,
+                                        Question.category).all()
+            self.load(rows)
+
+
+class PostgresSearch:
+    # Full text search done by PostgreSQL (to_tsvector/plainto_tsquery),
+    # ranked with ts_rank.
+
+    def search(self, term, category=None, answers=False):
+        document = func.coalesce(Question.question, '')
+        if answers:
+            document = document + ' ' + func.coalesce(Question.answer, '')
+        vector = func.to_tsvector('english', document)
+        query = func.plainto_tsquery('english', term)
+
+        matches = db.session.query(Question.id).filter(vector.op('@@')(query))
+        if category is not None:
+            matches = matches.filter(Question.category == int(category))
+        matches = matches.order_by(func.ts_rank(vector, query).desc(),
+                                   Question.id)
+        return [id for id, in matches.all()]
+
+
+search_index = InvertedIndex()
+on_changes(search_index.invalidate)
+
+
+def create_search(app):
+    # SEARCH_BACKEND: 'memory' (default) or 'postgres'
+    backend = app.config.get('SEARCH_BACKEND', 'memory')
+    if backend == 'memory':
+        return search_index
+    if backend == 'postgres':
+        return PostgresSearch()
+    raise ValueError('Unknown SEARCH_BACKEND: {}'.format(backend))
@@ -0,0 +1,281 @@
+import random
+import threading
+from array import array
+
+from models import db, Question, on_change
+from replicas import on_primary
+
+'''
+QuestionPool
+    In-memory arrays of question ids per category, used to draw a random quiz
+    question without loading the candidate questions from the database.
+    Bucket ALL holds every question id. Each category (and ALL) also has a
+    bucket per difficulty, keyed (category, difficulty), so a draw within a
+    difficulty band only looks at the buckets of the band.
+
+    A load builds new buckets aside and swaps them in, the questions added
+    and removed meanwhile are applied to them again.
+'''
+
+ALL = 0
+
+# While at least half of a bucket is still eligible the expected number of
+# random draws is below 2, past that point we scan the bucket once.
+MAX_DRAWS = 8
+
+MIN_DIFFICULTY = 1
+MAX_DIFFICULTY = 5
+# Level of an adaptive quiz before the first answer
+START_DIFFICULTY = 2
+
+
+class QuestionPool:
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._buckets = None
+        # Changes made since begin_load(): (function, args) applied again to
+        # the loaded buckets, None to drop them. None when no load runs.
+        self._pending = None
+
+    def draw(self, category=ALL, previous=(), seen=None, difficulties=None):
+        # Returns a random question id of the category that is not in
+        # previous (None if there are none) and the number of eligible ids.
+        # previous can be any container, if it only holds ids of the bucket
+        # its size can be given as seen to skip counting them (an estimate,
+        # some of them may have been deleted since).
+        # difficulties limits the draw to those levels (seen is ignored).
+        if difficulties is None:
+            buckets = [self._bucket(category)]
+        else:
+            buckets = [self._bucket((_category_key(category), difficulty))
+                       for difficulty in difficulties]
+            seen = None
+        size = sum(len(ids) for ids, positions in buckets)
+
+        exact = seen is None
+        if exact:
+            if not isinstance(previous, (set, frozenset)):
+                previous = set(previous)
+            seen = sum(1 for id in previous
+                       for ids, positions in buckets if id in positions)
+        remaining = size - seen
+        if remaining <= 0 and exact:
+            return None, 0
+
+        if remaining * 2 >= size:
+            for _ in range(MAX_DRAWS):
+                id = _pick(buckets, random.randrange(size))
+                if id not in previous:
+                    return id, remaining
+
+        candidates = [id for ids, positions in buckets for id in ids
+                      if id not in previous]
+        if not candidates:
+            return None, 0
+        return random.choice(candidates), len(candidates)
+
+    def draw_near(self, category, previous, level, low=MIN_DIFFICULTY,
+                  high=MAX_DIFFICULTY):
+        # Draws at level, or at the closest level between low and high that
+        # still has questions. Returns (id, remaining, level), remaining is
+        # the number of eligible ids of that level.
+        for distance in range(high - low + 1):
+            for candidate in sorted({level - distance, level + distance}):
+                if low <= candidate <= high:
+                    id, remaining = self.draw(category, previous,
+                                              difficulties=(candidate,))
+                    if id is not None:
+                        return id, remaining, candidate
+        return None, 0, level
+
+    def draw_many(self, category=ALL, previous=(), count=1, seen=None,
+                  band=None, level=None):
+        # Up to count distinct random ids that are not in previous. band
+        # (low, high) limits their difficulty, with a level each one is drawn
+        # at the closest level of the band that has questions left. Returns
+        # the ids, the number of eligible ids before the draw and the level
+        # of the first one.
+        if count > 1:
+            previous = set(previous)
+            seen = None
+        ids = []
+        remaining, first_level = 0, level
+        for _ in range(count):
+            if level is not None:
+                id, left, drawn_level = self.draw_near(
+                    category, previous, level, *band)
+            else:
+                difficulties = range(band[0], band[1] + 1) if band else None
+                id, left = self.draw(category, previous, seen, difficulties)
+                drawn_level = None
+            if id is None:
+                break
+            if not ids:
+                remaining, first_level = left, drawn_level
+            ids.append(id)
+            if count > 1:
+                previous.add(id)
+        return ids, remaining, first_level
+
+    def add(self, id, category, difficulty=None):
+        self._change(_add, id, category, difficulty)
+
+    def remove(self, id, category=None):
+        self._change(_remove, id)
+
+    def _change(self, function, *args):
+        with self._lock:
+            if self._pending is not None:
+                self._pending.append((function, args))
+            if self._buckets is not None:
+                function(self._buckets, *args)
+
+    def invalidate(self, change=None):
+        if change is not None and change.table != 'questions':
+            return
+        if change is not None and change.action == 'insert':
+            self.add(change.id, change.category, change.difficulty)
+        elif change is not None and change.action == 'delete':
+            self.remove(change.id)
+        else:
+            # An update may have moved the question to another category
+            with self._lock:
+                self._buckets = None
+                if self._pending is not None:
+                    self._pending.append(None)
+
+    def _bucket(self, key):
+        buckets = self._buckets
+        if buckets is None:
+            buckets = self._load()
+        if not isinstance(key, tuple):
+            key = _category_key(key)
+        return buckets.get(key, (array('l'), {}))
+
+    def begin_load(self):
+        # The changes made from now on are applied again to the buckets of
+        # the next load(), whose rows may have been read before them
+        with self._lock:
+            if self._pending is None:
+                self._pending = []
+
+    def load(self, rows):
+        # Replaces the pool with the (id, category, difficulty) rows
+        self.begin_load()
+        buckets = {ALL: (array('l'), {})}
+        try:
+            for id, category, difficulty in rows:
+                for key in _keys(category, difficulty):
+                    ids, positions = buckets.setdefault(key, (array('l'), {}))
+                    positions[id] = len(ids)
+                    ids.append(id)
+        except Exception:
+            with self._lock:
+                self._pending = None
+            raise
+        with self._lock:
+            current = buckets
+            for change in self._pending:
+                if change is None:
+                    # Dropped meanwhile, the next draw loads it again
+                    current = None
+                else:
+                    function, args = change
+                    function(buckets, *args)
+            self._pending = None
+            self._buckets = current
+        return buckets
+
+    def _load(self):
+        # From the primary, a replica may not have the questions added to
+        # the pool since
+        self.begin_load()
+        with on_primary():
+            rows = db.session.query(Question.id, Question.category,
+                                    Question.difficulty).all()
+        return self.load(rows)
+
+
+def _add(buckets, id, category, difficulty):
+    for key in _keys(category, difficulty):
+        ids, positions = buckets.setdefault(key, (array('l'), {}))
+        if id not in positions:
+            positions[id] = len(ids)
+            ids.append(id)
+
+
+def _remove(buckets, id):
+    for ids, positions in buckets.values():
+        index = positions.pop(id, None)
+        if index is None:
+            continue
+        # Swap with the last id so removal is O(1):
+        last = ids.pop()
+        if last != id:
+            ids[index] = last
+            positions[last] = index
+
+
+def _category_key(category):
+    return int(category) if category is not None else None
+
+
+def _keys(category, difficulty):
+    category = _category_key(category)
+    keys = [ALL, category]
+    if difficulty is not None:
+        keys += [(ALL, int(difficulty)), (category, int(difficulty))]
+    return keys
+
+
+def _pick(buckets, index):
+    # The id at index of the buckets put end to end
+    for ids, positions in buckets:
+        if index < len(ids):
+            return ids[index]
+        index -= len(ids)
+
+
+def difficulty_band(value):
+    # (low, high) from a level or a {"min": low, "max": high} band, raises
+    # ValueError for anything else
+    if isinstance(value, dict):
+        low = int(value.get('min', MIN_DIFFICULTY))
+        high = int(value.get('max', MAX_DIFFICULTY))
+    else:
+        low = high = int(value)
+    if low > high:
+        raise ValueError('Empty difficulty band')
+    return max(low, MIN_DIFFICULTY), min(high, MAX_DIFFICULTY)
+
+
+def adaptive_difficulty(results, low=MIN_DIFFICULTY, high=MAX_DIFFICULTY,
+                        start=START_DIFFICULTY):
+    # Staircase: one level up after a right answer, one down after a wrong
+    # one, within low and high
+    level = min(max(start, low), high)
+    for correct in results:
+        level = min(level + 1, high) if correct else max(level - 1, low)
+    return level
+
+
+def requested_difficulty(body, adaptive=False):
+    # Optional difficulty of a /quizzes body or of a new quiz session:
+    # "difficulty" is a level or a band, "adaptive": true (sessions only,
+    # they keep the level) starts the level that follows the answers.
+    # Returns (band, level), both None when not asked for, and raises
+    # ValueError when they are invalid.
+    band = None
+    if body.get('difficulty') is not None:
+        band = difficulty_band(body['difficulty'])
+    if not body.get('adaptive'):
+        return band, None
+    if not adaptive:
+        raise ValueError('Adaptive quizzes need a quiz session')
+    band = band or (MIN_DIFFICULTY, MAX_DIFFICULTY)
+    return band, adaptive_difficulty([], *band)
+
+
+pool = QuestionPool()
+on_change(pool.invalidate)
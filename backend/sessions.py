@@ -0,0 +1,188 @@
+import secrets
+import struct
+import threading
+import time
+from array import array
+from bisect import bisect_left
+from collections import OrderedDict
+
+from selection import adaptive_difficulty
+
+'''
+Quiz sessions
+    Server-side state of a quiz being played, so clients only send the
+    session id instead of the whole list of previous questions. An adaptive
+    session also keeps the level of the player: it moves with the answers
+    to the last question asked, checked by POST /quizzes/answers.
+'''
+
+DEFAULT_TTL = 30 * 60
+# category, question asked, band (low, high) and level, 0 for none
+HEADER = struct.Struct('!iiBBB')
+
+
+class QuizSession:
+    # Played question ids are kept in a sorted array (8 bytes per question)
+
+    def __init__(self, category, id=None, played=None, band=None,
+                 level=None, asked=None):
+        self.id = id or secrets.token_urlsafe(16)
+        self.category = category
+        self.played = played if played is not None else array('l')
+        # (low, high) difficulties of the questions drawn, None for any
+        self.band = band
+        # Level of an adaptive quiz, None otherwise
+        self.level = level
+        # Question whose answer moves the level, None once answered
+        self.asked = asked
+
+    def __contains__(self, question_id):
+        index = bisect_left(self.played, question_id)
+        return index < len(self.played) and self.played[index] == question_id
+
+    def __len__(self):
+        return len(self.played)
+
+    def __iter__(self):
+        return iter(self.played)
+
+    def add(self, question_id):
+        index = bisect_left(self.played, question_id)
+        if index == len(self.played) or self.played[index] != question_id:
+            self.played.insert(index, question_id)
+
+    def answer(self, question_id, correct):
+        # Moves the level of an adaptive quiz one up after a right answer to
+        # the question asked, one down after a wrong one. Returns True if it
+        # was that question.
+        if self.level is None or question_id != self.asked:
+            return False
+        self.level = adaptive_difficulty([correct], *self.band,
+                                         start=self.level)
+        self.asked = None
+        return True
+
+    def dumps(self):
+        low, high = self.band or (0, 0)
+        return HEADER.pack(self.category, self.asked or 0, low, high,
+                           self.level or 0) + self.played.tobytes()
+
+    @classmethod
+    def loads(cls, id, data):
+        category, asked, low, high, level = HEADER.unpack_from(data)
+        played = array('l')
+        played.frombytes(data[HEADER.size:])
+        return cls(category, id, played, (low, high) if low else None,
+                   level or None, asked or None)
+
+    def format(self):
+        return {
+            'session_id': self.id,
+            'quiz_category': self.category,
+            'played': len(self.played),
+            'difficulty': self.level
+        }
+
+
+'''
+Session stores
+    get(id) returns the QuizSession or None if unknown/expired, save(session)
+    (re)starts its TTL and delete(id) drops it.
+'''
+
+
+class MemorySessionStore:
+
+    def __init__(self, ttl=DEFAULT_TTL):
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        # id -> (expires, session), ordered by expiration time
+        self._sessions = OrderedDict()
+
+    def get(self, id):
+        with self._lock:
+            self._evict()
+            entry = self._sessions.get(id)
+        return entry[1] if entry is not None else None
+
+    def save(self, session):
+        with self._lock:
+            self._sessions[session.id] = (time.time() + self.ttl, session)
+            self._sessions.move_to_end(session.id)
+            self._evict()
+
+    def delete(self, id):
+        with self._lock:
+            self._sessions.pop(id, None)
+
+    def _evict(self):
+        now = time.time()
+        while self._sessions:
+            id, (expires, session) = next(iter(self._sessions.items()))
+            if expires > now:
+                break
+            del self._sessions[id]
+
+
+class RedisSessionStore:
+    # Works with a redis.Redis client or any object with the same
+    # get/set/delete methods, like LocalRedis
+
+    def __init__(self, client, ttl=DEFAULT_TTL, prefix='quiz-session:'):
+        self.client = client
+        self.ttl = ttl
+        self.prefix = prefix
+
+    def get(self, id):
+        data = self.client.get(self.prefix + id)
+        return QuizSession.loads(id, data) if data is not None else None
+
+    def save(self, session):
+        self.client.set(self.prefix + session.id, session.dumps(), ex=self.ttl)
+
+    def delete(self, id):
+        self.client.delete(self.prefix + id)
+
+
+class LocalRedis:
+    # In-process stand-in for the subset of the redis client used here
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._data = {}
+
+    def get(self, key):
+        with self._lock:
+            entry = self._data.get(key)
+            if entry is None:
+                return None
+            value, expires = entry
+            if expires is not None and expires <= time.time():
+                del self._data[key]
+                return None
+            return value
+
+    def set(self, key, value, ex=None):
+        expires = time.time() + ex if ex is not None else None
+        with self._lock:
+            self._data[key] = (value, expires)
+        return True
+
+    def delete(self, *keys):
+        with self._lock:
+            return sum(1 for key in keys if self._data.pop(key, None))
+
+
+def create_store(app):
+    # QUIZ_SESSION_STORE: 'memory' (default), 'local-redis' or 'redis'
+    kind = app.config.get('QUIZ_SESSION_STORE', 'memory')
+    ttl = app.config.get('QUIZ_SESSION_TTL', DEFAULT_TTL)
+    if kind == 'memory':
+        return MemorySessionStore(ttl)
+    if kind == 'local-redis':
+        return RedisSessionStore(LocalRedis(), ttl)
+    if kind == 'redis':
+        import redis
+        client = redis.Redis.from_url(app.config['REDIS_URL'])
+        return RedisSessionStore(client, ttl)
+    raise ValueError('Unknown QUIZ_SESSION_STORE: {}'.format(kind))
@@ -0,0 +1,75 @@
+import json
+
+from flask import Response, stream_with_context
+
+from models import Question, format_question_row
+from helpers import encode_cursor, decode_cursor
+
+'''
+Streaming JSON responses
+    The rows of a listing are fetched from a server-side cursor and encoded
+    one at a time, so the memory used by a request does not depend on how
+    many rows it returns.
+'''
+
+STREAM_BATCH_SIZE = 500
+
+
+class StreamedQuestions:
+    # Iterates over the formatted questions of a page, next_cursor is set
+    # once the iteration is done (None when there are no more questions).
+    # quantity is at least 1, None for every question.
+
+    def __init__(self, request, query, quantity=None):
+        if quantity is not None and quantity < 1:
+            raise ValueError('Invalid quantity')
+        query = query.with_entities(
+            Question.id, Question.question, Question.answer,
+            Question.category, Question.difficulty).order_by(Question.id)
+        cursor = request.args.get('cursor', None)
+        if cursor:
+            query = query.filter(Question.id > decode_cursor(cursor))
+        elif quantity is not None:
+            page = request.args.get('page', 1, type=int)
+            query = query.offset(max(page - 1, 0) * quantity)
+        if quantity is not None:
+            # One extra row tells if there is a next page
+            query = query.limit(quantity + 1)
+
+        self.quantity = quantity
+        self.next_cursor = None
+        self._rows = query.execution_options(
+            stream_results=True).yield_per(STREAM_BATCH_SIZE)
+
+    def __iter__(self):
+        count = 0
+        last_id = None
+        for row in self._rows:
+            if count == self.quantity:
+                self.next_cursor = encode_cursor(last_id)
+                break
+            yield format_question_row(row)
+            last_id = row[0]
+            count += 1
+
+
+def stream_json(envelope, key, items, tail=None):
+    # Yields the JSON of envelope with the items as a list under key,
+    # followed by the fields returned by tail() once the items are sent
+    head = json.dumps(envelope)[:-1]
+    yield head + (', ' if envelope else '') + json.dumps(key) + ': ['
+    separator = ''
+    for item in items:
+        yield separator + json.dumps(item)
+        separator = ', '
+    yield ']'
+    if tail is not None:
+        for name, value in tail().items():
+            yield ', ' + json.dumps(name) + ': ' + json.dumps(value)
+    yield '}'
+
+
+def json_stream_response(envelope, key, items, tail=None):
+    return Response(stream_with_context(stream_json(envelope, key, items,
+                                                    tail)),
+                    mimetype='application/json')
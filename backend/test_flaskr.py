@@ -1,10 +1,28 @@
 import os
+import tempfile
 import unittest
 import json
-from flask_sqlalchemy import SQLAlchemy
+import gzip
+import time
+import uuid
+
+from sqlalchemy import create_engine
+from flask import g
 
 from flaskr import create_app
-from models import setup_db, Question, Category
+from models import (db, Question, Score, AnsweredQuestion,
+                    ChangeLog, Change, QuestionHash)
+from leaderboard import Leaderboard
+from search import InvertedIndex
+from catalog import Catalog
+from change_bus import PollingBus
+from dedupe import scan, find_duplicates
+from bulk import import_questions
+from http_cache import versions
+from cache import category_question_ids
+from selection import QuestionPool, pool
+from config import TestingConfig
+import migrations
 
 
 class TriviaTestCase(unittest.TestCase):
@@ -12,19 +30,15 @@ class TriviaTestCase(unittest.TestCase):
 
     def setUp(self):
         """Define test variables and initialize app."""
-        self.app = create_app()
+        self.app = create_app(TestingConfig)
         self.client = self.app.test_client
-        self.database_name = "trivia_test"
-        self.database_path = "postgres://postgres:postgres@{}/{}".format(
-            'localhost:5433', self.database_name)
-        setup_db(self.app, self.database_path)
+        self.database_path = self.app.config['SQLALCHEMY_DATABASE_URI']
 
         # binds the app to the current context
         with self.app.app_context():
-            self.db = SQLAlchemy()
-            self.db.init_app(self.app)
+            self.db = db
             # create all tables
-            self.db.create_all()
+            migrations.upgrade(db.engine)
 
     def tearDown(self):
         """Executed after reach test"""
@@ -34,6 +48,58 @@ class TriviaTestCase(unittest.TestCase):
     Write at least one test for each test for successful operation and for expected errors.
     """
 
+    def test_index_totals_follow_inserts(self):
+        """the cached totals of / are refreshed after a question is created"""
+        res = self.client().get('/')
+        before = json.loads(res.data)
+        self.assertEqual(res.status_code, 200)
+        self.assertTrue(before['total_categories'])
+
+        # Unique text, the duplicates of an earlier run would be refused
+        new_question = {'question': "counted question " + uuid.uuid4().hex,
+                        'answer': 'answer', 'difficulty': 1, 'category': 1}
+        res = self.client().post('/questions', json=new_question)
+        created = json.loads(res.data)['question_created']
+        after = json.loads(self.client().get('/').data)
+
+        self.assertEqual(after['total_questions'],
+                         before['total_questions'] + 1)
+        self.client().delete('/questions/{}'.format(created))
+
+    def test_metrics(self):
+        """counts the queries of each endpoint and sends Server-Timing"""
+        res = self.client().get('/categories')
+        self.assertIn('desc="', res.headers['Server-Timing'])
+
+        res = self.client().get('/metrics')
+        text = res.data.decode()
+
+        self.assertEqual(res.status_code, 200)
+        self.assertIn('trivia_requests_total{endpoint="/categories",'
+                      'method="GET",status="200"}', text)
+        self.assertIn('trivia_db_queries_total{endpoint="/categories"', text)
+
+    def test_conditional_get(self):
+        """answers If-None-Match with 304 until the listing changes"""
+        res = self.client().get('/categories/1/questions')
+        etag = res.headers['ETag']
+        self.assertEqual(res.headers['Cache-Control'], 'public, no-cache')
+
+        res = self.client().get('/categories/1/questions',
+                                headers={'If-None-Match': etag})
+        self.assertEqual(res.status_code, 304)
+        self.assertEqual(res.data, b'')
+
+        with self.app.app_context():
+            question = Question('Conditional?', 'Yes', 1, 1)
+            question.insert()
+        res = self.client().get('/categories/1/questions',
+                                headers={'If-None-Match': etag})
+        with self.app.app_context():
+            question.delete()
+        self.assertEqual(res.status_code, 200)
+        self.assertNotEqual(res.headers['ETag'], etag)
+
     def test_get_categories(self):
         """" gets categories using /categories endpoint"""
         res = self.client().get('/categories')
@@ -43,6 +109,32 @@ class TriviaTestCase(unittest.TestCase):
         self.assertEqual(data['success'], True)
         self.assertTrue(len(data['categories']))
 
+    def test_cache_stats(self):
+        """repeated category reads are served from the cache"""
+        self.client().get('/categories')
+        self.client().get('/categories')
+        res = self.client().get('/cache')
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 200)
+        stats = {cache['name']: cache for cache in data['caches']}
+        self.assertTrue(stats['categories']['hits'])
+
+    def test_cache_drops_loads_overtaken_by_changes(self):
+        """a value loaded before an invalidation is not cached"""
+        def stale_loader():
+            # A change is committed while the value is being read
+            category_question_ids.invalidate(-1)
+            return [1]
+
+        self.assertEqual(
+            category_question_ids.get_or_load(-1, stale_loader), [1])
+        self.assertIsNone(category_question_ids.get(-1))
+        self.assertEqual(
+            category_question_ids.get_or_load(-1, lambda: [2]), [2])
+        self.assertEqual(category_question_ids.get(-1), [2])
+        category_question_ids.invalidate(-1)
+
     def test_get_questions_no_page(self):
         """" gets questions using /questions endpoint without a page argument"""
         res = self.client().get('/questions')
@@ -65,6 +157,54 @@ class TriviaTestCase(unittest.TestCase):
         self.assertTrue(len(data['list_of_questions']))
         self.assertTrue(len(data['categories']))
 
+    def test_get_questions_with_cursor(self):
+        """follows the next_cursor of the first page to get the second one"""
+        res = self.client().get('/questions')
+        first_page = json.loads(res.data)
+        self.assertTrue(first_page['next_cursor'])
+
+        res = self.client().get(
+            '/questions?cursor=' + first_page['next_cursor'])
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(data['success'], True)
+        self.assertTrue(len(data['list_of_questions']))
+        self.assertGreater(data['list_of_questions'][0]['id'],
+                           first_page['list_of_questions'][-1]['id'])
+
+    def test_get_questions_invalid_cursor(self):
+        """requests a page with a cursor that was not given by the api"""
+        res = self.client().get('/questions?cursor=notacursor')
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 400)
+        self.assertEqual(data['success'], False)
+
+    def test_get_questions_streamed(self):
+        """streams every question when no per_page is given"""
+        res = self.client().get('/questions?stream=true')
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(data['success'], True)
+        self.assertEqual(len(data['list_of_questions']),
+                         data['total_questions'])
+        self.assertEqual(data['next_cursor'], None)
+
+        res = self.client().get('/questions?stream=true&per_page=2')
+        data = json.loads(res.data)
+        self.assertEqual(len(data['list_of_questions']), 2)
+        self.assertTrue(data['next_cursor'])
+
+        res = self.client().get('/questions?stream=true&per_page=0')
+        data = json.loads(res.data)
+        self.assertEqual(data['items_per_page'], 1)
+        self.assertEqual(len(data['list_of_questions']), 1)
+        res = self.client().get('/questions?stream=true&per_page=1&cursor='
+                                + data['next_cursor'])
+        self.assertEqual(res.status_code, 200)
+
     def test_get_questions404(self):
         """requests a page beyond the range of pages"""
         res = self.client().get('/questions?page=10000')
@@ -88,8 +228,9 @@ class TriviaTestCase(unittest.TestCase):
         self.assertEqual(res.status_code, 200)
         self.assertEqual(data['success'], True)
         self.assertEqual(data['question_created'], inserted_question.id)
+        self.assertEqual(data['question']['id'], inserted_question.id)
         self.assertTrue(data['total_questions'])
-        self.assertTrue(len(data['questions']))
+        self.assertNotIn('questions', data)
 
         # 2) request creation with no question provided
         new_question = {'answer': 'answer', 'difficulty': 1, 'category': 1}
@@ -138,10 +279,55 @@ class TriviaTestCase(unittest.TestCase):
         self.assertEqual(res.status_code, 200)
         self.assertEqual(data['success'], True)
         self.assertEqual(data['question_deleted'], question_id)
-        self.assertTrue(len(data['questions']))
+        self.assertEqual(data['question']['id'], question_id)
         self.assertTrue(data['total_questions'])
         self.assertEqual(question, None)
 
+    def test_delete_question_return_page(self):
+        """deletes a question and gets the first page back"""
+        new_question = {'question': "question to delete",
+                        'answer': 'answer', 'difficulty': 1, 'category': 1}
+        res = self.client().post('/questions', json=new_question)
+        question_id = json.loads(res.data)['question_created']
+
+        res = self.client().delete(
+            '/questions/{}?return=page'.format(question_id))
+        data = json.loads(res.data)
+        self.assertEqual(res.status_code, 200)
+        self.assertTrue(len(data['questions']))
+        self.assertNotIn(question_id, [q['id'] for q in data['questions']])
+
+    def test_batch_insert_and_delete(self):
+        """creates and deletes several questions in one request each"""
+        new_questions = [{'question': "batch question {}".format(i),
+                          'answer': 'answer', 'difficulty': 1, 'category': 2}
+                         for i in range(3)]
+        res = self.client().post('/questions/batch',
+                                 json={'questions': new_questions})
+        data = json.loads(res.data)
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(len(data['questions_created']), 3)
+
+        ids = data['questions_created']
+        res = self.client().delete('/questions/batch',
+                                   json={'ids': ids + [123456]})
+        data = json.loads(res.data)
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(sorted(data['questions_deleted']), sorted(ids))
+        self.assertEqual(data['not_found'], [123456])
+        self.assertEqual(Question.query.filter(
+            Question.id.in_(ids)).count(), 0)
+
+    def test_batch_insert422(self):
+        """a batch with an incomplete question creates nothing"""
+        res = self.client().post('/questions/batch', json={
+            'questions': [{'question': 'complete', 'answer': 'answer',
+                           'difficulty': 1, 'category': 2},
+                          {'question': 'no answer'}]})
+        data = json.loads(res.data)
+        self.assertEqual(res.status_code, 422)
+        self.assertEqual(data['success'], False)
+
     def test_delete_question404(self):
         """request a delete with unknown id"""
         res = self.client().delete('/questions/12233')
@@ -169,6 +355,636 @@ class TriviaTestCase(unittest.TestCase):
         self.assertEqual(data['total_questions'], 0)
         self.assertEqual(len(data['questions']), 0)
 
+    def test_play_quiz_skips_previous_questions(self):
+        """draws a quiz question of a category that was not played yet"""
+        category_questions = Question.query.filter(
+            Question.category == 1).all()
+        previous = [q.id for q in category_questions[1:]]
+        res = self.client().post('/quizzes', json={
+            'previous_questions': previous,
+            'quiz_category': {'type': 'Science', 'id': 1}})
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(data['success'], True)
+        self.assertEqual(data['question']['id'], category_questions[0].id)
+        self.assertEqual(data['total_questions'], 1)
+
+    def test_play_quiz_all_played(self):
+        """returns no question once every question was played"""
+        previous = [q.id for q in Question.query.all()]
+        res = self.client().post('/quizzes', json={
+            'previous_questions': previous,
+            'quiz_category': {'type': 'click', 'id': 0}})
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(data['question'], None)
+        self.assertEqual(data['total_questions'], 0)
+
+    def test_play_quiz_difficulty_band(self):
+        """only draws questions within the requested difficulty band"""
+        res = self.client().post('/quizzes', json={
+            'previous_questions': [],
+            'quiz_category': {'type': 'click', 'id': 0},
+            'difficulty': {'min': 3, 'max': 3}})
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(data['question']['difficulty'], 3)
+        self.assertEqual(data['total_questions'], Question.query.filter(
+            Question.difficulty == 3).count())
+
+    def test_play_quiz_adaptive(self):
+        """ramps the difficulty of a session up after right answers"""
+        res = self.client().post('/quizzes/sessions', json={
+            'quiz_category': {'type': 'click', 'id': 0},
+            'adaptive': True})
+        session_id = json.loads(res.data)['session_id']
+        player = 'player-' + uuid.uuid4().hex[:8]
+        levels = []
+        for _ in range(2):
+            res = self.client().post(
+                '/quizzes/sessions/{}/next'.format(session_id))
+            question = json.loads(res.data)['question']
+            levels.append(question['difficulty'])
+            answer = {'player': player, 'question_id': question['id'],
+                      'answer': question['answer'],
+                      'session_id': session_id}
+            data = json.loads(self.client().post(
+                '/quizzes/answers', json=answer).data)
+            # Only the first answer to the question asked counts
+            again = json.loads(self.client().post(
+                '/quizzes/answers', json=answer).data)
+            self.assertEqual(data['difficulty'], levels[-1] + 1)
+            self.assertEqual(again['difficulty'], levels[-1] + 1)
+
+        self.assertEqual(levels, [2, 3])
+        # The stateless route does not trust results sent by the client
+        res = self.client().post('/quizzes', json={
+            'previous_questions': [],
+            'quiz_category': {'type': 'click', 'id': 0},
+            'adaptive': True,
+            'previous_results': [True, True]})
+        self.assertEqual(res.status_code, 400)
+        with self.app.app_context():
+            AnsweredQuestion.query.filter_by(player=player).delete()
+            db.session.commit()
+
+    def test_play_quiz_batch(self):
+        """draws several distinct questions in one call"""
+        res = self.client().post('/quizzes', json={
+            'previous_questions': [],
+            'quiz_category': {'type': 'click', 'id': 0},
+            'count': 5})
+        data = json.loads(res.data)
+        ids = [question['id'] for question in data['questions']]
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(len(set(ids)), 5)
+        self.assertEqual(data['question']['id'], ids[0])
+        self.assertEqual(data['total_questions'], Question.query.count())
+
+    def test_play_quiz_batch400(self):
+        """rejects a count above the limit"""
+        res = self.client().post('/quizzes', json={
+            'previous_questions': [],
+            'quiz_category': {'type': 'click', 'id': 0},
+            'count': 1000})
+
+        self.assertEqual(res.status_code, 400)
+
+    def test_rate_limited_search(self):
+        """refuses searches with 429 once the client's bucket is empty"""
+        class LimitedConfig(TestingConfig):
+            RATE_LIMITS = {'search': (0.01, 2)}
+            API_KEYS = ['another-client']
+
+        client = create_app(LimitedConfig).test_client()
+        statuses = [client.post('/questions?search=title').status_code
+                    for _ in range(3)]
+        res = client.post('/questions?search=title')
+        data = json.loads(res.data)
+
+        self.assertEqual(statuses, [200, 200, 429])
+        self.assertEqual(data['error'], 429)
+        self.assertTrue(int(res.headers['Retry-After']) > 0)
+        # An unknown key does not give a new bucket
+        res = client.post('/questions?search=title',
+                          headers={'X-API-Key': 'made-up-key'})
+        self.assertEqual(res.status_code, 429)
+        res = client.post('/questions?search=title',
+                          headers={'X-API-Key': 'another-client'})
+        self.assertEqual(res.status_code, 200)
+
+        # Behind a proxy, each client has the bucket of its own address
+        class ProxiedConfig(LimitedConfig):
+            TRUSTED_PROXIES = 1
+
+        client = create_app(ProxiedConfig).test_client()
+        statuses = [client.post('/questions?search=title', headers={
+            'X-Forwarded-For': address}).status_code
+            for address in ('10.0.0.1', '10.0.0.1', '10.0.0.1', '10.0.0.2')]
+        self.assertEqual(statuses, [200, 200, 429, 200])
+
+    def test_quiz_session(self):
+        """plays a whole category with a quiz session"""
+        res = self.client().post('/quizzes/sessions', json={
+            'quiz_category': {'type': 'Science', 'id': 1}})
+        data = json.loads(res.data)
+        self.assertEqual(res.status_code, 200)
+        session_id = data['session_id']
+        total = data['total_questions']
+
+        played = set()
+        for _ in range(total):
+            res = self.client().post(
+                '/quizzes/sessions/{}/next'.format(session_id))
+            data = json.loads(res.data)
+            self.assertEqual(res.status_code, 200)
+            self.assertNotIn(data['question']['id'], played)
+            played.add(data['question']['id'])
+
+        res = self.client().post(
+            '/quizzes/sessions/{}/next'.format(session_id))
+        self.assertEqual(json.loads(res.data)['question'], None)
+
+        res = self.client().delete('/quizzes/sessions/' + session_id)
+        data = json.loads(res.data)
+        self.assertEqual(data['total_played'], total)
+
+    def test_quiz_session404(self):
+        """asks the next question of an unknown session"""
+        res = self.client().post('/quizzes/sessions/unknown/next')
+        data = json.loads(res.data)
+        self.assertEqual(res.status_code, 404)
+        self.assertEqual(data['success'], False)
+
+    def test_answer_question(self):
+        """answers are checked on the server and scored once"""
+        with self.app.app_context():
+            question = Question('Who sang Let It Be?', 'The Beatles', 1, 3)
+            question.insert()
+            question_id = question.id
+        player = 'player-' + uuid.uuid4().hex[:8]
+        answer = {'player': player, 'question_id': question_id,
+                  'answer': ' beatles!'}
+
+        res = self.client().post('/quizzes/answers', json=answer)
+        data = json.loads(res.data)
+        again = json.loads(
+            self.client().post('/quizzes/answers', json=answer).data)
+        entry = json.loads(self.client().get('/leaderboard/' + player).data)
+        top = json.loads(self.client().get('/leaderboard?limit=5').data)
+
+        self.assertEqual(res.status_code, 200)
+        self.assertTrue(data['correct'])
+        self.assertEqual(data['points'], 3)
+        self.assertEqual(data['score'], 3)
+        self.assertEqual(again['points'], 0)
+        self.assertEqual(entry['score'], 3)
+        self.assertEqual(entry['answers'], 1)
+        self.assertEqual(entry['rank'], data['rank'])
+        self.assertLessEqual(len(top['leaderboard']), 5)
+        self.assertTrue(top['total_players'])
+        with self.app.app_context():
+            # Two workers, or one restarted: the second takes the points
+            # back when its flush finds the answer in the database
+            other = player + '-2'
+            first, second = Leaderboard(), Leaderboard()
+            first.record(other, question_id, True, 3)
+            first.flush()
+            second.record(other, question_id, True, 3)
+            self.assertEqual(second.player(other)['score'], 6)
+            self.assertEqual(second.flush(), 0)
+            self.assertEqual(second.player(other)['score'], 3)
+            self.assertEqual(second.player(other)['answers'], 1)
+            self.assertEqual(Score.query.get(other).score, 3)
+            Score.query.filter_by(player=other).delete()
+            AnsweredQuestion.query.filter(
+                AnsweredQuestion.player.in_([player, other])).delete(
+                    synchronize_session=False)
+            db.session.commit()
+        self.client().delete('/questions/{}'.format(question_id))
+
+    def test_answer_question400(self):
+        """answers without a player, or to an unknown question"""
+        res = self.client().post('/quizzes/answers', json={
+            'question_id': 1, 'answer': 'x'})
+        self.assertEqual(res.status_code, 400)
+        res = self.client().post('/quizzes/answers', json={
+            'player': 'nobody', 'question_id': 999999, 'answer': 'x'})
+        self.assertEqual(res.status_code, 404)
+        res = self.client().get('/leaderboard/' + uuid.uuid4().hex)
+        self.assertEqual(res.status_code, 404)
+
+    def test_leaderboard_flush(self):
+        """buffered scores are added to the scores table in one batch"""
+        player = 'player-' + uuid.uuid4().hex[:8]
+        with self.app.app_context():
+            leaderboard = Leaderboard()
+            leaderboard.record(player, 1, True, 2)
+            leaderboard.record(player, 2, False, 5)
+            self.assertEqual(leaderboard.flush(), 1)
+            leaderboard.record(player, 3, True, 1)
+            leaderboard.flush()
+            score = Score.query.get(player)
+
+            self.assertEqual((score.score, score.answers, score.correct),
+                             (3, 3, 2))
+            self.assertEqual(leaderboard.player(player)['score'], 3)
+            db.session.delete(score)
+            AnsweredQuestion.query.filter_by(player=player).delete()
+            db.session.commit()
+
+    def test_polling_change_bus(self):
+        """changes logged by another worker are applied, ours are not"""
+        with self.app.app_context():
+            bus = PollingBus(self.app)
+            bus.poll()
+            bus.publish([Change('questions', 'update', 1, 1, 1)])
+            self.assertEqual(bus.poll(), 0)
+
+            def log(id=None):
+                db.session.add(ChangeLog(
+                    id=id, origin='another-worker', table_name='questions',
+                    action='delete', row_id=999999, category=1,
+                    difficulty=1, created_at=time.time()))
+                db.session.commit()
+
+            etag = versions.etag('questions')
+            log()
+            self.assertEqual(bus.poll(), 1)
+            self.assertNotEqual(versions.etag('questions'), etag)
+
+            # An id committed after a higher one is still applied, without
+            # reloading everything
+            last_id = bus.last_id
+            log(last_id + 2)
+            self.assertEqual(bus.poll(), 1)
+            log(last_id + 1)
+            self.assertEqual(bus.poll(), 1)
+            self.assertEqual(bus.reloads, 0)
+
+            # Rows pruned before they were seen
+            log(last_id + 4)
+            ChangeLog.query.filter(ChangeLog.id < last_id + 4).delete()
+            db.session.commit()
+            bus.last_id = last_id + 2
+            bus.poll()
+            self.assertEqual(bus.reloads, 1)
+
+    def test_search_question_filters(self):
+        """searches by word prefix, inside a category and in the answers"""
+        res = self.client().post('/questions?search=socc')
+        data = json.loads(res.data)
+        self.assertEqual(res.status_code, 200)
+        self.assertTrue(data['total_questions'])
+        self.assertTrue(all('soccer' in q['question'].lower()
+                            for q in data['questions']))
+
+        res = self.client().post('/questions?search=soccer&category=1')
+        self.assertEqual(json.loads(res.data)['total_questions'], 0)
+
+        res = self.client().post('/questions?search=scarab&answers=true')
+        data = json.loads(res.data)
+        self.assertEqual(data['questions'][0]['answer'], 'Scarab')
+
+    def test_import_and_export_questions(self):
+        """imports a JSON Lines bank, skipping the invalid rows"""
+        run = uuid.uuid4().hex
+        texts = ['imported {} {}'.format(i, run) for i in range(3)]
+        lines = [json.dumps({'question': text, 'answer': 'answer',
+                             'category': 3, 'difficulty': 2})
+                 for text in texts]
+        lines.append(json.dumps({'question': 'no answer', 'category': 3}))
+        res = self.client().post('/questions/import?format=jsonl',
+                                 data='\n'.join(lines))
+        data = json.loads(res.data)
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(data['imported'], 3)
+        self.assertEqual(data['rejected'], 1)
+        self.assertEqual(data['errors'][0]['row'], 4)
+
+        res = self.client().get('/questions/export?format=csv')
+        rows = res.data.decode().splitlines()
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(rows[0], 'id,question,answer,category,difficulty')
+        self.assertEqual(len(rows) - 1, Question.query.count())
+
+        with self.app.app_context():
+            Question.delete_many([question.id for question in
+                                  Question.query.filter(
+                                      Question.question.in_(texts))])
+
+    def test_duplicate_questions(self):
+        """exact duplicates are refused or skipped, near ones reported"""
+        text = 'Which planet of the solar system is known as the Red Planet?'
+        near = 'Which planet in the solar system is known as the Red Planet?'
+        question = {'question': text, 'answer': 'Mars', 'difficulty': 1,
+                    'category': 1}
+        res = self.client().post('/questions?force=true', json=question)
+        first = json.loads(res.data)['question_created']
+
+        question['question'] = '  which PLANET of the solar system is ' \
+            'known as the red planet!! '
+        res = self.client().post('/questions', json=question)
+        data = json.loads(res.data)
+        self.assertEqual(res.status_code, 409)
+        self.assertIn(first, data['duplicates'])
+
+        question['question'] = near
+        res = self.client().post('/questions', json=question)
+        data = json.loads(res.data)
+        second = data['question_created']
+        self.assertEqual(res.status_code, 200)
+        self.assertIn(first, data['similar_questions'])
+
+        lines = [json.dumps(dict(question, question=question_text))
+                 for question_text in (text, 'Dedupe import only', near,
+                                       'dedupe import only!')]
+        res = self.client().post('/questions/import?format=jsonl',
+                                 data='\n'.join(lines))
+        data = json.loads(res.data)
+        self.assertEqual(data['imported'], 1)
+        self.assertEqual(data['duplicates'], 3)
+
+        with self.app.app_context():
+            imported = Question.query.filter(
+                Question.question == 'Dedupe import only').first().id
+            pairs = [(id, other) for id, other, score, exact in scan()]
+            self.assertIn((first, second), pairs)
+            Question.delete_many([first, second, imported])
+
+    def test_duplicates_across_batches_and_candidates(self):
+        """exact duplicates are found past the candidate cap and batches"""
+        import dedupe
+        text = 'Which batch holds the duplicate? ' + uuid.uuid4().hex
+        rows = [{'question': text, 'answer': 'The first', 'category': 1,
+                 'difficulty': 1}] * 3
+        with self.app.app_context():
+            result = import_questions(rows, batch_size=1)
+            self.assertEqual((result['imported'], result['duplicates']),
+                             (1, 2))
+
+            limit, dedupe.MAX_CANDIDATES = dedupe.MAX_CANDIDATES, 0
+            try:
+                duplicates = find_duplicates(text)
+            finally:
+                dedupe.MAX_CANDIDATES = limit
+            self.assertEqual(len(duplicates), 1)
+            self.assertTrue(duplicates[0]['exact'])
+            Question.delete_many([duplicates[0]['id']])
+
+    def explain(self, query):
+        """returns the query plan of a query, without sequential scans"""
+        if db.engine.dialect.name != 'postgresql':
+            self.skipTest('the query plans are checked on PostgreSQL')
+        db.session.execute('SET enable_seqscan = off')
+        plan = db.session.execute('EXPLAIN ' + query).fetchall()
+        db.session.rollback()
+        return '\n'.join(row[0] for row in plan)
+
+    def test_upgrade_fingerprints_existing_questions(self):
+        """questions written before the duplicate index are fingerprinted"""
+        text = 'Which ocean lies between Africa and Australia?'
+        with self.app.app_context():
+            question = Question(text, 'Indian', 3, 2)
+            question.insert()
+            QuestionHash.remove([question.id])
+            db.session.commit()
+            self.assertEqual(find_duplicates(text), [])
+
+            with db.engine.begin() as connection:
+                migrations.fingerprint_questions(connection)
+            self.assertEqual([duplicate['id'] for duplicate in
+                              find_duplicates(text)], [question.id])
+            question.delete()
+
+    def test_category_listing_uses_index(self):
+        """the sorted ids of a category are read from (category, id)"""
+        plan = self.explain('SELECT id FROM questions WHERE category = 1 '
+                            'ORDER BY id')
+        self.assertIn('ix_questions_category_id', plan)
+        self.assertNotIn('Sort', plan)
+
+    def test_category_difficulty_uses_index(self):
+        """quizzes filtered by category and difficulty use an index"""
+        plan = self.explain('SELECT id FROM questions WHERE category = 1 '
+                            'AND difficulty BETWEEN 2 AND 3')
+        self.assertIn('ix_questions_category_difficulty', plan)
+
+    def test_schema_is_up_to_date(self):
+        """every migration was applied"""
+        with db.engine.connect() as connection:
+            self.assertEqual(migrations.current_version(connection),
+                             migrations.MIGRATIONS[-1][0])
+
+    def test_async_app_matches_flask_listing(self):
+        """the ASGI app returns the same questions page and quiz draws"""
+        from starlette.testclient import TestClient
+        from asgi import create_asgi_app
+
+        expected = json.loads(self.client().get('/questions?page=2').data)
+        app = create_asgi_app({'SQLALCHEMY_DATABASE_URI': self.database_path,
+                               'ASYNC_RELOAD_INTERVAL': 0})
+        with TestClient(app) as client:
+            res = client.get('/questions?page=2')
+            data = res.json()
+            previous = [q.id for q in Question.query.all()]
+            quiz = client.post('/quizzes', json={
+                'previous_questions': previous,
+                'quiz_category': {'type': 'click', 'id': 0}}).json()
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(data['list_of_questions'],
+                         expected['list_of_questions'])
+        self.assertEqual(data['total_questions'], expected['total_questions'])
+        self.assertEqual(quiz['question'], None)
+
+    def test_benchmark_reports_route_stats(self):
+        """the benchmark drives a route and compares it to a baseline"""
+        import benchmark
+
+        with self.app.app_context():
+            driver = benchmark.TestClientDriver(self.app)
+            stats = benchmark.run_route(driver, 'categories', 10, 2,
+                                        Question.query.count(), (1, 2), 1)
+        self.assertEqual(stats['requests'], 10)
+        self.assertEqual(stats['errors'], 0)
+        self.assertLessEqual(stats['p50_ms'], stats['p99_ms'])
+
+        slower = dict(stats, p95_ms=stats['p95_ms'] * 2)
+        regressions = benchmark.compare({'routes': {'categories': slower}},
+                                        {'routes': {'categories': stats}})
+        self.assertEqual(regressions[0]['route'], 'categories')
+        # Not a baseline: fast, but every request failed
+        broken = dict(stats, errors=stats['requests'])
+        self.assertEqual(benchmark.compare({'routes': {'categories': slower}},
+                                           {'routes': {'categories': broken}}),
+                         [])
+        self.assertTrue(benchmark.is_error(404))
+        self.assertFalse(benchmark.is_error(304))
+
+    def test_catalog_serves_reads_without_queries(self):
+        """the catalog mode returns the same listings with no queries"""
+        class CatalogConfig(TestingConfig):
+            QUESTION_CATALOG = True
+            CATALOG_RELOAD_INTERVAL = 0
+
+        expected = json.loads(
+            self.client().get('/categories/1/questions').data)
+        client = create_app(CatalogConfig).test_client()
+        client.get('/')
+        res = client.get('/categories/1/questions')
+        data = json.loads(res.data)
+
+        self.assertEqual(data, expected)
+        self.assertIn('desc="0 queries"', res.headers['Server-Timing'])
+        res = client.post('/quizzes', json={
+            'previous_questions': [],
+            'quiz_category': {'type': 'Science', 'id': 1}})
+        self.assertIn('desc="0 queries"', res.headers['Server-Timing'])
+
+    def test_catalog_applies_batches(self):
+        """a batch of changes is applied to the catalog at once"""
+        catalog = Catalog()
+        catalog.load([(1, 'One', 'A', 1, 1), (3, 'Three', 'C', 2, 1)], [])
+        catalog.apply([(2, 'Two', 'B', 2, 300), (3, 'Three', 'C', 1, 2)],
+                      [1, 4])
+
+        self.assertEqual(list(catalog.ids()), [2, 3])
+        self.assertEqual(list(catalog.ids(1)), [3])
+        self.assertEqual(list(catalog.ids(2)), [2])
+        self.assertEqual(catalog.questions([1, 2, 3]), [
+            {'id': 2, 'question': 'Two', 'answer': 'B', 'category': 2,
+             'difficulty': 300},
+            {'id': 3, 'question': 'Three', 'answer': 'C', 'category': 1,
+             'difficulty': 2}])
+
+    def test_reload_keeps_changes_made_meanwhile(self):
+        """a reload serves the old data and replays the changes it missed"""
+        index = InvertedIndex()
+        index.load([(1, 'Old question', 'Old', 1)])
+        quiz_pool = QuestionPool()
+        quiz_pool.load([(1, 1, 1)])
+
+        def index_rows():
+            # Read before the changes below
+            yield 1, 'Old question', 'Old', 1
+            self.assertEqual(index.search('old'), [1])
+            index.add(2, 'New question', 'New', 1)
+            index.remove(1)
+
+        def pool_rows():
+            yield 1, 1, 1
+            self.assertEqual(quiz_pool.draw(1), (1, 1))
+            quiz_pool.add(2, 1, 1)
+            quiz_pool.remove(1)
+
+        index.load(index_rows())
+        quiz_pool.load(pool_rows())
+
+        self.assertEqual(index.search('question'), [2])
+        self.assertEqual(quiz_pool.draw(1), (2, 1))
+
+    def test_listing_reuses_encoded_questions(self):
+        """the listings splice the cached JSON of each question"""
+        first = self.client().get('/questions')
+        second = self.client().get('/questions')
+        data = json.loads(second.data)
+        stats = json.loads(self.client().get('/cache').data)
+
+        self.assertEqual(second.status_code, 200)
+        self.assertEqual(second.mimetype, 'application/json')
+        self.assertEqual(json.loads(first.data), data)
+        self.assertEqual(data['list_of_questions'], [
+            question.format() for question in
+            Question.query.order_by(Question.id).limit(10)])
+        caches = {cache['name']: cache for cache in stats['caches']}
+        self.assertTrue(caches['question_json']['hits'])
+
+    def test_compressed_listing(self):
+        """gzip listings are compressed once per version of the page"""
+        expected = json.loads(self.client().get('/questions').data)
+        headers = {'Accept-Encoding': 'gzip'}
+        first = self.client().get('/questions', headers=headers)
+        second = self.client().get('/questions', headers=headers)
+
+        self.assertEqual(first.headers['Content-Encoding'], 'gzip')
+        self.assertIn('Accept-Encoding', first.headers['Vary'])
+        self.assertEqual(json.loads(gzip.decompress(first.data)), expected)
+        self.assertEqual(second.data, first.data)
+        self.assertEqual(second.headers['ETag'], first.headers['ETag'])
+        self.assertIn('desc="0 queries"', second.headers['Server-Timing'])
+
+    def test_reads_go_to_replica_until_client_writes(self):
+        """read-only routes use the replica, a client that wrote the primary"""
+        replica = 'sqlite:///' + os.path.join(tempfile.mkdtemp(), 'replica.db')
+        # An empty replica, its listings are not found
+        migrations.upgrade(create_engine(replica))
+
+        class ReplicaConfig(TestingConfig):
+            DB_REPLICA_URLS = [replica]
+
+        client = create_app(ReplicaConfig).test_client()
+        self.assertEqual(client.get('/questions').status_code, 404)
+
+        res = client.post('/questions', json={
+            'question': 'Replicated?', 'answer': 'Later', 'difficulty': 1,
+            'category': 1})
+        created = json.loads(res.data)['question_created']
+        self.assertIn('trivia_primary=1', res.headers['Set-Cookie'])
+        self.assertEqual(client.get('/questions').status_code, 200)
+        client.delete('/questions/{}'.format(created))
+
+    def test_quiz_draws_questions_missing_from_replica(self):
+        """a question not replicated yet is read from the primary"""
+        replica = 'sqlite:///' + os.path.join(tempfile.mkdtemp(), 'replica.db')
+        migrations.upgrade(create_engine(replica))
+
+        class ReplicaConfig(TestingConfig):
+            DB_REPLICA_URLS = [replica]
+
+        app = create_app(ReplicaConfig)
+        with app.app_context():
+            pool.draw()
+            question = Question(question='Replicated?', answer='Later',
+                                category=1, difficulty=1)
+            question.insert()
+            created = question.id
+            played = [id for id, in db.session.query(Question.id).filter(
+                Question.id != created)]
+
+        # Another client, which did not write
+        client = app.test_client()
+        reader = {'REMOTE_ADDR': '10.0.0.2'}
+        res = client.post('/quizzes', environ_base=reader, json={
+            'previous_questions': played,
+            'quiz_category': {'type': 'click', 'id': 0}})
+        data = json.loads(res.data)
+        self.assertEqual(data['question']['id'], created)
+        with app.test_request_context():
+            # Nothing read from a replica is cached right after a change
+            g.db_replicas = object()
+            category_question_ids.get_or_load(-1, lambda: [])
+            self.assertIsNone(category_question_ids.get(-1))
+
+        with app.app_context():
+            Question.query.get(created).delete()
+
+    def test_reads_fall_back_to_primary(self):
+        """a replica that cannot be reached is left out"""
+        class ReplicaConfig(TestingConfig):
+            DB_REPLICA_URLS = ['sqlite:////nonexistent/replica.db']
+
+        client = create_app(ReplicaConfig).test_client()
+        res = client.get('/questions')
+        stats = json.loads(client.get('/cache').data)
+
+        self.assertEqual(res.status_code, 200)
+        self.assertFalse(stats['replicas'][0]['healthy'])
+
 
 # Make the tests conveniently executable
 if __name__ == "__main__":
@@ -0,0 +1,59 @@
+import threading
+from sqlalchemy import func
+
+from models import db, Question, Category, on_change
+
+'''
+Totals
+    In-process cache of the number of questions (global and per category)
+    and of categories. The counts are computed with SELECT count(*) queries
+    the first time they are needed and dropped when a Change is notified.
+'''
+
+
+class Totals:
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._questions_by_category = None
+        self._total_categories = None
+
+    def questions(self, category=None):
+        by_category = self._questions_by_category
+        if by_category is None:
+            by_category = self._count_questions()
+        if category is None:
+            return sum(by_category.values())
+        return by_category.get(int(category), 0)
+
+    def categories(self):
+        total = self._total_categories
+        if total is None:
+            with self._lock:
+                total = db.session.query(func.count(Category.id)).scalar()
+                self._total_categories = total
+        return total
+
+    def invalidate(self, change=None):
+        with self._lock:
+            if change is None or change.table == 'questions':
+                self._questions_by_category = None
+            if change is None or change.table == 'categories':
+                self._total_categories = None
+
+    def _count_questions(self):
+        # One grouped query gives the global and every per category total:
+        with self._lock:
+            rows = db.session.query(
+                Question.category, func.count(Question.id)).group_by(
+                Question.category).all()
+            by_category = {}
+            for category, count in rows:
+                key = int(category) if category is not None else None
+                by_category[key] = by_category.get(key, 0) + count
+            self._questions_by_category = by_category
+        return by_category
+
+
+totals = Totals()
+on_change(totals.invalidate)